@@ -7,7 +7,6 @@ from datetime import datetime
 from logging import basicConfig, getLogger
 
 import polars as pl
-from mongoengine import connect
 from pycoshark.mongomodels import (
     Commit,
     File,
@@ -18,9 +17,21 @@ from pycoshark.mongomodels import (
     PullRequestSystem,
     VCSSystem,
 )
-from pycoshark.utils import create_mongodb_uri_string
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.checkpoint import CheckpointStore, default_checkpoint_dir
+from utils.commit_shards import merge_counts, run_shards, shard_filter, shard_ranges
+from utils.label_index import LabelIndex, load_or_build
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.project_pool import EXECUTORS, ProjectPool
+from utils.query_profiler import install_profiler, profile_project
+from utils.scheduler import largest_first
+from utils.snapshot import load_projects, scan
+from utils.source_files import (
+    SOURCE_FILE_PATTERN,
+    SourceFileTable,
+    load_or_build_table,
+)
 from utils.timeit_decorator import timeit_decorator
 
 # ========================================
@@ -35,30 +46,6 @@ IGNORED_PROJECTS = (
     "bigtop",
 )
 BOT_IDS = ("5ff191c8c26a57681e7b99d0",)  # dependabot
-SOURCE_FILE_EXTENSIONS = (
-    # Java
-    ".java",
-    # Scala
-    ".scala",
-    # Python
-    ".py",
-    # C
-    ".c",
-    ".h",
-    # C++
-    ".cpp",
-    ".hpp",
-    ".cc",
-    ".hh",
-    ".cxx",
-    ".hxx",
-    # C#
-    ".cs",
-    # JavaScript
-    ".js",
-    # TypeScript
-    ".ts",
-)
 
 # ロギングの設定
 basicConfig(
@@ -68,60 +55,94 @@ basicConfig(
 logger = getLogger(__name__)
 
 
-def connect_to_mongodb():
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
-    )
-    return connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
-    )
-
-
-def worker(project: Project) -> pl.DataFrame:
+def worker(
+    project: Project,
+    aggregate: bool = False,
+    snapshot_dir: str | None = None,
+    label_index_dir: str | None = None,
+    source_file_table_dir: str | None = None,
+    shards: int = 1,
+) -> pl.DataFrame:
     # 進捗表示
     if project.name in IGNORED_PROJECTS:
         logger.info(f"{project.name} Ignored")
         return pl.DataFrame()
     logger.info(f"{project.name} Start")
 
-    client = connect_to_mongodb()
-    row = process_project(project)
-    client.close()
+    # スナップショットを使用する場合は DB に接続しない
+    if snapshot_dir:
+        return pl.DataFrame(process_project_snapshot(project, snapshot_dir))
+
+    # プロセス内で共有する接続を使用 (閉じずに次のプロジェクトでも再利用する)
+    connect_to_mongodb()
+    with profile_project(project.name):
+        if aggregate:
+            row = process_project_aggregate(project)
+        else:
+            label_index = (
+                load_or_build(project, label_index_dir) if label_index_dir else None
+            )
+            row = process_project(project, label_index, source_file_table_dir, shards)
     return pl.DataFrame(row)
 
 
-def process_project(project: Project) -> dict:
-    row = {
+def process_project(
+    project: Project,
+    label_index: LabelIndex | None = None,
+    source_file_table_dir: str | None = None,
+    shards: int = 1,
+) -> dict:
+    # プロジェクトに含まれるコミットを取得
+    vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
+
+    # ファイルの分類表を作成 (commit 毎に File を取得しない)
+    source_file_table = load_or_build_table(vcs_system, source_file_table_dir)
+
+    # コミットを _id の範囲で分割し, シャード毎に並行してカウントしてから合計する
+    def count_shard(lower, upper) -> dict:
+        commits: list[Commit] = Commit.objects(
+            vcs_system_id=vcs_system.id, **shard_filter(lower, upper)
+        ).only("id")
+        return count_commits(project, commits, label_index, source_file_table)
+
+    counts = merge_counts(run_shards(count_shard, shard_ranges(vcs_system.id, shards)))
+    return {
         "project": project.name,
+        **{
+            key: counts[key]
+            for key in ("#cmt+pr+bi", "#cmt+pr-bi", "#cmt-pr+bi", "#cmt-pr-bi")
+        },
+    }
+
+
+def count_commits(
+    project: Project,
+    commits: list[Commit],
+    label_index: LabelIndex | None,
+    source_file_table: SourceFileTable,
+) -> dict:
+    row = {
         "#cmt+pr+bi": 0,
         "#cmt+pr-bi": 0,
         "#cmt-pr+bi": 0,
         "#cmt-pr-bi": 0,
     }
 
-    # プロジェクトに含まれるコミットを取得
-    vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
-    commits: list[Commit] = Commit.objects(vcs_system_id=vcs_system.id).only("id")
     for i, commit in enumerate(commits):
         # 進捗表示
         if i % 500 == 0:
             logger.info(f"{project.name: <24} {i}/{len(commits)}")
 
-        # コミットに含まれるファイルアクションとファイルを取得
+        # コミットに含まれるファイルアクションを取得
+        # (ラベル索引がある場合は induces を取得しない)
+        fields = ("file_id",) if label_index else ("induces.label", "file_id")
         file_actions: list[FileAction] = FileAction.objects(
             commit_id=commit.id,
-        ).only("induces.label", "file_id")
+        ).only(*fields)
         file_ids = [file_action.file_id for file_action in file_actions]
-        files = File.objects(id__in=file_ids).only("path")
 
         # コード変更を含まない場合はスキップ
-        if not any(file.path.endswith(SOURCE_FILE_EXTENSIONS) for file in files):
+        if not source_file_table.lookup(file_ids).any():
             continue
 
         # commit が pull_request に含まれているか判定
@@ -135,15 +156,20 @@ def process_project(project: Project) -> dict:
                 continue
             in_pull_request = True
 
-        # コミットが不具合混入しているかを判定
+        # コミットが不具合混入しているかを判定 (ラベル索引がある場合は索引から)
         is_bug_inducing = False
-        for file_action in file_actions:
-            if not file_action.induces:
-                continue
-            for induce in file_action.induces:
-                if induce["label"] == "JL+R":
-                    is_bug_inducing = True
-                    break
+        if label_index:
+            is_bug_inducing = bool(
+                label_index.has(label_index.lookup([commit.id]), "JL+R").any()
+            )
+        else:
+            for file_action in file_actions:
+                if not file_action.induces:
+                    continue
+                for induce in file_action.induces:
+                    if induce["label"] == "JL+R":
+                        is_bug_inducing = True
+                        break
 
         # プルリクエストの有無と不具合混入の有無によって, コミットをカウント
         if in_pull_request and is_bug_inducing:
@@ -158,42 +184,306 @@ def process_project(project: Project) -> dict:
     return row
 
 
+def process_project_aggregate(project: Project) -> dict:
+    row = {
+        "project": project.name,
+        "#cmt+pr+bi": 0,
+        "#cmt+pr-bi": 0,
+        "#cmt-pr+bi": 0,
+        "#cmt-pr-bi": 0,
+    }
+
+    # process_project と同じ判定を MongoDB 上で行い, 4 象限の件数だけを受け取る
+    vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
+    pipeline = [
+        {"$match": {"vcs_system_id": vcs_system.id}},
+        {"$project": {"_id": 1}},
+        # コミットに含まれるファイルアクションとファイルを取得
+        {
+            "$lookup": {
+                "from": FileAction._get_collection_name(),
+                "localField": "_id",
+                "foreignField": "commit_id",
+                "as": "file_actions",
+            }
+        },
+        {
+            "$project": {
+                "file_actions.file_id": 1,
+                "file_actions.induces.label": 1,
+            }
+        },
+        {
+            "$lookup": {
+                "from": File._get_collection_name(),
+                "localField": "file_actions.file_id",
+                "foreignField": "_id",
+                "as": "files",
+            }
+        },
+        # コード変更を含まない場合は除外
+        {
+            "$match": {
+                "$expr": {
+                    "$anyElementTrue": [
+                        {
+                            "$map": {
+                                "input": "$files.path",
+                                "as": "path",
+                                "in": {
+                                    "$regexMatch": {
+                                        "input": "$$path",
+                                        "regex": SOURCE_FILE_PATTERN,
+                                    }
+                                },
+                            }
+                        }
+                    ]
+                }
+            }
+        },
+        # commit が pull_request に含まれているか判定
+        {
+            "$lookup": {
+                "from": PullRequestCommit._get_collection_name(),
+                "localField": "_id",
+                "foreignField": "commit_id",
+                "as": "pull_request_commits",
+            }
+        },
+        {
+            "$project": {
+                "in_pull_request": {"$gt": [{"$size": "$pull_request_commits"}, 0]},
+                # process_project と同様に author_id を BOT_IDS と比較
+                "is_bot": {
+                    "$in": [
+                        {
+                            "$ifNull": [
+                                {
+                                    "$arrayElemAt": [
+                                        "$pull_request_commits.author_id",
+                                        0,
+                                    ]
+                                },
+                                None,
+                            ]
+                        },
+                        list(BOT_IDS),
+                    ]
+                },
+                # コミットが不具合混入しているかを判定
+                "is_bug_inducing": {
+                    "$anyElementTrue": [
+                        {
+                            "$map": {
+                                "input": "$file_actions",
+                                "as": "file_action",
+                                "in": {
+                                    "$in": [
+                                        "JL+R",
+                                        {
+                                            "$ifNull": [
+                                                "$$file_action.induces.label",
+                                                [],
+                                            ]
+                                        },
+                                    ]
+                                },
+                            }
+                        }
+                    ]
+                },
+            }
+        },
+        # Bot によるコミットは除外
+        {"$match": {"is_bot": False}},
+        # プルリクエストの有無と不具合混入の有無によって, コミットをカウント
+        {
+            "$group": {
+                "_id": {
+                    "in_pull_request": "$in_pull_request",
+                    "is_bug_inducing": "$is_bug_inducing",
+                },
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    for result in Commit._get_collection().aggregate(pipeline, allowDiskUse=True):
+        pr = "+pr" if result["_id"]["in_pull_request"] else "-pr"
+        bi = "+bi" if result["_id"]["is_bug_inducing"] else "-bi"
+        row[f"#cmt{pr}{bi}"] = result["count"]
+
+    return row
+
+
+def process_project_snapshot(project: Project, snapshot_dir: str) -> dict:
+    row = {
+        "project": project.name,
+        "#cmt+pr+bi": 0,
+        "#cmt+pr-bi": 0,
+        "#cmt-pr+bi": 0,
+        "#cmt-pr-bi": 0,
+    }
+
+    # プロジェクトに含まれるコミットを取得
+    vcs_system_id = scan(snapshot_dir, VCSSystem, project.name).collect()["id"][0]
+    commits = (
+        scan(snapshot_dir, Commit, project.name)
+        .filter(pl.col("vcs_system_id") == vcs_system_id)
+        .select(commit_id="id")
+    )
+    file_actions = scan(snapshot_dir, FileAction, project.name).select(
+        "commit_id", "file_id", "induces"
+    )
+    files = scan(snapshot_dir, File, project.name).select(file_id="id", path="path")
+
+    # コード変更を含むコミット
+    source_commits = (
+        file_actions.join(files, on="file_id")
+        .filter(pl.col("path").str.contains(SOURCE_FILE_PATTERN))
+        .select("commit_id")
+        .unique()
+    )
+
+    # pull_request に含まれるコミット
+    # process_project では author_id (ObjectId) を文字列の BOT_IDS と比較しており
+    # Bot によるコミットは除外されないため, ここでも除外しない
+    pull_request_commits = (
+        scan(snapshot_dir, PullRequestCommit, project.name)
+        .select("commit_id")
+        .drop_nulls()
+        .unique()
+        .with_columns(in_pull_request=pl.lit(True))
+    )
+
+    # 不具合混入しているコミット
+    bug_inducing_commits = (
+        file_actions.filter(pl.col("induces").list.contains("JL+R"))
+        .select("commit_id")
+        .unique()
+        .with_columns(is_bug_inducing=pl.lit(True))
+    )
+
+    # プルリクエストの有無と不具合混入の有無によって, コミットをカウント
+    counts = (
+        commits.join(source_commits, on="commit_id", how="semi")
+        .join(pull_request_commits, on="commit_id", how="left")
+        .join(bug_inducing_commits, on="commit_id", how="left")
+        .fill_null(False)
+        .group_by("in_pull_request", "is_bug_inducing")
+        .len()
+        .collect()
+    )
+    for in_pull_request, is_bug_inducing, count in counts.iter_rows():
+        pr = "+pr" if in_pull_request else "-pr"
+        bi = "+bi" if is_bug_inducing else "-bi"
+        row[f"#cmt{pr}{bi}"] = count
+
+    return row
+
+
 @timeit_decorator(logger=logger)
 def main(args):
-    # データベースに接続
-    client = connect_to_mongodb()
+    # クエリのプロファイルを取る場合は接続前にコマンド監視を登録
+    profiler = install_profiler(args.profile_bytes) if args.profile else None
+
+    # データベースに接続 (スナップショットを使用する場合は接続しない)
+    if not args.snapshot:
+        connect_to_mongodb()
 
-    # DataFrame の初期化
-    df = pl.DataFrame()
+    # チェックポイントの準備 (--resume でない場合は以前の結果を破棄)
+    checkpoint = CheckpointStore(
+        args.checkpoint_dir or default_checkpoint_dir(args.output)
+    )
+    if not args.resume:
+        checkpoint.clear()
+    # 前回と異なる設定で --resume した場合は中断する
+    checkpoint.check_config(
+        {
+            "aggregate": args.aggregate,
+            "snapshot": args.snapshot,
+            "label_index": args.label_index,
+        },
+        args.resume,
+    )
 
     # project のリストを取得
-    projects: list[Project] = Project.objects
+    if args.snapshot:
+        projects: list[Project] = load_projects(args.snapshot)
+    else:
+        projects: list[Project] = Project.objects
     if args.small:
         projects = projects[:16]
     project_count = len(projects)
 
-    # データベースをクローズ
-    client.close()
+    # 完了済みのプロジェクトは除外
+    pending_projects = [
+        project for project in projects if not checkpoint.is_done(project.name)
+    ]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        done_count = 0
+    # 大きいプロジェクトから順に実行 (前回の処理時間, 無い場合は件数から見積もる)
+    timings = checkpoint.load_timings()
+    if args.largest_first:
+        pending_projects = largest_first(pending_projects, timings, args.snapshot)
+
+    with ProjectPool(args.executor, args.workers) as pool:
+        done_count = len(projects) - len(pending_projects)
         future_to_project = {
-            executor.submit(worker, project): project for project in projects
+            pool.submit(
+                worker,
+                project,
+                args.aggregate,
+                args.snapshot,
+                args.label_index,
+                args.source_file_table,
+                args.shards,
+            ): project
+            for project in pending_projects
         }
         for future in concurrent.futures.as_completed(future_to_project):
             # 進捗表示
             done_count += 1
             project = future_to_project[future]
+
+            # 失敗したプロジェクトは記録して次回の --resume で再実行
+            try:
+                result = pool.result(future)
+            except Exception as error:
+                logger.exception(
+                    f"{project.name} Failed ({done_count}/{project_count})"
+                )
+                checkpoint.mark_failed(project.name, error)
+                continue
             logger.info(f"{project.name} Done ({done_count}/{project_count})")
-            # 結果を DataFrame に追加
-            df = pl.concat([df, future.result()], how="diagonal")
+
+            # チェックポイントに保存
+            checkpoint.save(project.name, result)
+            timings[project.name] = pool.elapsed(future)
+
+    # 次回の見積もりのために処理時間を保存
+    checkpoint.save_timings(timings)
+
+    # データベース接続を閉じる
+    close_mongodb()
+
+    # クエリのプロファイルを出力
+    if profiler:
+        profiler.write(args.profile)
+
+    # 失敗したプロジェクトがある場合は出力しない
+    failed_projects = checkpoint.failed_projects()
+    if failed_projects:
+        logger.error(f"Failed: {', '.join(failed_projects)}. Rerun with --resume.")
+        return
+
+    # チェックポイントを結合 (遅延評価)
+    df = checkpoint.scan([project.name for project in projects])
 
     # null を 0 で埋める
     df = df.fill_null(0)
 
     # CSV に出力
-    with open(args.output, "w") as f:
-        df.write_csv(f)
+    df.sink_csv(args.output)
 
 
 if __name__ == "__main__":
@@ -202,6 +492,21 @@ if __name__ == "__main__":
         "-o", "--output", type=str, default="data/pull_request_effect.csv"
     )
     parser.add_argument("--small", default=False, action="store_true")
+    parser.add_argument("--aggregate", default=False, action="store_true")
+    parser.add_argument("--snapshot", type=str, default=None)
+    parser.add_argument("--label-index", type=str, default=None)
+    parser.add_argument("--source-file-table", type=str, default=None)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--executor", choices=EXECUTORS, default="thread")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--largest-first", default=False, action="store_true")
+    parser.add_argument("--profile", type=str, default=None)
+    parser.add_argument("--profile-bytes", default=False, action="store_true")
+    parser.add_argument("--checkpoint-dir", type=str, default=None)
+    parser.add_argument("--resume", default=False, action="store_true")
     args = parser.parse_args()
+    # 子プロセスで発行したクエリは親プロセスのプロファイラに記録されない
+    if args.profile and args.executor == "process":
+        parser.error("--profile cannot be used with --executor process")
 
     main(args)
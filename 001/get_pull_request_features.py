@@ -1,15 +1,17 @@
 import argparse
+import asyncio
 import concurrent.futures
 import os
 import sys
+import time
+from collections import defaultdict
 from datetime import datetime
 from logging import basicConfig, getLogger
+from typing import TYPE_CHECKING, Iterable
 
 import polars as pl
-from mongoengine import connect
 from pycoshark.mongomodels import (
     Commit,
-    File,
     FileAction,
     Project,
     PullRequest,
@@ -21,11 +23,24 @@ from pycoshark.mongomodels import (
     PullRequestSystem,
     VCSSystem,
 )
-from pycoshark.utils import create_mongodb_uri_string
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.checkpoint import CheckpointStore, default_checkpoint_dir
+from utils.chunked_query import fetch_in_chunks, group_by
+from utils.feature_store import build_feature_store
+from utils.label_index import LabelIndex, load_or_build
+from utils.mongo_client import DEFAULT_CONCURRENCY, close_mongodb, connect_to_mongodb
+from utils.project_pool import EXECUTORS, ProjectPool
+from utils.query_profiler import install_profiler, profile_project
+from utils.scheduler import largest_first
+from utils.snapshot import load_projects, scan
+from utils.source_files import SOURCE_FILE_EXTENSIONS, SOURCE_FILE_PATTERN
 from utils.timeit_decorator import timeit_decorator
 
+# motor は --asyncio の場合のみ必要なため, 型注釈以外では実行時に読み込む
+if TYPE_CHECKING:
+    from utils.async_mongo import AsyncQueryRunner
+
 # ========================================
 # 定数
 # ========================================
@@ -38,30 +53,6 @@ IGNORED_PROJECTS = (
     "bigtop",
 )
 BOT_IDS = ("5ff191c8c26a57681e7b99d0",)  # dependabot
-SOURCE_FILE_EXTENSIONS = (
-    # Java
-    ".java",
-    # Scala
-    ".scala",
-    # Python
-    ".py",
-    # C
-    ".c",
-    ".h",
-    # C++
-    ".cpp",
-    ".hpp",
-    ".cc",
-    ".hh",
-    ".cxx",
-    ".hxx",
-    # C#
-    ".cs",
-    # JavaScript
-    ".js",
-    # TypeScript
-    ".ts",
-)
 
 # ロギングの設定
 basicConfig(
@@ -71,225 +62,698 @@ basicConfig(
 logger = getLogger(__name__)
 
 
-def connect_to_mongodb():
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
-    )
-    return connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
-    )
+def worker(
+    project: Project,
+    prefetch: bool = False,
+    snapshot_dir: str | None = None,
+    label_index_dir: str | None = None,
+    features: list[str] | None = None,
+) -> pl.DataFrame:
+    # 進捗表示
+    if project.name in IGNORED_PROJECTS:
+        logger.info(f"{project.name} Ignored")
+        return pl.DataFrame()
+    logger.info(f"{project.name} Start")
+
+    # スナップショットを使用する場合は DB に接続しない
+    if snapshot_dir:
+        return pl.DataFrame(process_project_snapshot(project, snapshot_dir, features))
+
+    # プロセス内で共有する接続を使用 (閉じずに次のプロジェクトでも再利用する)
+    connect_to_mongodb()
+    with profile_project(project.name):
+        label_index = (
+            load_or_build(project, label_index_dir) if label_index_dir else None
+        )
+        rows = process_project(
+            project, prefetch=prefetch, label_index=label_index, features=features
+        )
+
+    return pl.DataFrame(rows)
 
 
-def worker(project: Project) -> pl.DataFrame:
+async def worker_async(
+    runner: "AsyncQueryRunner",
+    project: Project,
+    label_index_dir: str | None = None,
+    features: list[str] | None = None,
+) -> pl.DataFrame:
     # 進捗表示
     if project.name in IGNORED_PROJECTS:
         logger.info(f"{project.name} Ignored")
         return pl.DataFrame()
     logger.info(f"{project.name} Start")
 
-    client = connect_to_mongodb()
-    rows = process_project(project)
+    # ラベル索引の作成は同期クライアントで行うため別スレッドで実行
+    label_index = (
+        await asyncio.to_thread(load_or_build, project, label_index_dir)
+        if label_index_dir
+        else None
+    )
+    return pl.DataFrame(
+        await process_project_async(runner, project, label_index, features)
+    )
+
+
+async def run_async(
+    projects: list[Project],
+    pending_projects: list[Project],
+    checkpoint: CheckpointStore,
+    timings: dict[str, float],
+    concurrency: int,
+    label_index_dir: str | None = None,
+    features: list[str] | None = None,
+):
+    # 全プロジェクトを 1 つのイベントループで並行実行
+    # (同時に発行するクエリの数はプロジェクトを跨いで concurrency に制限)
+    from utils.async_mongo import AsyncQueryRunner, connect_to_motor
+
+    client = connect_to_motor()
+    runner = AsyncQueryRunner(client[os.getenv("SMARTSHARK_DB_DATABASE")], concurrency)
+
+    async def run(project: Project):
+        # 処理時間は次回の見積もりに使う (他のプロジェクトと並行して実行した時間)
+        start = time.perf_counter()
+        try:
+            result = await worker_async(runner, project, label_index_dir, features)
+            return project, result, None, time.perf_counter() - start
+        except Exception as error:
+            return project, None, error, time.perf_counter() - start
+
+    done_count = len(projects) - len(pending_projects)
+    for coroutine in asyncio.as_completed(
+        [run(project) for project in pending_projects]
+    ):
+        # 進捗表示
+        done_count += 1
+        project, result, error, elapsed = await coroutine
+
+        # 失敗したプロジェクトは記録して次回の --resume で再実行
+        if error:
+            logger.error(
+                f"{project.name} Failed ({done_count}/{len(projects)})",
+                exc_info=error,
+            )
+            checkpoint.mark_failed(project.name, error)
+            continue
+        logger.info(f"{project.name} Done ({done_count}/{len(projects)})")
+
+        # チェックポイントに保存
+        checkpoint.save(project.name, result)
+        timings[project.name] = elapsed
+
     client.close()
 
-    return pl.DataFrame(rows)
 
+# ========================================
+# 特徴量の登録
+# ========================================
+# 常に出力する列
+KEY_FEATURES = ("project", "id")
 
-def process_project(project: Project) -> list[dict]:
-    pull_request_systems = PullRequestSystem.objects(project_id=project.id).only(
-        "id", "url"
+# 列名: (必要なフィールド, 計算する関数)
+# 必要なフィールドは fetch_pull_request_data が返すキー毎に .only() で取得するフィールド
+# (pull_request は process_project で取得するプルリクエストのフィールド)
+FEATURES = {}
+
+
+def feature(name: str, **requires: tuple[str, ...]):
+    def register(function):
+        FEATURES[name] = (requires, function)
+        return function
+
+    return register
+
+
+def select_features(features: Iterable[str] | None = None) -> list[str]:
+    # 登録順に並べ, 常に出力する列を先頭に追加する (None の場合は全ての特徴量)
+    if features is None:
+        return list(FEATURES)
+    return [name for name in FEATURES if name in KEY_FEATURES or name in set(features)]
+
+
+def required_fields(features: Iterable[str]) -> dict[str, tuple[str, ...]]:
+    # 選択した特徴量が必要とするフィールドをキー毎にまとめる
+    # コミットが存在しないプルリクエストを除外するため pull_request_commits は常に取得
+    fields = defaultdict(dict)
+    fields["pull_request_commits"]["commit_id"] = None
+    for name in features:
+        requires, _ = FEATURES[name]
+        for key, names in requires.items():
+            fields[key].update(dict.fromkeys(names))
+    # レビューコメントはレビューの id から取得
+    if "pull_request_review_comments" in fields:
+        fields["pull_request_reviews"]["id"] = None
+    return {key: tuple(names) for key, names in fields.items()}
+
+
+# プロジェクト名
+@feature("project")
+def compute_project(pull_request: PullRequest, data: dict, context: dict):
+    return context["project"]
+
+
+# プルリクエストの識別子
+@feature("id")
+def compute_id(pull_request: PullRequest, data: dict, context: dict):
+    return str(pull_request.id)
+
+
+# マージされるまでの時間 (分)
+@feature("age", pull_request=("created_at", "merged_at"))
+def compute_age(pull_request: PullRequest, data: dict, context: dict):
+    return (pull_request.merged_at - pull_request.created_at).total_seconds() / 60
+
+
+# 含まれるコミット数
+@feature("#commits")
+def compute_commit_count(pull_request: PullRequest, data: dict, context: dict):
+    return len(data["pull_request_commits"])
+
+
+# 追加行数
+@feature("#added", pull_request_files=("additions",))
+def compute_added(pull_request: PullRequest, data: dict, context: dict):
+    return sum(
+        pull_request_file.additions for pull_request_file in data["pull_request_files"]
     )
-    pull_request_system_ids = [
-        pull_request_system.id for pull_request_system in pull_request_systems
-    ]
-    owner, repository = pull_request_systems[0].url.split("/")[-3:-1]
-    pull_request_system_url = f"https://github.com/{owner}/{repository}/pull"
 
-    # マージされた pull_request を取得
-    pull_requests: list[PullRequest] = PullRequest.objects(
-        pull_request_system_id__in=pull_request_system_ids, merged_at__exists=True
-    ).only(
-        "id",
-        "external_id",
-        "created_at",
-        "merged_at",
-        "source_repo_url",
-        "target_repo_url",
-        "creator_id",
-        "author_association",
+
+# 削除行数
+@feature("#deleted", pull_request_files=("deletions",))
+def compute_deleted(pull_request: PullRequest, data: dict, context: dict):
+    return sum(
+        pull_request_file.deletions for pull_request_file in data["pull_request_files"]
     )
 
-    rows = []
-    for pull_request in pull_requests:
-        # ========================================
-        # 事前に必要なデータを取得
-        # ========================================
 
-        # プルリクエストコミット情報
-        pull_request_commits: list[PullRequestCommit] = PullRequestCommit.objects(
-            pull_request_id=pull_request.id,
-            commit_id__exists=True,
-        ).only("commit_id")
-        # コミットが存在しない場合はスキップ
-        if not pull_request_commits:
-            continue
-        commit_ids = [
-            pull_request_commit.commit_id
-            for pull_request_commit in pull_request_commits
-        ]
+# 変更ファイル数
+@feature("#files", pull_request_files=("id",))
+def compute_file_count(pull_request: PullRequest, data: dict, context: dict):
+    return len(data["pull_request_files"])
+
+
+# コメント数
+@feature("#comments", pull_request_comments=("id",))
+def compute_comment_count(pull_request: PullRequest, data: dict, context: dict):
+    return len(data["pull_request_comments"])
+
+
+# レビューコメント数
+@feature("#review_comments", pull_request_review_comments=("id",))
+def compute_review_comment_count(pull_request: PullRequest, data: dict, context: dict):
+    return len(data["pull_request_review_comments"])
+
+
+# Bot によるプルリクエストかどうか
+@feature("bot", pull_request=("creator_id",))
+def compute_bot(pull_request: PullRequest, data: dict, context: dict):
+    return str(pull_request.creator_id) in BOT_IDS
+
+
+# コード変更かどうか
+@feature("code_change", pull_request_files=("path",))
+def compute_code_change(pull_request: PullRequest, data: dict, context: dict):
+    return any(
+        pull_request_file.path.endswith(tuple(SOURCE_FILE_EXTENSIONS))
+        for pull_request_file in data["pull_request_files"]
+    )
+
+
+# ソースとターゲットのリポジトリが同じかどうか
+@feature("intra_branch", pull_request=("source_repo_url", "target_repo_url"))
+def compute_intra_branch(pull_request: PullRequest, data: dict, context: dict):
+    source_owner, source_repository = (
+        pull_request.source_repo_url.split("/")[-2:]
+        if pull_request.source_repo_url
+        else (None, None)
+    )
+    target_owner, target_repository = pull_request.target_repo_url.split("/")[-2:]
+    return source_owner == target_owner and source_repository == target_repository
+
+
+# 最後のコメントにメンションが含まれているかどうか
+# TODO
+
+
+# 承認数
+@feature("#approvals", pull_request_reviews=("state",))
+def compute_approvals(pull_request: PullRequest, data: dict, context: dict):
+    return sum(
+        pull_request_review.state == "APPROVED"
+        for pull_request_review in data["pull_request_reviews"]
+    )
+
+
+# 変更依頼数
+@feature("#changes_requested", pull_request_reviews=("state",))
+def compute_changes_requested(pull_request: PullRequest, data: dict, context: dict):
+    return sum(
+        pull_request_review.state == "CHANGES_REQUESTED"
+        for pull_request_review in data["pull_request_reviews"]
+    )
+
+
+# 不具合修正かどうか
+# ラベル索引がある場合は commits の代わりに commit_masks を使用
+@feature("fix", commits=("labels",))
+def compute_fix(pull_request: PullRequest, data: dict, context: dict):
+    label_index = context["label_index"]
+    if label_index:
+        return bool(label_index.has(data["commit_masks"], "issueonly_bugfix").any())
+    for commit in data["commits"]:
+        if "issueonly_bugfix" not in commit.labels:
+            print(commit.id)
+        if commit.labels["issueonly_bugfix"]:
+            return True
+    return False
+
+
+# テストコードが含まれているかどうか
+@feature("test", pull_request_files=("path",))
+def compute_test(pull_request: PullRequest, data: dict, context: dict):
+    return any(
+        substring in pull_request_file.path.lower()
+        for pull_request_file in data["pull_request_files"]
+        for substring in ["test", "spec"]
+    )
+
+
+# 不具合混入しているかどうか
+# ラベル索引がある場合は file_actions の代わりに commit_masks を使用
+@feature("buggy", file_actions=("induces",))
+def compute_buggy(pull_request: PullRequest, data: dict, context: dict):
+    label_index = context["label_index"]
+    if label_index:
+        return bool(label_index.has(data["commit_masks"], "JL+R").any())
+    return any(
+        induce["label"] == "JL+R"
+        for file_action in data["file_actions"]
+        for induce in file_action.induces
+    )
+
+
+# 作成者がメンバーかどうか
+@feature("is_member", pull_request=("author_association",))
+def compute_is_member(pull_request: PullRequest, data: dict, context: dict):
+    return pull_request.author_association == "MEMBER"
+
+
+# プルリクエストへのリンク
+@feature("url", pull_request=("external_id",))
+def compute_url(pull_request: PullRequest, data: dict, context: dict):
+    return f"{context['pull_request_system_url']}/{pull_request.external_id}"
+
+
+# ========================================
+# データの取得
+# ========================================
+def uses_label_index(fields: dict, label_index: LabelIndex | None) -> bool:
+    # ラベル索引がある場合は commits と file_actions を取得せず commit_masks を使用
+    return bool(label_index) and ("commits" in fields or "file_actions" in fields)
+
+
+def fetch_pull_request_data(
+    pull_request: PullRequest,
+    label_index: LabelIndex | None = None,
+    fields: dict[str, tuple[str, ...]] | None = None,
+) -> dict:
+    fields = fields or required_fields(FEATURES)
+
+    # プルリクエストコミット情報
+    pull_request_commits: list[PullRequestCommit] = PullRequestCommit.objects(
+        pull_request_id=pull_request.id,
+        commit_id__exists=True,
+    ).only(*fields["pull_request_commits"])
+    # コミットが存在しない場合は以降のクエリを省略
+    if not pull_request_commits:
+        return {"pull_request_commits": []}
+    commit_ids = [
+        pull_request_commit.commit_id for pull_request_commit in pull_request_commits
+    ]
+    data = {"pull_request_commits": pull_request_commits}
 
+    # ラベル索引がある場合はコミットのラベルを索引から取得
+    if uses_label_index(fields, label_index):
+        data["commit_masks"] = label_index.lookup(commit_ids)
+    else:
         # コミット情報
-        commits: list[Commit] = Commit.objects(id__in=commit_ids)
+        if "commits" in fields:
+            data["commits"] = Commit.objects(id__in=commit_ids).only(*fields["commits"])
 
         # ファイルアクション情報
-        file_actions: list[FileAction] = FileAction.objects(
-            commit_id__in=commit_ids
-        ).only("file_id", "induces")
-
-        # ファイル情報
-        file_ids = set(
-            [file_action.file_id for file_action in file_actions if file_action.file_id]
-        )
-        files = File.objects(id__in=file_ids).only("path")
+        if "file_actions" in fields:
+            data["file_actions"] = FileAction.objects(commit_id__in=commit_ids).only(
+                *fields["file_actions"]
+            )
 
-        # プルリクエストファイル情報
-        pull_request_files: list[PullRequestFile] = PullRequestFile.objects(
+    # プルリクエストファイル情報
+    if "pull_request_files" in fields:
+        data["pull_request_files"] = PullRequestFile.objects(
             pull_request_id=pull_request.id
-        ).only("path", "additions", "deletions")
+        ).only(*fields["pull_request_files"])
 
-        # プルリクエストコメント情報
-        pull_request_comments: list[PullRequestComment] = (
+    # プルリクエストコメント情報
+    if "pull_request_comments" in fields:
+        data["pull_request_comments"] = (
             PullRequestComment.objects(pull_request_id=pull_request.id)
             .order_by("created_at")
-            .only("created_at", "comment")
+            .only(*fields["pull_request_comments"])
         )
 
-        # プルリクエストレビュー情報
-        pull_request_reviews: list[PullRequestReview] = (
+    # プルリクエストレビュー情報
+    if "pull_request_reviews" in fields:
+        data["pull_request_reviews"] = (
             PullRequestReview.objects(pull_request_id=pull_request.id)
             .order_by("submitted_at")
-            .only("submitted_at", "state")
+            .only(*fields["pull_request_reviews"])
         )
 
-        # プルリクエストレビューコメント情報
+    # プルリクエストレビューコメント情報
+    if "pull_request_review_comments" in fields:
         pull_request_review_ids = [
-            pull_request_review.id for pull_request_review in pull_request_reviews
+            pull_request_review.id
+            for pull_request_review in data["pull_request_reviews"]
         ]
-        pull_request_review_comments: list[PullRequestReviewComment] = (
+        data["pull_request_review_comments"] = (
             PullRequestReviewComment.objects(
                 pull_request_review_id__in=pull_request_review_ids,
                 comment__exists=True,
             )
             .order_by("created_at")
-            .only("created_at")
+            .only(*fields["pull_request_review_comments"])
         )
 
-        # ========================================
-        # レコードを作成
-        # ========================================
+    return data
+
+
+def prefetch_pull_request_data(
+    pull_requests: list[PullRequest],
+    label_index: LabelIndex | None = None,
+    fields: dict[str, tuple[str, ...]] | None = None,
+) -> dict:
+    fields = fields or required_fields(FEATURES)
+    pull_request_ids = [pull_request.id for pull_request in pull_requests]
+
+    def prefetch(queryset, field: str, values: list) -> dict:
+        return group_by(
+            fetch_in_chunks(queryset, field, values),
+            key=lambda document: getattr(document, field),
+        )
+
+    # プルリクエストコミット情報
+    pull_request_commits = prefetch(
+        PullRequestCommit.objects(commit_id__exists=True).only(
+            "pull_request_id", *fields["pull_request_commits"]
+        ),
+        "pull_request_id",
+        pull_request_ids,
+    )
+    commit_ids = [
+        pull_request_commit.commit_id
+        for pull_request_commits_ in pull_request_commits.values()
+        for pull_request_commit in pull_request_commits_
+    ]
+
+    # コミット情報とファイルアクション情報 (ラベル索引がある場合は取得しない)
+    use_label_index = uses_label_index(fields, label_index)
+    commits = {}
+    file_actions = {}
+    if not use_label_index and "commits" in fields:
+        commits = {
+            commit.id: commit
+            for commit in fetch_in_chunks(
+                Commit.objects.only(*fields["commits"]), "id", commit_ids
+            )
+        }
+    if not use_label_index and "file_actions" in fields:
+        file_actions = prefetch(
+            FileAction.objects.only("commit_id", *fields["file_actions"]),
+            "commit_id",
+            commit_ids,
+        )
 
-        row = {}
+    # プルリクエストファイル情報
+    pull_request_files = {}
+    if "pull_request_files" in fields:
+        pull_request_files = prefetch(
+            PullRequestFile.objects.only(
+                "pull_request_id", *fields["pull_request_files"]
+            ),
+            "pull_request_id",
+            pull_request_ids,
+        )
 
-        # プロジェクト名
-        row["project"] = project.name
+    # プルリクエストコメント情報
+    pull_request_comments = {}
+    if "pull_request_comments" in fields:
+        pull_request_comments = prefetch(
+            PullRequestComment.objects.order_by("created_at").only(
+                "pull_request_id", *fields["pull_request_comments"]
+            ),
+            "pull_request_id",
+            pull_request_ids,
+        )
 
-        # プルリクエストの識別子
-        row["id"] = str(pull_request.id)
+    # プルリクエストレビュー情報
+    pull_request_reviews = {}
+    if "pull_request_reviews" in fields:
+        pull_request_reviews = prefetch(
+            PullRequestReview.objects.order_by("submitted_at").only(
+                "pull_request_id", *fields["pull_request_reviews"]
+            ),
+            "pull_request_id",
+            pull_request_ids,
+        )
 
-        # マージされるまでの時間 (分)
-        row["age"] = (
-            pull_request.merged_at - pull_request.created_at
-        ).total_seconds() / 60
+    # プルリクエストレビューコメント情報
+    pull_request_review_comments = {}
+    if "pull_request_review_comments" in fields:
+        pull_request_review_ids = [
+            pull_request_review.id
+            for pull_request_reviews_ in pull_request_reviews.values()
+            for pull_request_review in pull_request_reviews_
+        ]
+        pull_request_review_comments = prefetch(
+            PullRequestReviewComment.objects(comment__exists=True)
+            .order_by("created_at")
+            .only("pull_request_review_id", *fields["pull_request_review_comments"]),
+            "pull_request_review_id",
+            pull_request_review_ids,
+        )
 
-        # 含まれるコミット数
-        row["#commits"] = len(pull_request_commits)
+    # プルリクエスト毎に fetch_pull_request_data と同じ形に組み立てる
+    pull_request_data = {}
+    for pull_request_id in pull_request_ids:
+        pull_request_commits_ = pull_request_commits.get(pull_request_id, [])
+        if not pull_request_commits_:
+            pull_request_data[pull_request_id] = {"pull_request_commits": []}
+            continue
+        commit_ids_ = dict.fromkeys(
+            pull_request_commit.commit_id
+            for pull_request_commit in pull_request_commits_
+        )
+        reviews = pull_request_reviews.get(pull_request_id, [])
+        data = {"pull_request_commits": pull_request_commits_}
+        if use_label_index:
+            data["commit_masks"] = label_index.lookup(commit_ids_)
+        if not use_label_index and "commits" in fields:
+            data["commits"] = [
+                commits[commit_id] for commit_id in commit_ids_ if commit_id in commits
+            ]
+        if not use_label_index and "file_actions" in fields:
+            data["file_actions"] = [
+                file_action
+                for commit_id in commit_ids_
+                for file_action in file_actions.get(commit_id, [])
+            ]
+        if "pull_request_files" in fields:
+            data["pull_request_files"] = pull_request_files.get(pull_request_id, [])
+        if "pull_request_comments" in fields:
+            data["pull_request_comments"] = pull_request_comments.get(
+                pull_request_id, []
+            )
+        if "pull_request_reviews" in fields:
+            data["pull_request_reviews"] = reviews
+        if "pull_request_review_comments" in fields:
+            data["pull_request_review_comments"] = [
+                comment
+                for review in reviews
+                for comment in pull_request_review_comments.get(review.id, [])
+            ]
+        pull_request_data[pull_request_id] = data
 
-        # 追加行数・削除行数
-        row["#added"] = 0
-        row["#deleted"] = 0
-        for pull_request_file in pull_request_files:
-            row["#added"] += pull_request_file.additions
-            row["#deleted"] += pull_request_file.deletions
+    return pull_request_data
 
-        # 変更ファイル数
-        row["#files"] = len(pull_request_files)
 
-        # コメント数
-        row["#comments"] = len(pull_request_comments)
+async def fetch_pull_request_data_async(
+    runner: "AsyncQueryRunner",
+    pull_request: PullRequest,
+    label_index: LabelIndex | None = None,
+    fields: dict[str, tuple[str, ...]] | None = None,
+) -> dict:
+    # fetch_pull_request_data と同じ形のデータを, 独立したクエリを並行に発行して取得
+    fields = fields or required_fields(FEATURES)
 
-        # レビューコメント数
-        row["#review_comments"] = len(pull_request_review_comments)
+    # プルリクエストコミット情報
+    pull_request_commits = await runner.find(
+        PullRequestCommit,
+        {"pull_request_id": pull_request.id, "commit_id": {"$exists": True}},
+        fields["pull_request_commits"],
+    )
+    # コミットが存在しない場合は以降のクエリを省略
+    if not pull_request_commits:
+        return {"pull_request_commits": []}
+    commit_ids = [
+        pull_request_commit.commit_id for pull_request_commit in pull_request_commits
+    ]
+    data = {"pull_request_commits": pull_request_commits}
 
-        # Bot によるプルリクエストかどうか
-        row["bot"] = str(pull_request.creator_id) in BOT_IDS
+    async def fetch_commits():
+        # コミット情報
+        data["commits"] = await runner.find(
+            Commit, {"_id": {"$in": commit_ids}}, fields["commits"]
+        )
 
-        # コード変更かどうか
-        row["code_change"] = any(
-            pull_request_file.path.endswith(tuple(SOURCE_FILE_EXTENSIONS))
-            for pull_request_file in pull_request_files
+    async def fetch_file_actions():
+        # ファイルアクション情報
+        data["file_actions"] = await runner.find(
+            FileAction, {"commit_id": {"$in": commit_ids}}, fields["file_actions"]
         )
 
-        # ソースとターゲットのリポジトリが同じかどうか
-        source_owner, source_repository = (
-            pull_request.source_repo_url.split("/")[-2:]
-            if pull_request.source_repo_url
-            else (None, None)
+    async def fetch_files():
+        # プルリクエストファイル情報
+        data["pull_request_files"] = await runner.find(
+            PullRequestFile,
+            {"pull_request_id": pull_request.id},
+            fields["pull_request_files"],
+        )
+
+    async def fetch_comments():
+        # プルリクエストコメント情報
+        data["pull_request_comments"] = await runner.find(
+            PullRequestComment,
+            {"pull_request_id": pull_request.id},
+            fields["pull_request_comments"],
+            sort=[("created_at", 1)],
+        )
+
+    async def fetch_reviews():
+        # プルリクエストレビュー情報とレビューコメント情報 (レビューの取得後)
+        data["pull_request_reviews"] = await runner.find(
+            PullRequestReview,
+            {"pull_request_id": pull_request.id},
+            fields["pull_request_reviews"],
+            sort=[("submitted_at", 1)],
+        )
+        if "pull_request_review_comments" in fields:
+            data["pull_request_review_comments"] = await runner.find(
+                PullRequestReviewComment,
+                {
+                    "pull_request_review_id": {
+                        "$in": [review.id for review in data["pull_request_reviews"]]
+                    },
+                    "comment": {"$exists": True},
+                },
+                fields["pull_request_review_comments"],
+                sort=[("created_at", 1)],
+            )
+
+    # ラベル索引がある場合はコミットのラベルを索引から取得
+    use_label_index = uses_label_index(fields, label_index)
+    if use_label_index:
+        data["commit_masks"] = label_index.lookup(commit_ids)
+
+    # 必要なものだけを並行に取得
+    fetches = {
+        "commits": fetch_commits,
+        "file_actions": fetch_file_actions,
+        "pull_request_files": fetch_files,
+        "pull_request_comments": fetch_comments,
+        "pull_request_reviews": fetch_reviews,
+    }
+    await asyncio.gather(
+        *(
+            fetch()
+            for key, fetch in fetches.items()
+            if key in fields
+            and not (use_label_index and key in ("commits", "file_actions"))
+        )
+    )
+
+    return data
+
+
+# ========================================
+# レコードの作成
+# ========================================
+def build_row(
+    features: list[str],
+    context: dict,
+    pull_request: PullRequest,
+    data: dict,
+) -> dict | None:
+    # コミットが存在しない場合はスキップ
+    if not data["pull_request_commits"]:
+        return None
+    return {name: FEATURES[name][1](pull_request, data, context) for name in features}
+
+
+def get_pull_request_system_url(pull_request_systems) -> str:
+    owner, repository = pull_request_systems[0].url.split("/")[-3:-1]
+    return f"https://github.com/{owner}/{repository}/pull"
+
+
+def process_project(
+    project: Project,
+    prefetch: bool = False,
+    label_index: LabelIndex | None = None,
+    features: Iterable[str] | None = None,
+) -> list[dict]:
+    features = select_features(features)
+    fields = required_fields(features)
+
+    pull_request_systems = PullRequestSystem.objects(project_id=project.id).only(
+        "id", "url"
+    )
+    pull_request_system_ids = [
+        pull_request_system.id for pull_request_system in pull_request_systems
+    ]
+    context = {
+        "project": project.name,
+        "pull_request_system_url": get_pull_request_system_url(pull_request_systems),
+        "label_index": label_index,
+    }
+
+    # マージされた pull_request を取得
+    pull_requests: list[PullRequest] = PullRequest.objects(
+        pull_request_system_id__in=pull_request_system_ids, merged_at__exists=True
+    ).only("id", *fields.get("pull_request", ()))
+
+    # prefetch の場合はプロジェクト単位でまとめて取得
+    if prefetch:
+        pull_requests = list(pull_requests)
+        pull_request_data = prefetch_pull_request_data(
+            pull_requests, label_index, fields
         )
-        target_owner, target_repository = pull_request.target_repo_url.split("/")[-2:]
-        row["intra_branch"] = (
-            source_owner == target_owner and source_repository == target_repository
+
+    rows = []
+    for pull_request in pull_requests:
+        # ========================================
+        # 事前に必要なデータを取得
+        # ========================================
+        data = (
+            pull_request_data[pull_request.id]
+            if prefetch
+            else fetch_pull_request_data(pull_request, label_index, fields)
         )
 
-        # 最後のコメントにメンションが含まれているかどうか
-        # TODO
-
-        # 承認数・変更依頼数
-        row["#approvals"] = 0
-        row["#changes_requested"] = 0
-        for pull_request_review in pull_request_reviews:
-            if pull_request_review.state == "APPROVED":
-                row["#approvals"] += 1
-            if pull_request_review.state == "CHANGES_REQUESTED":
-                row["#changes_requested"] += 1
-
-        # 不具合修正かどうか
-        row["fix"] = False
-        for commit in commits:
-            if "issueonly_bugfix" not in commit.labels:
-                print(commit.id)
-            if commit.labels["issueonly_bugfix"]:
-                row["fix"] = True
-                break
-
-        # テストコードが含まれているかどうか
-        row["test"] = False
-        for pull_request_file in pull_request_files:
-            if any(
-                substring in pull_request_file.path.lower()
-                for substring in ["test", "spec"]
-            ):
-                row["test"] = True
-
-        # 不具合混入しているかどうか
-        row["buggy"] = False
-        for file_action in file_actions:
-            for induce in file_action.induces:
-                if induce["label"] == "JL+R":
-                    row["buggy"] = True
-                    break
-
-        # 作成者がメンバーかどうか
-        row["is_member"] = pull_request.author_association == "MEMBER"
-
-
-
-        # プルリクエストへのリンク
-        row["url"] = f"{pull_request_system_url}/{pull_request.external_id}"
+        # ========================================
+        # レコードを作成 (コミットが存在しない場合はスキップ)
+        # ========================================
+        row = build_row(features, context, pull_request, data)
+        if row is None:
+            continue
 
         # ========================================
         # レコードを追加
@@ -299,38 +763,318 @@ def process_project(project: Project) -> list[dict]:
     return rows
 
 
+async def process_project_async(
+    runner: "AsyncQueryRunner",
+    project: Project,
+    label_index: LabelIndex | None = None,
+    features: Iterable[str] | None = None,
+) -> list[dict]:
+    features = select_features(features)
+    fields = required_fields(features)
+
+    pull_request_systems = await runner.find(
+        PullRequestSystem, {"project_id": project.id}, ("url",)
+    )
+    context = {
+        "project": project.name,
+        "pull_request_system_url": get_pull_request_system_url(pull_request_systems),
+        "label_index": label_index,
+    }
+
+    # マージされた pull_request を取得
+    pull_requests = await runner.find(
+        PullRequest,
+        {
+            "pull_request_system_id": {
+                "$in": [system.id for system in pull_request_systems]
+            },
+            "merged_at": {"$exists": True},
+        },
+        ("id", *fields.get("pull_request", ())),
+    )
+
+    # プルリクエスト毎のクエリを並行に発行 (同時実行数は runner のセマフォで制限)
+    pull_request_data = await asyncio.gather(
+        *(
+            fetch_pull_request_data_async(runner, pull_request, label_index, fields)
+            for pull_request in pull_requests
+        )
+    )
+
+    rows = []
+    for pull_request, data in zip(pull_requests, pull_request_data):
+        row = build_row(features, context, pull_request, data)
+        if row is not None:
+            rows.append(row)
+
+    return rows
+
+
+def process_project_snapshot(
+    project: Project, snapshot_dir: str, features: Iterable[str] | None = None
+) -> list[dict]:
+    pull_request_systems = scan(snapshot_dir, PullRequestSystem, project.name)
+    owner, repository = pull_request_systems.collect()["url"][0].split("/")[-3:-1]
+    pull_request_system_url = f"https://github.com/{owner}/{repository}/pull"
+
+    # マージされた pull_request を取得
+    pull_requests = (
+        scan(snapshot_dir, PullRequest, project.name)
+        .filter(pl.col("merged_at").is_not_null())
+        .with_row_index()
+    )
+
+    # プルリクエストコミット情報 (コミットが存在しないプルリクエストは除外)
+    pull_request_commits = scan(snapshot_dir, PullRequestCommit, project.name).filter(
+        pl.col("commit_id").is_not_null()
+    )
+    commit_counts = pull_request_commits.group_by("pull_request_id").agg(
+        pl.len().alias("#commits")
+    )
+    pull_request_commit_ids = pull_request_commits.select(
+        "pull_request_id", "commit_id"
+    ).unique()
+
+    # 不具合修正かどうか
+    fixes = (
+        pull_request_commit_ids.join(
+            scan(snapshot_dir, Commit, project.name).select(
+                commit_id="id", fix=pl.col("issueonly_bugfix").fill_null(False)
+            ),
+            on="commit_id",
+        )
+        .group_by("pull_request_id")
+        .agg(pl.col("fix").any())
+    )
+
+    # 不具合混入しているかどうか
+    buggies = (
+        pull_request_commit_ids.join(
+            scan(snapshot_dir, FileAction, project.name).select(
+                "commit_id",
+                buggy=pl.col("induces").list.contains("JL+R").fill_null(False),
+            ),
+            on="commit_id",
+        )
+        .group_by("pull_request_id")
+        .agg(pl.col("buggy").any())
+    )
+
+    # 追加行数・削除行数・変更ファイル数・コード変更かどうか・テストコードが含まれているかどうか
+    file_stats = (
+        scan(snapshot_dir, PullRequestFile, project.name)
+        .group_by("pull_request_id")
+        .agg(
+            pl.col("additions").sum().alias("#added"),
+            pl.col("deletions").sum().alias("#deleted"),
+            pl.len().alias("#files"),
+            pl.col("path").str.contains(SOURCE_FILE_PATTERN).any().alias("code_change"),
+            pl.col("path")
+            .str.to_lowercase()
+            .str.contains("test|spec")
+            .any()
+            .alias("test"),
+        )
+    )
+
+    # コメント数
+    comment_counts = (
+        scan(snapshot_dir, PullRequestComment, project.name)
+        .group_by("pull_request_id")
+        .agg(pl.len().alias("#comments"))
+    )
+
+    # 承認数・変更依頼数
+    pull_request_reviews = scan(snapshot_dir, PullRequestReview, project.name)
+    review_counts = pull_request_reviews.group_by("pull_request_id").agg(
+        (pl.col("state") == "APPROVED").sum().alias("#approvals"),
+        (pl.col("state") == "CHANGES_REQUESTED").sum().alias("#changes_requested"),
+    )
+
+    # レビューコメント数
+    review_comment_counts = (
+        scan(snapshot_dir, PullRequestReviewComment, project.name)
+        .filter(pl.col("has_comment"))
+        .join(
+            pull_request_reviews.select("pull_request_id", pull_request_review_id="id"),
+            on="pull_request_review_id",
+        )
+        .group_by("pull_request_id")
+        .agg(pl.len().alias("#review_comments"))
+    )
+
+    # ソースとターゲットのリポジトリが同じかどうか
+    source = pl.col("source_repo_url").str.split("/")
+    target = pl.col("target_repo_url").str.split("/")
+    intra_branch = (source.list.get(-2, null_on_oob=True) == target.list.get(-2)) & (
+        source.list.get(-1) == target.list.get(-1)
+    )
+
+    rows = (
+        pull_requests.join(
+            commit_counts, left_on="id", right_on="pull_request_id", how="inner"
+        )
+        .join(file_stats, left_on="id", right_on="pull_request_id", how="left")
+        .join(comment_counts, left_on="id", right_on="pull_request_id", how="left")
+        .join(
+            review_comment_counts, left_on="id", right_on="pull_request_id", how="left"
+        )
+        .join(review_counts, left_on="id", right_on="pull_request_id", how="left")
+        .join(fixes, left_on="id", right_on="pull_request_id", how="left")
+        .join(buggies, left_on="id", right_on="pull_request_id", how="left")
+        .sort("index")
+        .select(
+            project=pl.lit(project.name),
+            id=pl.col("id"),
+            age=(pl.col("merged_at") - pl.col("created_at")).dt.total_microseconds(),
+            **{"#commits": pl.col("#commits")},
+            **{
+                column: pl.col(column).fill_null(0)
+                for column in ("#added", "#deleted", "#files", "#comments")
+            },
+            **{"#review_comments": pl.col("#review_comments").fill_null(0)},
+            bot=pl.col("creator_id").is_in(BOT_IDS).fill_null(False),
+            code_change=pl.col("code_change").fill_null(False),
+            intra_branch=intra_branch.fill_null(False),
+            **{
+                column: pl.col(column).fill_null(0)
+                for column in ("#approvals", "#changes_requested")
+            },
+            fix=pl.col("fix").fill_null(False),
+            test=pl.col("test").fill_null(False),
+            buggy=pl.col("buggy").fill_null(False),
+            is_member=(pl.col("author_association") == "MEMBER").fill_null(False),
+            url=pl.format(f"{pull_request_system_url}/{{}}", pl.col("external_id")),
+        )
+        .collect()
+    )
+
+    # マージされるまでの時間 (分)
+    # polars のスカラー除算は逆数の乗算になり丸めが変わるため NumPy で計算
+    rows = rows.with_columns(pl.Series("age", rows["age"].to_numpy() / 1_000_000 / 60))
+
+    return rows.select(select_features(features)).to_dicts()
+
+
 @timeit_decorator(logger=logger)
 def main(args):
-    # データベースに接続
-    client = connect_to_mongodb()
+    # クエリのプロファイルを取る場合は接続前にコマンド監視を登録
+    profiler = install_profiler(args.profile_bytes) if args.profile else None
+    if profiler and args.asyncio:
+        logger.warning("--profile records queries of --asyncio under (main)")
 
-    # データフレームの初期化
-    df = pl.DataFrame()
+    # データベースに接続 (スナップショットを使用する場合は接続しない)
+    if not args.snapshot:
+        connect_to_mongodb()
+
+    # チェックポイントの準備 (--resume でない場合は以前の結果を破棄)
+    checkpoint = CheckpointStore(
+        args.checkpoint_dir or default_checkpoint_dir(args.output)
+    )
+    if not args.resume:
+        checkpoint.clear()
+    # 前回と異なる設定で --resume した場合は中断する
+    checkpoint.check_config(
+        {
+            "prefetch": args.prefetch,
+            "snapshot": args.snapshot,
+            "label_index": args.label_index,
+            "asyncio": args.asyncio,
+            # --features は出力の列を変えるため, 選択した特徴量 (登録順) を記録する
+            "features": select_features(args.features),
+        },
+        args.resume,
+    )
 
     # プロジェクトの取得
-    projects: list[Project] = Project.objects
+    if args.snapshot:
+        projects: list[Project] = load_projects(args.snapshot)
+    else:
+        projects: list[Project] = Project.objects
     if args.small:
         projects = projects[:16]
 
-    # 並行実行のためにデータベース接続を閉じる
-    client.close()
+    # 完了済みのプロジェクトは除外
+    pending_projects = [
+        project for project in projects if not checkpoint.is_done(project.name)
+    ]
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        done_count = 0
-        future_to_project = {
-            executor.submit(worker, project): project for project in projects
-        }
-        for future in concurrent.futures.as_completed(future_to_project):
-            # 進捗表示
-            done_count += 1
-            project = future_to_project[future]
-            logger.info(f"{project.name} Done ({done_count}/{len(projects)})")
-            # データフレームに追加
-            df = pl.concat([df, future.result()], how="diagonal")
+    # 大きいプロジェクトから順に実行 (前回の処理時間, 無い場合は件数から見積もる)
+    timings = checkpoint.load_timings()
+    if args.largest_first:
+        pending_projects = largest_first(pending_projects, timings, args.snapshot)
+
+    # asyncio の場合は 1 スレッドのイベントループで実行
+    if args.asyncio:
+        asyncio.run(
+            run_async(
+                projects,
+                pending_projects,
+                checkpoint,
+                timings,
+                args.concurrency,
+                args.label_index,
+                args.features,
+            )
+        )
+    else:
+        with ProjectPool(args.executor, args.workers) as pool:
+            done_count = len(projects) - len(pending_projects)
+            future_to_project = {
+                pool.submit(
+                    worker,
+                    project,
+                    args.prefetch,
+                    args.snapshot,
+                    args.label_index,
+                    args.features,
+                ): project
+                for project in pending_projects
+            }
+            for future in concurrent.futures.as_completed(future_to_project):
+                # 進捗表示
+                done_count += 1
+                project = future_to_project[future]
+
+                # 失敗したプロジェクトは記録して次回の --resume で再実行
+                try:
+                    result = pool.result(future)
+                except Exception as error:
+                    logger.exception(
+                        f"{project.name} Failed ({done_count}/{len(projects)})"
+                    )
+                    checkpoint.mark_failed(project.name, error)
+                    continue
+                logger.info(f"{project.name} Done ({done_count}/{len(projects)})")
+
+                # チェックポイントに保存
+                checkpoint.save(project.name, result)
+                timings[project.name] = pool.elapsed(future)
+
+    # 次回の見積もりのために処理時間を保存
+    checkpoint.save_timings(timings)
+
+    # データベース接続を閉じる
+    close_mongodb()
+
+    # クエリのプロファイルを出力
+    if profiler:
+        profiler.write(args.profile)
+
+    # 失敗したプロジェクトがある場合は出力しない
+    failed_projects = checkpoint.failed_projects()
+    if failed_projects:
+        logger.error(f"Failed: {', '.join(failed_projects)}. Rerun with --resume.")
+        return
+
+    # チェックポイントを結合 (遅延評価)
+    df = checkpoint.scan([project.name for project in projects])
 
     # CSV 出力
-    with open(args.output, "w") as f:
-        df.write_csv(f)
+    df.sink_csv(args.output)
+
+    # ノートブックから読み込むための型付きの Arrow IPC を作成
+    build_feature_store(args.output)
 
 
 if __name__ == "__main__":
@@ -339,7 +1083,31 @@ if __name__ == "__main__":
         "-o", "--output", type=str, default="data/pull_request_features.csv"
     )
     parser.add_argument("--small", default=False, action="store_true")
+    parser.add_argument("--prefetch", default=False, action="store_true")
+    parser.add_argument("--features", nargs="+", choices=list(FEATURES), default=None)
+    parser.add_argument("--snapshot", type=str, default=None)
+    parser.add_argument("--label-index", type=str, default=None)
+    parser.add_argument("--executor", choices=EXECUTORS, default="thread")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--largest-first", default=False, action="store_true")
+    parser.add_argument("--asyncio", default=False, action="store_true")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--profile", type=str, default=None)
+    parser.add_argument("--profile-bytes", default=False, action="store_true")
+    parser.add_argument("--checkpoint-dir", type=str, default=None)
+    parser.add_argument("--resume", default=False, action="store_true")
 
     args = parser.parse_args()
+    # 子プロセスで発行したクエリは親プロセスのプロファイラに記録されない
+    if args.profile and args.executor == "process":
+        parser.error("--profile cannot be used with --executor process")
+    # --asyncio は全プロジェクトを 1 つのイベントループで同時に開始するため,
+    # プロジェクト単位の実行方法や順序の指定は使えない
+    if args.asyncio:
+        for option in ("snapshot", "prefetch", "executor", "workers", "largest_first"):
+            if getattr(args, option) != parser.get_default(option):
+                parser.error(
+                    f"--asyncio cannot be used with --{option.replace('_', '-')}"
+                )
 
     main(args)
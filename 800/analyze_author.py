@@ -6,7 +6,6 @@ from datetime import datetime
 from logging import basicConfig, getLogger
 
 import polars as pl
-from mongoengine import connect
 from pycoshark.mongomodels import (
     Commit,
     File,
@@ -21,9 +20,14 @@ from pycoshark.mongomodels import (
     PullRequestSystem,
     VCSSystem,
 )
-from pycoshark.utils import create_mongodb_uri_string
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.checkpoint import CheckpointStore, default_checkpoint_dir
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.project_pool import EXECUTORS, ProjectPool
+from utils.query_profiler import install_profiler, profile_project
+from utils.scheduler import largest_first
+from utils.snapshot import load_projects, scan
 from utils.timeit_decorator import timeit_decorator
 
 # 定数
@@ -40,27 +44,17 @@ basicConfig(
 logger = getLogger(__name__)
 
 
-def connect_to_mongodb():
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
-    )
-    return connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
-    )
-
-
-def worker(project: Project) -> pl.DataFrame:
+def worker(project: Project, snapshot_dir: str | None = None) -> pl.DataFrame:
     logger.info(f"{project.name} Start")
 
-    client = connect_to_mongodb()
-    row = process_project(project)
-    client.close()
+    # スナップショットを使用する場合は DB に接続しない
+    if snapshot_dir:
+        return pl.DataFrame(process_project_snapshot(project, snapshot_dir))
+
+    # プロセス内で共有する接続を使用 (閉じずに次のプロジェクトでも再利用する)
+    connect_to_mongodb()
+    with profile_project(project.name):
+        row = process_project(project)
 
     return pl.DataFrame(row)
 
@@ -103,40 +97,124 @@ def process_project(project: Project) -> dict:
     return row
 
 
+def process_project_snapshot(project: Project, snapshot_dir: str) -> dict:
+    # マージされた dependabot によるプルリクエストの作成者を取得
+    bot_ids = (
+        scan(snapshot_dir, PullRequest, project.name)
+        .filter(
+            pl.col("merged_at").is_not_null()
+            & pl.col("title").str.starts_with(DEPENDABOT_PREFIX)
+            & pl.col("description").str.contains(
+                DEPENDABOT_UNIQUE_SUBSTRING, literal=True
+            )
+        )
+        .select(pl.col("creator_id").fill_null("None"))
+        .unique()
+        .collect()
+    )
+
+    return {
+        "project": project.name,
+        "bot_ids": ",".join(bot_ids["creator_id"]),
+    }
+
+
 @timeit_decorator(logger=logger)
 def main(args):
-    # データベースに接続
-    client = connect_to_mongodb()
+    # クエリのプロファイルを取る場合は接続前にコマンド監視を登録
+    profiler = install_profiler(args.profile_bytes) if args.profile else None
 
-    # データフレームの初期化
-    df = pl.DataFrame()
+    # データベースに接続 (スナップショットを使用する場合は接続しない)
+    if not args.snapshot:
+        connect_to_mongodb()
+
+    # チェックポイントの準備 (--resume でない場合は以前の結果を破棄)
+    checkpoint = CheckpointStore(
+        args.checkpoint_dir or default_checkpoint_dir(args.output)
+    )
+    if not args.resume:
+        checkpoint.clear()
+    # 前回と異なる設定で --resume した場合は中断する
+    checkpoint.check_config({"snapshot": args.snapshot}, args.resume)
 
     # プロジェクトの取得
-    projects: list[Project] = Project.objects()
+    if args.snapshot:
+        projects: list[Project] = load_projects(args.snapshot)
+    else:
+        projects: list[Project] = Project.objects()
+
+    # 完了済みのプロジェクトは除外
+    pending_projects = [
+        project for project in projects if not checkpoint.is_done(project.name)
+    ]
 
-    # 並行実行のためにデータベース接続を閉じる
-    client.close()
+    # 大きいプロジェクトから順に実行 (前回の処理時間, 無い場合は件数から見積もる)
+    timings = checkpoint.load_timings()
+    if args.largest_first:
+        pending_projects = largest_first(pending_projects, timings, args.snapshot)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        done_count = 0
+    with ProjectPool(args.executor, args.workers) as pool:
+        done_count = len(projects) - len(pending_projects)
         future_to_project = {
-            executor.submit(worker, project): project for project in projects
+            pool.submit(worker, project, args.snapshot): project
+            for project in pending_projects
         }
         for future in concurrent.futures.as_completed(future_to_project):
             # 進捗表示
             done_count += 1
             project = future_to_project[future]
+
+            # 失敗したプロジェクトは記録して次回の --resume で再実行
+            try:
+                result = pool.result(future)
+            except Exception as error:
+                logger.exception(
+                    f"{project.name} Failed ({done_count}/{len(projects)})"
+                )
+                checkpoint.mark_failed(project.name, error)
+                continue
             logger.info(f"{project.name} Done ({done_count}/{len(projects)})")
-            # データフレームに追加
-            df = pl.concat([df, future.result()], how="diagonal")
+
+            # チェックポイントに保存
+            checkpoint.save(project.name, result)
+            timings[project.name] = pool.elapsed(future)
+
+    # 次回の見積もりのために処理時間を保存
+    checkpoint.save_timings(timings)
+
+    # データベース接続を閉じる
+    close_mongodb()
+
+    # クエリのプロファイルを出力
+    if profiler:
+        profiler.write(args.profile)
+
+    # 失敗したプロジェクトがある場合は出力しない
+    failed_projects = checkpoint.failed_projects()
+    if failed_projects:
+        logger.error(f"Failed: {', '.join(failed_projects)}. Rerun with --resume.")
+        return
+
+    # チェックポイントを結合 (遅延評価)
+    df = checkpoint.scan([project.name for project in projects])
 
     # CSV 出力
-    with open(args.output, "w") as f:
-        df.write_csv(f)
+    df.sink_csv(args.output)
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-o", "--output", type=str, default="data/author_info.csv")
+    parser.add_argument("--snapshot", type=str, default=None)
+    parser.add_argument("--executor", choices=EXECUTORS, default="thread")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--largest-first", default=False, action="store_true")
+    parser.add_argument("--profile", type=str, default=None)
+    parser.add_argument("--profile-bytes", default=False, action="store_true")
+    parser.add_argument("--checkpoint-dir", type=str, default=None)
+    parser.add_argument("--resume", default=False, action="store_true")
     args = parser.parse_args()
+    # 子プロセスで発行したクエリは親プロセスのプロファイラに記録されない
+    if args.profile and args.executor == "process":
+        parser.error("--profile cannot be used with --executor process")
     main(args)
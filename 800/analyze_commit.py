@@ -4,114 +4,358 @@ import os
 import sys
 from collections import defaultdict
 
+import numpy as np
 import polars as pl
-from mongoengine import connect
 from pycoshark.mongomodels import Commit, FileAction, Project, VCSSystem
-from pycoshark.utils import create_mongodb_uri_string
 
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.commit_shards import merge_counts, run_shards, shard_filter, shard_ranges
+from utils.label_index import LabelIndex, load_or_build
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.part_writer import PartWriter, default_parts_dir
+from utils.project_pool import EXECUTORS, ProjectPool
+from utils.snapshot import load_projects, scan
 
-def main(args):
-    # データベースに接続
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
+
+def worker(
+    project: Project,
+    label_index_dir: str | None = None,
+    shards: int = 1,
+    aggregate: bool = False,
+) -> pl.DataFrame:
+    # プロセス内で共有する接続を使用 (閉じずに次のプロジェクトでも再利用する)
+    connect_to_mongodb()
+    if aggregate:
+        row = process_project_aggregate(project)
+    else:
+        row = process_project(project, label_index_dir, shards)
+    print(dict(row), file=sys.stderr)
+    return pl.DataFrame(row)
+
+
+def process_project(
+    project: Project, label_index_dir: str | None = None, shards: int = 1
+) -> dict:
+    row = defaultdict(int)
+
+    vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
+    row["project"] = project.name
+
+    # commit のカウント
+    row["nc"] = Commit.objects(vcs_system_id=vcs_system.id).count()
+
+    # 進捗表示
+    print(f"Processing {row["nc"]} commits in {project.name}...", file=sys.stderr)
+
+    # commit の日付の最小値と最大値を取得
+    row["fcd"] = (
+        Commit.objects(vcs_system_id=vcs_system.id)
+        .only("committer_date")
+        .order_by("+committer_date")
+        .first()
+        .committer_date
     )
-    connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
+    row["lcd"] = (
+        Commit.objects(vcs_system_id=vcs_system.id)
+        .only("committer_date")
+        .order_by("-committer_date")
+        .first()
+        .committer_date
     )
 
-    # DataFrame の初期化
-    df = pl.DataFrame()
+    # ラベル索引がある場合は commit 毎のクエリを省略
+    if label_index_dir:
+        label_index = load_or_build(project, label_index_dir)
+        masks = label_index.lookup(
+            Commit.objects(vcs_system_id=vcs_system.id).scalar("id")
+        )
+        row.update(count_labels(label_index, masks))
+        return row
 
-    # project 毎に処理
-    projects: list[Project] = Project.objects()
-    for i, project in enumerate(projects):
-        row = defaultdict(int)
+    # bug-fixing と bug-inducing のカウント
+    # コミットを _id の範囲で分割し, シャード毎に並行してカウントしてから合計する
+    def count_shard(lower, upper) -> dict:
+        commits: list[Commit] = Commit.objects(
+            vcs_system_id=vcs_system.id, **shard_filter(lower, upper)
+        ).only("id", "labels")
+        return count_commits(commits, row["nc"])
 
-        vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
-        row["project"] = project.name
+    row.update(
+        merge_counts(run_shards(count_shard, shard_ranges(vcs_system.id, shards)))
+    )
+    return row
 
-        # commit のカウント
-        row["nc"] = Commit.objects(vcs_system_id=vcs_system.id).count()
 
-        # 進捗表示
-        print(
-            f"{i} projects done. Processing {row["nc"]} commits in {project.name}...",
-            file=sys.stderr,
+def count_commits(commits: list[Commit], total: int) -> dict:
+    row = defaultdict(int)
+    for j, commit in enumerate(commits):
+        if j % 1000 == 0:
+            # 進捗表示
+            print(
+                f"{j / total * 100:2.1f}% done.",
+                end="\r",
+                file=sys.stderr,
+            )
+
+        # bug-fixing のカウント
+        is_bugfixing_a = commit.labels.get("adjustedszz_bugfix", False)
+        is_bugfixing_io = commit.labels.get("issueonly_bugfix", False)
+        is_bugfixing_v = commit.labels.get("validated_bugfix", False)
+        is_bugfixing_if = commit.labels.get("issueonly_bugfix", False)
+        is_bugfixing = (
+            is_bugfixing_a or is_bugfixing_io or is_bugfixing_v or is_bugfixing_if
         )
+        row["nbfc"] += is_bugfixing
+        row["nbfc_a"] += is_bugfixing_a
+        row["nbfc_io"] += is_bugfixing_io
+        row["nbfc_v"] += is_bugfixing_v
+        row["nbfc_if"] += is_bugfixing_if
 
-        # commit の日付の最小値と最大値を取得
-        row["fcd"] = (
-            Commit.objects(vcs_system_id=vcs_system.id)
-            .only("committer_date")
-            .order_by("+committer_date")
-            .first()
-            .committer_date
+        # bug-inducing のカウント
+        flags = defaultdict(bool)
+        file_actions: list[FileAction] = FileAction.objects(commit_id=commit.id).only(
+            "induces"
         )
-        row["lcd"] = (
-            Commit.objects(vcs_system_id=vcs_system.id)
-            .only("committer_date")
-            .order_by("-committer_date")
-            .first()
-            .committer_date
+        for file_action in file_actions:
+            for induce in file_action.induces:
+                flags[induce["label"]] = True
+        row["nbic"] += any(flags.values())
+        for label, flag in flags.items():
+            row[f"nbic_{label.lower()}"] += flag
+
+    return row
+
+
+def process_project_aggregate(project: Project) -> dict:
+    row = defaultdict(int)
+
+    vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
+    row["project"] = project.name
+
+    # commit のカウント, commit の日付の最小値と最大値, bug-fixing のカウント
+    # process_project と同じ値を 1 回の $group で求める
+    def label(name: str) -> dict:
+        return {"$ifNull": [f"$labels.{name}", False]}
+
+    is_bugfixing_a = label("adjustedszz_bugfix")
+    is_bugfixing_io = label("issueonly_bugfix")
+    is_bugfixing_v = label("validated_bugfix")
+    is_bugfixing_if = label("issueonly_bugfix")
+    pipeline = [
+        {"$match": {"vcs_system_id": vcs_system.id}},
+        {
+            "$group": {
+                "_id": None,
+                "nc": {"$sum": 1},
+                "fcd": {"$min": "$committer_date"},
+                "lcd": {"$max": "$committer_date"},
+                "nbfc": {
+                    "$sum": {
+                        "$cond": [
+                            {
+                                "$or": [
+                                    is_bugfixing_a,
+                                    is_bugfixing_io,
+                                    is_bugfixing_v,
+                                    is_bugfixing_if,
+                                ]
+                            },
+                            1,
+                            0,
+                        ]
+                    }
+                },
+                "nbfc_a": {"$sum": {"$cond": [is_bugfixing_a, 1, 0]}},
+                "nbfc_io": {"$sum": {"$cond": [is_bugfixing_io, 1, 0]}},
+                "nbfc_v": {"$sum": {"$cond": [is_bugfixing_v, 1, 0]}},
+                "nbfc_if": {"$sum": {"$cond": [is_bugfixing_if, 1, 0]}},
+            }
+        },
+    ]
+    result = next(Commit._get_collection().aggregate(pipeline), None)
+    if result is None:
+        row["nc"] = 0
+        return row
+    del result["_id"]
+    row.update(result)
+
+    # 進捗表示
+    print(f"Processed {row["nc"]} commits in {project.name}.", file=sys.stderr)
+
+    # bug-inducing のカウント
+    # file_action を commit に結合し, (commit, ラベル) の組を 1 回の集約で数える
+    pipeline = [
+        {"$match": {"vcs_system_id": vcs_system.id}},
+        {"$project": {"_id": 1}},
+        {
+            "$lookup": {
+                "from": FileAction._get_collection_name(),
+                "localField": "_id",
+                "foreignField": "commit_id",
+                "as": "file_actions",
+            }
+        },
+        {"$project": {"file_actions.induces.label": 1}},
+        {"$unwind": "$file_actions"},
+        {"$unwind": "$file_actions.induces"},
+        {"$group": {"_id": {"commit": "$_id", "label": "$file_actions.induces.label"}}},
+        {
+            "$facet": {
+                "nbic": [{"$group": {"_id": "$_id.commit"}}, {"$count": "count"}],
+                # ラベルの列は process_project と同様に最初に出現した順に並べる
+                "labels": [
+                    {
+                        "$group": {
+                            "_id": "$_id.label",
+                            "count": {"$sum": 1},
+                            "first_commit_id": {"$min": "$_id.commit"},
+                        }
+                    },
+                    {"$sort": {"first_commit_id": 1, "_id": 1}},
+                ],
+            }
+        },
+    ]
+    result = next(Commit._get_collection().aggregate(pipeline, allowDiskUse=True))
+    row["nbic"] = result["nbic"][0]["count"] if result["nbic"] else 0
+    for label_count in result["labels"]:
+        row[f"nbic_{label_count["_id"].lower()}"] = label_count["count"]
+
+    return row
+
+
+def process_project_snapshot(project: Project, snapshot_dir: str) -> dict:
+    row = defaultdict(int)
+
+    vcs_system_id = scan(snapshot_dir, VCSSystem, project.name).collect()["id"][0]
+    row["project"] = project.name
+
+    commits = scan(snapshot_dir, Commit, project.name).filter(
+        pl.col("vcs_system_id") == vcs_system_id
+    )
+
+    # commit のカウント, commit の日付の最小値と最大値, bug-fixing のカウント
+    is_bugfixing_a = pl.col("adjustedszz_bugfix").fill_null(False)
+    is_bugfixing_io = pl.col("issueonly_bugfix").fill_null(False)
+    is_bugfixing_v = pl.col("validated_bugfix").fill_null(False)
+    is_bugfixing_if = pl.col("issueonly_bugfix").fill_null(False)
+    row.update(
+        commits.select(
+            pl.len().alias("nc"),
+            pl.col("committer_date").min().alias("fcd"),
+            pl.col("committer_date").max().alias("lcd"),
+            (is_bugfixing_a | is_bugfixing_io | is_bugfixing_v | is_bugfixing_if)
+            .sum()
+            .alias("nbfc"),
+            is_bugfixing_a.sum().alias("nbfc_a"),
+            is_bugfixing_io.sum().alias("nbfc_io"),
+            is_bugfixing_v.sum().alias("nbfc_v"),
+            is_bugfixing_if.sum().alias("nbfc_if"),
         )
+        .collect()
+        .row(0, named=True)
+    )
 
-        # bug-fixing と bug-inducing のカウント
-        commits: list[Commit] = Commit.objects(vcs_system_id=vcs_system.id).only(
-            "id", "labels"
+    # bug-inducing のカウント
+    flags = (
+        commits.select(commit_id="id")
+        .join(
+            scan(snapshot_dir, FileAction, project.name)
+            .select("commit_id", label="induces")
+            .explode("label")
+            .drop_nulls(),
+            on="commit_id",
         )
-        for j, commit in enumerate(commits):
-            if j % 1000 == 0:
-                # 進捗表示
-                print(
-                    f"{j / row["nc"] * 100:2.1f}% done.",
-                    end="\r",
-                    file=sys.stderr,
-                )
-
-            # bug-fixing のカウント
-            is_bugfixing_a = commit.labels.get("adjustedszz_bugfix", False)
-            is_bugfixing_io = commit.labels.get("issueonly_bugfix", False)
-            is_bugfixing_v = commit.labels.get("validated_bugfix", False)
-            is_bugfixing_if = commit.labels.get("issueonly_bugfix", False)
-            is_bugfixing = (
-                is_bugfixing_a or is_bugfixing_io or is_bugfixing_v or is_bugfixing_if
-            )
-            row["nbfc"] += is_bugfixing
-            row["nbfc_a"] += is_bugfixing_a
-            row["nbfc_io"] += is_bugfixing_io
-            row["nbfc_v"] += is_bugfixing_v
-            row["nbfc_if"] += is_bugfixing_if
-
-            # bug-inducing のカウント
-            flags = defaultdict(bool)
-            file_actions: list[FileAction] = FileAction.objects(
-                commit_id=commit.id
-            ).only("induces")
-            for file_action in file_actions:
-                for induce in file_action.induces:
-                    flags[induce["label"]] = True
-            row["nbic"] += any(flags.values())
-            for label, flag in flags.items():
-                row[f"nbic_{label.lower()}"] += flag
-
-        print(dict(row), file=sys.stderr)
-
-        df = pl.concat([df, pl.DataFrame(row)], how="diagonal")
+        .unique(maintain_order=True)
+        .collect()
+    )
+    row["nbic"] = flags["commit_id"].n_unique()
+    for label, count in flags.group_by("label", maintain_order=True).len().iter_rows():
+        row[f"nbic_{label.lower()}"] = count
+
+    return row
+
+
+def count_labels(label_index: LabelIndex, masks: np.ndarray) -> dict:
+    row = {}
+
+    # bug-fixing のカウント
+    is_bugfixing_a = label_index.has(masks, "adjustedszz_bugfix")
+    is_bugfixing_io = label_index.has(masks, "issueonly_bugfix")
+    is_bugfixing_v = label_index.has(masks, "validated_bugfix")
+    is_bugfixing_if = label_index.has(masks, "issueonly_bugfix")
+    row["nbfc"] = int(
+        (is_bugfixing_a | is_bugfixing_io | is_bugfixing_v | is_bugfixing_if).sum()
+    )
+    row["nbfc_a"] = int(is_bugfixing_a.sum())
+    row["nbfc_io"] = int(is_bugfixing_io.sum())
+    row["nbfc_v"] = int(is_bugfixing_v.sum())
+    row["nbfc_if"] = int(is_bugfixing_if.sum())
+
+    # bug-inducing のカウント
+    # 索引はプロジェクトの全 vcs_system から作成するため, 数える commit に出現しないラベルは
+    # 出力しない (commit 毎に数える場合と同じく, 最初に出現した commit の順に列を並べる)
+    row["nbic"] = int(label_index.has(masks, *label_index.inducing_labels).sum())
+    counts = {}
+    for label in label_index.inducing_labels:
+        has_label = label_index.has(masks, label)
+        if has_label.any():
+            counts[label] = (int(np.argmax(has_label)), int(has_label.sum()))
+    for label, (_, count) in sorted(counts.items(), key=lambda item: item[1][0]):
+        row[f"nbic_{label.lower()}"] = count
+
+    return row
+
+
+def main(args):
+    # 結果はプロジェクト毎にパートファイルへ書き出す
+    writer = PartWriter(default_parts_dir(args.output))
+
+    # スナップショットを使用する場合は DB に接続しない
+    if args.snapshot:
+        for i, project in enumerate(load_projects(args.snapshot)):
+            print(f"{i} projects done. Processing {project.name}...", file=sys.stderr)
+            row = process_project_snapshot(project, args.snapshot)
+            writer.write(pl.DataFrame(row))
+        writer.scan().sink_csv(args.output)
+        writer.remove()
+        return
+
+    # データベースに接続
+    connect_to_mongodb()
+
+    # project 毎に並行処理 (パートファイルは project の順に書き出す)
+    projects: list[Project] = Project.objects()
+    with ProjectPool(args.executor, args.workers) as pool:
+        futures = [
+            pool.submit(worker, project, args.label_index, args.shards, args.aggregate)
+            for project in projects
+        ]
+        for i, (project, future) in enumerate(zip(projects, futures)):
+            writer.write(pool.result(future))
+            print(f"{i + 1} projects done. ({project.name})", file=sys.stderr)
 
     print("Done.", file=sys.stderr)
 
-    with open(args.output, "w") as f:
-        df.write_csv(f)
+    # データベース接続を閉じる
+    close_mongodb()
+
+    writer.scan().sink_csv(args.output)
+    writer.remove()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-o", "--output", type=str, default="data/commit_info.csv")
+    parser.add_argument("--snapshot", type=str, default=None)
+    parser.add_argument("--label-index", type=str, default=None)
+    parser.add_argument("--shards", type=int, default=1)
+    parser.add_argument("--aggregate", default=False, action="store_true")
+    parser.add_argument("--executor", choices=EXECUTORS, default="thread")
+    parser.add_argument("--workers", type=int, default=1)
     args = parser.parse_args()
+    if args.aggregate and (args.snapshot or args.label_index or args.shards > 1):
+        parser.error(
+            "--aggregate cannot be used with --snapshot, --label-index or --shards"
+        )
     main(args)
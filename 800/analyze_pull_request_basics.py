@@ -7,7 +7,6 @@ from datetime import datetime, timedelta
 from logging import basicConfig, getLogger
 
 import polars as pl
-from mongoengine import connect
 from pycoshark.mongomodels import (
     Commit,
     FileAction,
@@ -21,9 +20,14 @@ from pycoshark.mongomodels import (
     Refactoring,
     VCSSystem,
 )
-from pycoshark.utils import create_mongodb_uri_string
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.checkpoint import CheckpointStore, default_checkpoint_dir
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.project_pool import EXECUTORS, ProjectPool
+from utils.query_profiler import install_profiler, profile_project
+from utils.scheduler import largest_first
+from utils.snapshot import load_projects, scan
 from utils.timeit_decorator import timeit_decorator
 
 # ロギングの設定
@@ -34,28 +38,23 @@ basicConfig(
 logger = getLogger(__name__)
 
 
-def connect_to_mongodb():
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
-    )
-    return connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
-    )
-
-
-def worker(project: Project) -> pl.DataFrame:
+def worker(
+    project: Project, snapshot_dir: str | None = None, aggregate: bool = False
+) -> pl.DataFrame:
     # 進捗表示
     logger.info(f"{project.name} start.")
 
-    client = connect_to_mongodb()
-    row = process_project(project)
-    client.close()
+    # スナップショットを使用する場合は DB に接続しない
+    if snapshot_dir:
+        return pl.DataFrame(process_project_snapshot(project, snapshot_dir))
+
+    # プロセス内で共有する接続を使用 (閉じずに次のプロジェクトでも再利用する)
+    connect_to_mongodb()
+    with profile_project(project.name):
+        if aggregate:
+            row = process_project_aggregate(project)
+        else:
+            row = process_project(project)
     return pl.DataFrame(row)
 
 
@@ -153,35 +152,365 @@ def process_project(project: Project) -> dict:
     return row
 
 
+# process_project_aggregate の $bucket の境界 (commit 数, -1 は commit_ids の欠損)
+COMMIT_COUNT_BOUNDARIES = [-1, 0, 1, 2, 6, 11, 21, 31]
+
+
+def process_project_aggregate(project: Project) -> dict:
+    row = defaultdict(int)
+
+    # vcs_sustem を取得
+    vcs_system: VCSSystem = VCSSystem.objects(project_id=project.id).first()
+
+    # プルリクエストシステムの id のリストを取得
+    pull_request_system_ids = list(
+        PullRequestSystem.objects(project_id=project.id).scalar("id")
+    )
+
+    # プロジェクト名
+    row["project"] = project.name
+
+    # 最後のコミットの日付を取得
+    last_commit_date = (
+        Commit.objects(vcs_system_id=vcs_system.id)
+        .only("committer_date")
+        .order_by("-committer_date")
+        .first()
+    ).committer_date
+
+    # process_project のプルリクエストに対するクエリを 1 回の $facet にまとめる
+    pipeline = [
+        {"$match": {"pull_request_system_id": {"$in": pull_request_system_ids}}},
+        {
+            "$facet": {
+                # プルリクエストのカウントと日付の最小値と最大値
+                "pull_requests": [
+                    {
+                        "$group": {
+                            "_id": None,
+                            "count": {"$sum": 1},
+                            "first": {"$min": "$created_at"},
+                            "last": {"$max": "$created_at"},
+                        }
+                    }
+                ],
+                # コミットと紐づけることができるプルリクエストのカウント
+                "with_commit": [
+                    {
+                        "$match": {
+                            "created_at": {"$lte": last_commit_date + timedelta(days=7)}
+                        }
+                    },
+                    {"$count": "count"},
+                ],
+                # マージされたプルリクエスト毎に commit_id の有無とコミット数を集計
+                "merged": [
+                    {"$match": {"merged_at": {"$exists": True}}},
+                    {"$project": {"_id": 1}},
+                    {
+                        "$lookup": {
+                            "from": PullRequestCommit._get_collection_name(),
+                            "localField": "_id",
+                            "foreignField": "pull_request_id",
+                            "as": "pull_request_commits",
+                        }
+                    },
+                    {"$project": {"pull_request_commits.commit_id": 1}},
+                    {
+                        "$lookup": {
+                            "from": Commit._get_collection_name(),
+                            "localField": "pull_request_commits.commit_id",
+                            "foreignField": "_id",
+                            "as": "commits",
+                        }
+                    },
+                    {
+                        "$project": {
+                            "present": {
+                                "$size": {
+                                    "$filter": {
+                                        "input": "$pull_request_commits",
+                                        "cond": {
+                                            "$ne": [
+                                                {"$ifNull": ["$$this.commit_id", None]},
+                                                None,
+                                            ]
+                                        },
+                                    }
+                                }
+                            },
+                            "total": {"$size": "$pull_request_commits"},
+                            "nc": {"$size": "$commits._id"},
+                        }
+                    },
+                    # commit_ids が欠損している場合はコミット数を -1 とする
+                    {
+                        "$project": {
+                            "present": 1,
+                            "missing": {"$subtract": ["$total", "$present"]},
+                            "nc": {
+                                "$cond": [
+                                    {"$lt": ["$present", "$total"]},
+                                    -1,
+                                    "$nc",
+                                ]
+                            },
+                        }
+                    },
+                    {
+                        "$bucket": {
+                            "groupBy": "$nc",
+                            "boundaries": COMMIT_COUNT_BOUNDARIES,
+                            "default": "30<nc",
+                            "output": {
+                                "count": {"$sum": 1},
+                                "all": {
+                                    "$sum": {"$cond": [{"$eq": ["$missing", 0]}, 1, 0]}
+                                },
+                                "partial": {
+                                    "$sum": {
+                                        "$cond": [
+                                            {
+                                                "$and": [
+                                                    {"$gt": ["$present", 0]},
+                                                    {"$gt": ["$missing", 0]},
+                                                ]
+                                            },
+                                            1,
+                                            0,
+                                        ]
+                                    }
+                                },
+                                "none": {
+                                    "$sum": {"$cond": [{"$eq": ["$present", 0]}, 1, 0]}
+                                },
+                            },
+                        }
+                    },
+                ],
+            }
+        },
+    ]
+    result = next(PullRequest._get_collection().aggregate(pipeline, allowDiskUse=True))
+
+    # プルリクエストのカウントと日付の最小値と最大値
+    pull_requests = result["pull_requests"][0] if result["pull_requests"] else {}
+    row["#pull_request"] = pull_requests.get("count", 0)
+    row["first_pull_request_date"] = pull_requests.get("first")
+    row["last_pull_request_date"] = pull_requests.get("last")
+
+    # コミットと紐づけることができるプルリクエストのカウント
+    row["last_commit_date"] = last_commit_date
+    row["#pull_request_with_commit"] = (
+        result["with_commit"][0]["count"] if result["with_commit"] else 0
+    )
+
+    # マージされたプルリクエストのカウント
+    buckets = {bucket["_id"]: bucket for bucket in result["merged"]}
+    row["#merged_pull_request"] = sum(bucket["count"] for bucket in buckets.values())
+    if not buckets:
+        return row
+
+    # commit_ids の欠損度合いをカウント
+    row["#mpr_all"] = sum(bucket["all"] for bucket in buckets.values())
+    row["#mpr_partial"] = sum(bucket["partial"] for bucket in buckets.values())
+    row["#mpr_none"] = sum(bucket["none"] for bucket in buckets.values())
+
+    # commit 数の度数分布を取得 (commit_ids が欠損している場合は除外)
+    if set(buckets) == {-1}:
+        return row
+    count = {key: bucket["count"] for key, bucket in buckets.items()}
+    row["#mpr_nc==0"] = count.get(0, 0)
+    row["#mpr_nc==1"] = count.get(1, 0)
+    row["#mpr_1<nc<=5"] = count.get(1, 0) + count.get(2, 0)
+    row["#mpr_5<nc<=10"] = count.get(6, 0)
+    row["#mpr_10<nc<=20"] = count.get(11, 0)
+    row["#mpr_20<nc<=30"] = count.get(21, 0)
+    row["#mpr_30<nc"] = count.get("30<nc", 0)
+
+    return row
+
+
+def process_project_snapshot(project: Project, snapshot_dir: str) -> dict:
+    row = defaultdict(int)
+
+    # vcs_sustem を取得
+    vcs_system_id = scan(snapshot_dir, VCSSystem, project.name).collect()["id"][0]
+
+    # プルリクエストを取得
+    pull_requests = scan(snapshot_dir, PullRequest, project.name)
+
+    # プロジェクト名
+    row["project"] = project.name
+
+    # プルリクエストのカウントと日付の最小値と最大値
+    row.update(
+        pull_requests.select(
+            pl.len().alias("#pull_request"),
+            pl.col("created_at").min().alias("first_pull_request_date"),
+            pl.col("created_at").max().alias("last_pull_request_date"),
+        )
+        .collect()
+        .row(0, named=True)
+    )
+
+    # コミットと紐づけることができるプルリクエストのカウント
+    row["last_commit_date"] = (
+        scan(snapshot_dir, Commit, project.name)
+        .filter(pl.col("vcs_system_id") == vcs_system_id)
+        .select(pl.col("committer_date").max())
+        .collect()
+        .item()
+    )
+    row["#pull_request_with_commit"] = (
+        pull_requests.filter(
+            pl.col("created_at") <= row["last_commit_date"] + timedelta(days=7)
+        )
+        .select(pl.len())
+        .collect()
+        .item()
+    )
+
+    # マージされたプルリクエストのカウント
+    merged_pull_requests = pull_requests.filter(
+        pl.col("merged_at").is_not_null()
+    ).select(pull_request_id="id")
+    row["#merged_pull_request"] = merged_pull_requests.select(pl.len()).collect().item()
+
+    # マージされたプルリクエスト毎に commit_id の有無とコミット数を集計
+    pull_request_commits = scan(snapshot_dir, PullRequestCommit, project.name)
+    commit_id_counts = pull_request_commits.group_by("pull_request_id").agg(
+        pl.col("commit_id").count().alias("present"),
+        pl.col("commit_id").null_count().alias("missing"),
+    )
+    commit_counts = (
+        pull_request_commits.select("pull_request_id", "commit_id")
+        .drop_nulls()
+        .unique()
+        .join(
+            scan(snapshot_dir, Commit, project.name).select(commit_id="id"),
+            on="commit_id",
+            how="semi",
+        )
+        .group_by("pull_request_id")
+        .agg(pl.len().alias("nc"))
+    )
+    present = pl.col("present") > 0
+    missing = pl.col("missing") > 0
+    nc = pl.col("nc")
+    row.update(
+        merged_pull_requests.join(commit_id_counts, on="pull_request_id", how="left")
+        .join(commit_counts, on="pull_request_id", how="left")
+        .fill_null(0)
+        .select(
+            # commit_ids の欠損度合いをカウント
+            (~missing).sum().alias("#mpr_all"),
+            (present & missing).sum().alias("#mpr_partial"),
+            (~present).sum().alias("#mpr_none"),
+            # commit 数の度数分布を取得 (commit_ids が欠損している場合は除外)
+            (~missing & (nc == 0)).sum().alias("#mpr_nc==0"),
+            (~missing & (nc == 1)).sum().alias("#mpr_nc==1"),
+            (~missing & nc.is_between(1, 5)).sum().alias("#mpr_1<nc<=5"),
+            (~missing & nc.is_between(5, 10, closed="right"))
+            .sum()
+            .alias("#mpr_5<nc<=10"),
+            (~missing & nc.is_between(10, 20, closed="right"))
+            .sum()
+            .alias("#mpr_10<nc<=20"),
+            (~missing & nc.is_between(20, 30, closed="right"))
+            .sum()
+            .alias("#mpr_20<nc<=30"),
+            (~missing & (nc > 30)).sum().alias("#mpr_30<nc"),
+        )
+        .collect()
+        .row(0, named=True)
+    )
+
+    return row
+
+
 @timeit_decorator(logger=logger)
 def main(args):
-    # データベースに接続
-    client = connect_to_mongodb()
+    # クエリのプロファイルを取る場合は接続前にコマンド監視を登録
+    profiler = install_profiler(args.profile_bytes) if args.profile else None
 
-    # データフレームの初期化
-    df = pl.DataFrame()
+    # データベースに接続 (スナップショットを使用する場合は接続しない)
+    if not args.snapshot:
+        connect_to_mongodb()
+
+    # チェックポイントの準備 (--resume でない場合は以前の結果を破棄)
+    checkpoint = CheckpointStore(
+        args.checkpoint_dir or default_checkpoint_dir(args.output)
+    )
+    if not args.resume:
+        checkpoint.clear()
+    # 前回と異なる設定で --resume した場合は中断する
+    checkpoint.check_config(
+        {"snapshot": args.snapshot, "aggregate": args.aggregate}, args.resume
+    )
 
     # project のリストを取得
-    projects: list[Project] = Project.objects()
+    if args.snapshot:
+        projects: list[Project] = load_projects(args.snapshot)
+    else:
+        projects: list[Project] = Project.objects()
     project_count = len(projects)
 
-    # データベースをクローズ
-    client.close()
+    # 完了済みのプロジェクトは除外
+    pending_projects = [
+        project for project in projects if not checkpoint.is_done(project.name)
+    ]
+
+    # 大きいプロジェクトから順に実行 (前回の処理時間, 無い場合は件数から見積もる)
+    timings = checkpoint.load_timings()
+    if args.largest_first:
+        pending_projects = largest_first(pending_projects, timings, args.snapshot)
 
     # プロジェクト毎に並行処理
-    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        done_count = 0
+    with ProjectPool(args.executor, args.workers) as pool:
+        done_count = len(projects) - len(pending_projects)
         future_to_project = {
-            executor.submit(worker, project): project for project in projects
+            pool.submit(worker, project, args.snapshot, args.aggregate): project
+            for project in pending_projects
         }
         for future in concurrent.futures.as_completed(future_to_project):
             # 進捗表示
             done_count += 1
             project = future_to_project[future]
+
+            # 失敗したプロジェクトは記録して次回の --resume で再実行
+            try:
+                result = pool.result(future)
+            except Exception as error:
+                logger.exception(
+                    f"{project.name} Failed ({done_count}/{project_count})"
+                )
+                checkpoint.mark_failed(project.name, error)
+                continue
             logger.info(f"{project.name} Done ({done_count}/{project_count})")
 
-            # DataFrame に追加
-            df = pl.concat([df, future.result()], how="diagonal")
+            # チェックポイントに保存
+            checkpoint.save(project.name, result)
+            timings[project.name] = pool.elapsed(future)
+
+    # 次回の見積もりのために処理時間を保存
+    checkpoint.save_timings(timings)
+
+    # データベース接続を閉じる
+    close_mongodb()
+
+    # クエリのプロファイルを出力
+    if profiler:
+        profiler.write(args.profile)
+
+    # 失敗したプロジェクトがある場合は出力しない
+    failed_projects = checkpoint.failed_projects()
+    if failed_projects:
+        logger.error(f"Failed: {', '.join(failed_projects)}. Rerun with --resume.")
+        return
+
+    # チェックポイントを結合 (遅延評価)
+    df = checkpoint.scan([project.name for project in projects])
 
     # DataFrame の null を 0 で埋める
     df = df.fill_null(0)
@@ -190,8 +519,7 @@ def main(args):
     logger.info("Done.")
 
     # CSV に出力
-    with open(args.output, "w") as f:
-        df.write_csv(f)
+    df.sink_csv(args.output)
 
 
 if __name__ == "__main__":
@@ -199,6 +527,20 @@ if __name__ == "__main__":
     parser.add_argument(
         "-o", "--output", type=str, default="data/pull_request_basics.csv"
     )
+    parser.add_argument("--snapshot", type=str, default=None)
+    parser.add_argument("--aggregate", default=False, action="store_true")
+    parser.add_argument("--executor", choices=EXECUTORS, default="thread")
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--largest-first", default=False, action="store_true")
+    parser.add_argument("--profile", type=str, default=None)
+    parser.add_argument("--profile-bytes", default=False, action="store_true")
+    parser.add_argument("--checkpoint-dir", type=str, default=None)
+    parser.add_argument("--resume", default=False, action="store_true")
     args = parser.parse_args()
+    # 子プロセスで発行したクエリは親プロセスのプロファイラに記録されない
+    if args.profile and args.executor == "process":
+        parser.error("--profile cannot be used with --executor process")
+    if args.aggregate and args.snapshot:
+        parser.error("--aggregate cannot be used with --snapshot")
 
     main(args)
@@ -7,7 +7,6 @@ from datetime import datetime, timedelta
 from logging import basicConfig, getLogger
 
 import polars as pl
-from mongoengine import connect
 from pycoshark.mongomodels import (
     Commit,
     FileAction,
@@ -22,10 +21,16 @@ from pycoshark.mongomodels import (
     Refactoring,
     VCSSystem,
 )
-from pycoshark.utils import create_mongodb_uri_string
 
 sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
 
+from utils.checkpoint import CheckpointStore, default_checkpoint_dir
+from utils.label_index import LabelIndex, load_or_build
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.project_pool import EXECUTORS, ProjectPool
+from utils.query_profiler import install_profiler, profile_project
+from utils.scheduler import largest_first
+from utils.snapshot import load_projects, scan
 from utils.timeit_decorator import timeit_decorator
 
 # ロギングの設定
@@ -36,32 +41,29 @@ basicConfig(
 logger = getLogger(__name__)
 
 
-def connect_to_mongodb():
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
-    )
-    return connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
-    )
-
-
-def worker(project: Project) -> pl.DataFrame:
+def worker(
+    project: Project,
+    snapshot_dir: str | None = None,
+    label_index_dir: str | None = None,
+) -> pl.DataFrame:
     # 進捗表示
     logger.info(f"{project.name} start.")
 
-    client = connect_to_mongodb()
-    row = process_project(project)
-    client.close()
+    # スナップショットを使用する場合は DB に接続しない
+    if snapshot_dir:
+        return pl.DataFrame(process_project_snapshot(project, snapshot_dir))
+
+    # プロセス内で共有する接続を使用 (閉じずに次のプロジェクトでも再利用する)
+    connect_to_mongodb()
+    with profile_project(project.name):
+        if label_index_dir:
+            row = process_project(project, load_or_build(project, label_index_dir))
+        else:
+            row = process_project(project)
     return pl.DataFrame(row)
 
 
-def process_project(project: Project) -> dict:
+def process_project(project: Project, label_index: LabelIndex | None = None) -> dict:
     row = defaultdict(int)
 
     # vcs_sustem を取得
@@ -110,26 +112,39 @@ def process_project(project: Project) -> dict:
         if None in commit_ids:
             continue
 
-        # commit のリストを取得
-        commits: list[Commit] = Commit.objects(id__in=commit_ids).only("id", "labels")
-
         # bug-fixing と bug-inducing のカウント
         fixing_flags = defaultdict(bool)
         inducing_flags = defaultdict(bool)
-        for commit in commits:
-            # bug-fixing か判定
-            fixing_flags["a"] |= commit.labels.get("adjustedszz_bugfix", False)
-            fixing_flags["io"] |= commit.labels.get("issueonly_bugfix", False)
-            fixing_flags["v"] |= commit.labels.get("validated_bugfix", False)
-            fixing_flags["if"] |= commit.labels.get("issueonly_bugfix", False)
-
-            # bug-inducing か判定
-            file_actions: list[FileAction] = FileAction.objects(
-                commit_id=commit.id
-            ).only("induces")
-            for file_action in file_actions:
-                for induce in file_action.induces:
-                    inducing_flags[induce["label"]] = True
+
+        # ラベル索引がある場合は commit と file_action を取得しない
+        if label_index:
+            masks = label_index.lookup(commit_ids)
+            fixing_flags["a"] = bool(label_index.has(masks, "adjustedszz_bugfix").any())
+            fixing_flags["io"] = bool(label_index.has(masks, "issueonly_bugfix").any())
+            fixing_flags["v"] = bool(label_index.has(masks, "validated_bugfix").any())
+            fixing_flags["if"] = bool(label_index.has(masks, "issueonly_bugfix").any())
+            for label in label_index.inducing_labels:
+                if label_index.has(masks, label).any():
+                    inducing_flags[label] = True
+        else:
+            # commit のリストを取得
+            commits: list[Commit] = Commit.objects(id__in=commit_ids).only(
+                "id", "labels"
+            )
+            for commit in commits:
+                # bug-fixing か判定
+                fixing_flags["a"] |= commit.labels.get("adjustedszz_bugfix", False)
+                fixing_flags["io"] |= commit.labels.get("issueonly_bugfix", False)
+                fixing_flags["v"] |= commit.labels.get("validated_bugfix", False)
+                fixing_flags["if"] |= commit.labels.get("issueonly_bugfix", False)
+
+                # bug-inducing か判定
+                file_actions: list[FileAction] = FileAction.objects(
+                    commit_id=commit.id
+                ).only("induces")
+                for file_action in file_actions:
+                    for induce in file_action.induces:
+                        inducing_flags[induce["label"]] = True
 
         # bug-fixing のカウント
         row["nmbfpr"] += any(fixing_flags.values())
@@ -144,35 +159,175 @@ def process_project(project: Project) -> dict:
     return row
 
 
+def process_project_snapshot(project: Project, snapshot_dir: str) -> dict:
+    row = defaultdict(int)
+
+    # プルリクエストを取得
+    pull_requests = scan(snapshot_dir, PullRequest, project.name)
+
+    # プロジェクト名
+    row["project"] = project.name
+
+    # pull_request, マージされた pull_request, リジェクトされた pull_request のカウント
+    merged = pl.col("merged_at").is_not_null()
+    row.update(
+        pull_requests.select(
+            pl.len().alias("npr"),
+            merged.sum().alias("nmpr"),
+            (~merged & (pl.col("state") == "closed")).sum().alias("nrpr"),
+        )
+        .collect()
+        .row(0, named=True)
+    )
+
+    # commit_id が欠損していないマージされた pull_request に紐づいた commit を取得
+    pull_request_commits = scan(snapshot_dir, PullRequestCommit, project.name)
+    incomplete_pull_requests = pull_request_commits.filter(
+        pl.col("commit_id").is_null()
+    ).select("pull_request_id")
+    commits = (
+        pull_requests.filter(merged)
+        .select(pull_request_id="id")
+        .join(incomplete_pull_requests, on="pull_request_id", how="anti")
+        .join(
+            pull_request_commits.select("pull_request_id", "commit_id").unique(),
+            on="pull_request_id",
+        )
+        .join(
+            scan(snapshot_dir, Commit, project.name).select(
+                commit_id="id",
+                a=pl.col("adjustedszz_bugfix").fill_null(False),
+                io=pl.col("issueonly_bugfix").fill_null(False),
+                v=pl.col("validated_bugfix").fill_null(False),
+            ),
+            on="commit_id",
+        )
+    )
+
+    # bug-fixing のカウント
+    fixing_flags = commits.group_by("pull_request_id").agg(
+        pl.col("a").any(),
+        pl.col("io").any(),
+        pl.col("v").any(),
+        pl.col("io").any().alias("if"),
+    )
+    row.update(
+        fixing_flags.select(
+            pl.any_horizontal("a", "io", "v", "if").sum().alias("nmbfpr"),
+            *[
+                pl.col(label).sum().alias(f"nmbfpr_{label}")
+                for label in ("a", "io", "v", "if")
+            ],
+        )
+        .collect()
+        .row(0, named=True)
+    )
+
+    # bug-inducing のカウント
+    inducing_flags = (
+        commits.select("pull_request_id", "commit_id")
+        .join(
+            scan(snapshot_dir, FileAction, project.name)
+            .select("commit_id", label="induces")
+            .explode("label")
+            .drop_nulls(),
+            on="commit_id",
+        )
+        .select("pull_request_id", "label")
+        .unique(maintain_order=True)
+        .collect()
+    )
+    row["nmbipr"] = inducing_flags["pull_request_id"].n_unique()
+    for label, count in (
+        inducing_flags.group_by("label", maintain_order=True).len().iter_rows()
+    ):
+        row[f"nmbipr_{label.lower()}"] = count
+
+    return row
+
+
 @timeit_decorator(logger=logger)
 def main(args):
-    # データベースに接続
-    client = connect_to_mongodb()
+    # クエリのプロファイルを取る場合は接続前にコマンド監視を登録
+    profiler = install_profiler(args.profile_bytes) if args.profile else None
 
-    # DataFrame の初期化
-    df = pl.DataFrame()
+    # データベースに接続 (スナップショットを使用する場合は接続しない)
+    if not args.snapshot:
+        connect_to_mongodb()
+
+    # チェックポイントの準備 (--resume でない場合は以前の結果を破棄)
+    checkpoint = CheckpointStore(
+        args.checkpoint_dir or default_checkpoint_dir(args.output)
+    )
+    if not args.resume:
+        checkpoint.clear()
+    # 前回と異なる設定で --resume した場合は中断する
+    checkpoint.check_config(
+        {"snapshot": args.snapshot, "label_index": args.label_index}, args.resume
+    )
 
     # project のリストを取得
-    projects: list[Project] = Project.objects()
+    if args.snapshot:
+        projects: list[Project] = load_projects(args.snapshot)
+    else:
+        projects: list[Project] = Project.objects()
     project_count = len(projects)
 
-    # データベースをクローズ
-    client.close()
+    # 完了済みのプロジェクトは除外
+    pending_projects = [
+        project for project in projects if not checkpoint.is_done(project.name)
+    ]
+
+    # 大きいプロジェクトから順に実行 (前回の処理時間, 無い場合は件数から見積もる)
+    timings = checkpoint.load_timings()
+    if args.largest_first:
+        pending_projects = largest_first(pending_projects, timings, args.snapshot)
 
     # project を並行処理
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        done_count = 0
+    with ProjectPool(args.executor, args.workers) as pool:
+        done_count = len(projects) - len(pending_projects)
         future_to_project = {
-            executor.submit(worker, project): project for project in projects
+            pool.submit(worker, project, args.snapshot, args.label_index): project
+            for project in pending_projects
         }
         for future in concurrent.futures.as_completed(future_to_project):
             # 進捗表示
             done_count += 1
             project = future_to_project[future]
+
+            # 失敗したプロジェクトは記録して次回の --resume で再実行
+            try:
+                result = pool.result(future)
+            except Exception as error:
+                logger.exception(
+                    f"{project.name} Failed ({done_count}/{project_count})"
+                )
+                checkpoint.mark_failed(project.name, error)
+                continue
             logger.info(f"{project.name} Done ({done_count}/{project_count})")
 
-            # DataFrame に追加
-            df = pl.concat([df, future.result()], how="diagonal")
+            # チェックポイントに保存
+            checkpoint.save(project.name, result)
+            timings[project.name] = pool.elapsed(future)
+
+    # 次回の見積もりのために処理時間を保存
+    checkpoint.save_timings(timings)
+
+    # データベース接続を閉じる
+    close_mongodb()
+
+    # クエリのプロファイルを出力
+    if profiler:
+        profiler.write(args.profile)
+
+    # 失敗したプロジェクトがある場合は出力しない
+    failed_projects = checkpoint.failed_projects()
+    if failed_projects:
+        logger.error(f"Failed: {', '.join(failed_projects)}. Rerun with --resume.")
+        return
+
+    # チェックポイントを結合 (遅延評価)
+    df = checkpoint.scan([project.name for project in projects])
 
     # DataFrame の null を 0 で埋める
     df = df.fill_null(0)
@@ -181,8 +336,7 @@ def main(args):
     logger.info("Done.")
 
     # CSV に出力
-    with open(args.output, "w") as f:
-        df.write_csv(f)
+    df.sink_csv(args.output)
 
 
 if __name__ == "__main__":
@@ -190,6 +344,18 @@ if __name__ == "__main__":
     parser.add_argument(
         "-o", "--output", type=str, default="data/pull_request_defects.csv"
     )
+    parser.add_argument("--snapshot", type=str, default=None)
+    parser.add_argument("--label-index", type=str, default=None)
+    parser.add_argument("--executor", choices=EXECUTORS, default="thread")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--largest-first", default=False, action="store_true")
+    parser.add_argument("--profile", type=str, default=None)
+    parser.add_argument("--profile-bytes", default=False, action="store_true")
+    parser.add_argument("--checkpoint-dir", type=str, default=None)
+    parser.add_argument("--resume", default=False, action="store_true")
     args = parser.parse_args()
+    # 子プロセスで発行したクエリは親プロセスのプロファイラに記録されない
+    if args.profile and args.executor == "process":
+        parser.error("--profile cannot be used with --executor process")
 
     main(args)
@@ -1,11 +1,9 @@
 import argparse
 import os
 import sys
+from logging import basicConfig
 
 import polars as pl
-from gql import Client, gql
-from gql.transport.requests import RequestsHTTPTransport
-from mongoengine import connect
 from pycoshark.mongomodels import (
     Commit,
     Project,
@@ -13,142 +11,152 @@ from pycoshark.mongomodels import (
     PullRequestSystem,
     VCSSystem,
 )
-from pycoshark.utils import create_mongodb_uri_string
 
-GITHUB_GRAPHQL_ENDPOINT = "https://api.github.com/graphql"
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.github_graphql import (
+    CACHE_TTL,
+    DEFAULT_CONCURRENCY,
+    GITHUB_GRAPHQL_ENDPOINT,
+    RepositoryFetcher,
+    ResponseCache,
+    default_cache_dir,
+)
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.part_writer import PartWriter, default_parts_dir
+
+# ロギングの設定 (レート制限の待ち時間などを表示)
+basicConfig(
+    level="INFO",
+    format="[%(asctime)s] [%(levelname)s] %(message)s",
+)
 
 BATCH_SIZE = 25
 
+# リポジトリ毎に取得するフィールド
+REPOSITORY_FIELDS = """
+    owner {
+        login
+    }
+    name
+    description
+    url
+    createdAt
+    archivedAt
+    autoMergeAllowed
+    assignableUsers {
+        totalCount
+    }
+    languages(first: 8, orderBy: {direction: DESC, field: SIZE}) {
+        edges {
+            size
+            node {
+                name
+            }
+        }
+        totalSize
+    }
+    stargazers {
+        totalCount
+    }
+    mirrorUrl
+"""
+
+
+def process_project(project: Project, value: dict | None) -> dict:
+    row = {
+        "project_id": str(project.id),
+    }
+
+    # リポジトリ情報を DataFrame の行に変換 (取得できなかった場合は空)
+    for k, v in (value or {}).items():
+        if k == "languages":
+            # 第一言語とその割合を取得
+            row["primary_language"] = v["edges"][0]["node"]["name"]
+            row["primary_language_ratio"] = (
+                f"{v["edges"][0]["size"] / v["totalSize"]:.2f}"
+            )
+            # 第二言語とその割合を取得
+            row["secondary_language"] = None
+            row["secondary_language_ratio"] = None
+            row["other_languages"] = None
+            if len(v["edges"]) > 1:
+                row["secondary_language"] = v["edges"][1]["node"]["name"]
+                row["secondary_language_ratio"] = (
+                    f"{v["edges"][1]["size"] / v["totalSize"]:.2f}"
+                )
+                # その他の言語名を取得
+                row["other_languages"] = str(
+                    [edge["node"]["name"] for edge in v["edges"][2:]]
+                )
+
+        elif isinstance(v, dict):
+            for kk, vv in v.items():
+                row[f"{k}.{kk}"] = str(vv)
+
+        else:
+            row[k] = str(v)
+
+    # commit と pull request の数を取得
+    vcs_system = VCSSystem.objects(project_id=project.id).first()
+    pull_request_system = PullRequestSystem.objects(project_id=project.id).first()
+    row["#cmt"] = Commit.objects(vcs_system_id=vcs_system.id).count()
+    row["#pr"] = PullRequest.objects(
+        pull_request_system_id=pull_request_system.id
+    ).count()
+    row["#mpr"] = PullRequest.objects(
+        pull_request_system_id=pull_request_system.id, merged_at__exists=True
+    ).count()
+
+    return row
+
 
 def main(args):
     # データベースに接続
-    uri = create_mongodb_uri_string(
-        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
-        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
-        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
-        db_port=os.getenv("SMARTSHARK_DB_PORT"),
-        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
-        db_ssl_enabled=False,
-    )
-    connect(
-        db=os.getenv("SMARTSHARK_DB_DATABASE"),
-        host=uri,
+    connect_to_mongodb()
+
+    # project 毎にリポジトリの owner と name を取得
+    projects = list(Project.objects)
+    repositories = {}
+    for project in projects:
+        pull_request_system = PullRequestSystem.objects(project_id=project.id)
+        if len(pull_request_system) > 1:
+            print(f"Multiple pull request systems found for project {project.name}")
+        pull_request_system = pull_request_system.first()
+        owner, repository = pull_request_system.url.split("/")[-3:-1]
+        repositories[project.id] = (owner, repository)
+
+    # リポジトリ情報を並行して取得 (キャッシュにあるリポジトリは取得しない)
+    fetcher = RepositoryFetcher(
+        REPOSITORY_FIELDS,
+        endpoint=args.endpoint,
+        token=os.getenv("GITHUB_API_TOKEN"),
+        concurrency=args.concurrency,
+        cache=ResponseCache(
+            args.cache_dir or default_cache_dir(args.output), args.cache_ttl
+        ),
     )
+    results = fetcher.fetch(list(repositories.values()))
 
-    # GraphQL クライアントの初期化
-    transport = RequestsHTTPTransport(
-        url=GITHUB_GRAPHQL_ENDPOINT,
-        headers={"Authorization": f"Bearer {os.getenv('GITHUB_API_TOKEN')}"},
-    )
-    client = Client(transport=transport, fetch_schema_from_transport=True)
-
-    # DataFrame の初期化
-    df = pl.DataFrame()
-
-    projects = Project.objects
+    # 結果はバッチ毎にパートファイルへ書き出す
+    writer = PartWriter(default_parts_dir(args.output))
     for i in range(0, len(projects), BATCH_SIZE):
         # 進捗表示
         print(f"{i/len(projects)*100:.2f}%", end="\r", file=sys.stderr)
 
-        # プロジェクトのリポジトリ情報を取得するためのクエリを作成
-        repository_query = ""
-        for project in projects[i : i + BATCH_SIZE]:
-            pull_request_system = PullRequestSystem.objects(project_id=project.id)
-            if len(pull_request_system) > 1:
-                print(f"Multiple pull request systems found for project {project.name}")
-            pull_request_system = pull_request_system.first()
-            owner, repository = pull_request_system.url.split("/")[-3:-1]
-
-            repository_query += f"""
-                project_{project.id}: repository(owner: "{owner}", name: "{repository}") {{
-                    owner {{
-                        login
-                    }}
-                    name
-                    description
-                    url
-                    createdAt
-                    archivedAt
-                    autoMergeAllowed
-                    assignableUsers {{
-                        totalCount
-                    }}
-                    languages(first: 8, orderBy: {{direction: DESC, field: SIZE}}) {{
-                        edges {{
-                            size
-                            node {{
-                                name
-                            }}
-                        }}
-                        totalSize
-                    }}
-                    stargazers {{
-                        totalCount
-                    }}
-                    mirrorUrl
-                }},
-            """
-
-        # リポジトリ情報を取得
-        query = gql(
-            f"""
-            {{
-                {repository_query}
-            }}
-            """
-        )
-        result = client.execute(query)
-
-        # リポジトリ情報を DataFrame に変換
-        for key, value in result.items():
-            row = {
-                "project_id": key.split("_")[1],
-            }
-            for k, v in value.items():
-                if k == "languages":
-                    # 第一言語とその割合を取得
-                    row["primary_language"] = v["edges"][0]["node"]["name"]
-                    row["primary_language_ratio"] = (
-                        f"{v["edges"][0]["size"] / v["totalSize"]:.2f}"
-                    )
-                    # 第二言語とその割合を取得
-                    row["secondary_language"] = None
-                    row["secondary_language_ratio"] = None
-                    row["other_languages"] = None
-                    if len(v["edges"]) > 1:
-                        row["secondary_language"] = v["edges"][1]["node"]["name"]
-                        row["secondary_language_ratio"] = (
-                            f"{v["edges"][1]["size"] / v["totalSize"]:.2f}"
-                        )
-                        # その他の言語名を取得
-                        row["other_languages"] = str(
-                            [edge["node"]["name"] for edge in v["edges"][2:]]
-                        )
-
-                elif isinstance(v, dict):
-                    for kk, vv in v.items():
-                        row[f"{k}.{kk}"] = str(vv)
-
-                else:
-                    row[k] = str(v)
-
-            # commit と pull request の数を取得
-            vcs_system = VCSSystem.objects(project_id=row["project_id"]).first()
-            pull_request_system = PullRequestSystem.objects(
-                project_id=row["project_id"]
-            ).first()
-            row["#cmt"] = Commit.objects(vcs_system_id=vcs_system.id).count()
-            row["#pr"] = PullRequest.objects(
-                pull_request_system_id=pull_request_system.id
-            ).count()
-            row["#mpr"] = PullRequest.objects(
-                pull_request_system_id=pull_request_system.id, merged_at__exists=True
-            ).count()
-
-            df = pl.concat([df, pl.DataFrame(row)], how="diagonal_relaxed")
+        rows = [
+            pl.DataFrame(process_project(project, results[repositories[project.id]]))
+            for project in projects[i : i + BATCH_SIZE]
+        ]
+
+        # バッチ内の行を結合して書き出す
+        writer.write(pl.concat(rows, how="diagonal_relaxed"))
+
+    # データベース接続を閉じる
+    close_mongodb()
 
     # CSV に保存
-    df.write_csv(args.output)
+    writer.scan().sink_csv(args.output)
+    writer.remove()
 
     # 進捗表示
     print("100.00%", file=sys.stderr)
@@ -159,5 +167,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "-o", "--output", help="Output file", default="data/repository_info.csv"
     )
+    parser.add_argument("--endpoint", type=str, default=GITHUB_GRAPHQL_ENDPOINT)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--cache-dir", type=str, default=None)
+    parser.add_argument("--cache-ttl", type=float, default=CACHE_TTL)
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,54 @@
+import asyncio
+
+from mongoengine import Document
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+from utils.mongo_client import (
+    DEFAULT_CONCURRENCY,
+    MAX_IDLE_TIME_MS,
+    MAX_POOL_SIZE,
+    MIN_POOL_SIZE,
+    mongodb_uri,
+)
+
+
+def connect_to_motor() -> AsyncIOMotorClient:
+    # connect_to_mongodb と同じ接続先, 同じ接続プールの設定で非同期クライアントを作成する
+    return AsyncIOMotorClient(
+        mongodb_uri(),
+        maxPoolSize=MAX_POOL_SIZE,
+        minPoolSize=MIN_POOL_SIZE,
+        maxIdleTimeMS=MAX_IDLE_TIME_MS,
+    )
+
+
+class AsyncQueryRunner:
+    # 全てのクエリを 1 つのセマフォで制限しながら並行に発行する
+    # 結果は mongoengine の Document に変換し, 同期版の処理をそのまま使えるようにする
+
+    def __init__(
+        self, db: AsyncIOMotorDatabase, concurrency: int = DEFAULT_CONCURRENCY
+    ):
+        self.db = db
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def find(
+        self,
+        document: type[Document],
+        filter: dict,
+        fields: tuple[str, ...] | None = None,
+        sort: list[tuple[str, int]] | None = None,
+    ) -> list[Document]:
+        # fields は QuerySet.only と同じく Document のフィールド名で指定する
+        projection = (
+            {document._fields[field].db_field: 1 for field in fields}
+            if fields
+            else None
+        )
+        collection = self.db[document._get_collection_name()]
+        async with self.semaphore:
+            cursor = collection.find(filter, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            sons = await cursor.to_list(length=None)
+        return [document._from_son(son) for son in sons]
@@ -0,0 +1,344 @@
+import argparse
+import concurrent.futures
+import importlib.util
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+from logging import basicConfig, getLogger
+
+from mongoengine.connection import get_db
+from pycoshark.mongomodels import Project
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.mongo_client import (
+    close_mongodb,
+    connect_to_mongodb,
+    is_production_database,
+)
+from utils.query_profiler import install_profiler
+from utils.synthetic import connect_to_mongomock, populate
+from utils.timeit_decorator import timeit_decorator
+
+# ========================================
+# 定数
+# ========================================
+ROOT_DIR = os.path.join(os.path.dirname(__file__), "..")
+
+# ベンチマーク対象 (名前: (スクリプト, 関数, 引数))
+EXTRACTORS = {
+    "analyze_pull_request_effect": (
+        "000/analyze_pull_request_effect.py",
+        "process_project",
+        {},
+    ),
+    "analyze_pull_request_effect[aggregate]": (
+        "000/analyze_pull_request_effect.py",
+        "process_project_aggregate",
+        {},
+    ),
+    "get_pull_request_features": (
+        "001/get_pull_request_features.py",
+        "process_project",
+        {},
+    ),
+    "get_pull_request_features[prefetch]": (
+        "001/get_pull_request_features.py",
+        "process_project",
+        {"prefetch": True},
+    ),
+    "analyze_commit": ("800/analyze_commit.py", "process_project", {}),
+    "analyze_commit[aggregate]": (
+        "800/analyze_commit.py",
+        "process_project_aggregate",
+        {},
+    ),
+    "analyze_pull_request_basics": (
+        "800/analyze_pull_request_basics.py",
+        "process_project",
+        {},
+    ),
+    "analyze_pull_request_basics[aggregate]": (
+        "800/analyze_pull_request_basics.py",
+        "process_project_aggregate",
+        {},
+    ),
+    "analyze_pull_request_defects": (
+        "800/analyze_pull_request_defects.py",
+        "process_project",
+        {},
+    ),
+    "analyze_author": ("800/analyze_author.py", "process_project", {}),
+}
+
+# mongomock の集約パイプラインでは実行できないもの
+MONGOD_ONLY = ("analyze_pull_request_effect[aggregate]",)
+
+# mongomock で数える読み込み系のメソッド
+MONGOMOCK_QUERY_METHODS = (
+    "find",
+    "find_one",
+    "aggregate",
+    "count_documents",
+    "estimated_document_count",
+    "distinct",
+)
+
+# ロギングの設定
+basicConfig(
+    level="INFO",
+    format="[%(asctime)s] [%(levelname)s] %(message)s",
+)
+logger = getLogger(__name__)
+
+
+def connect_to_benchmark_db(backend: str, database: str):
+    # mongod の場合は環境変数の接続先に, ベンチマーク用のデータベースを作成する
+    if backend == "mongomock":
+        return connect_to_mongomock()
+    return connect_to_mongodb(database)
+
+
+def load_script(path: str):
+    # 数字のディレクトリにあるスクリプトはパッケージとして import できないため直接読み込む
+    name = "benchmark_" + os.path.splitext(path)[0].replace("/", "_")
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT_DIR, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# ========================================
+# クエリ数の計測
+# ========================================
+class MongomockQueryCounter:
+    # mongomock はコマンド監視を発行しないため, Collection のメソッド呼び出しを数える
+
+    def __init__(self):
+        import mongomock
+
+        self.count = 0
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        for method in MONGOMOCK_QUERY_METHODS:
+            original = getattr(mongomock.collection.Collection, method)
+            setattr(mongomock.collection.Collection, method, self._wrap(original))
+
+    def _wrap(self, original):
+        def wrapper(*args, **kwargs):
+            # find_one の内部の find などは 1 回として数える
+            depth = getattr(self.local, "depth", 0)
+            if depth == 0:
+                with self.lock:
+                    self.count += 1
+            self.local.depth = depth + 1
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.local.depth = depth
+
+        return wrapper
+
+
+class MongodQueryCounter:
+    def __init__(self):
+        self.profiler = install_profiler()
+
+    @property
+    def count(self) -> int:
+        return sum(
+            stats["commands"]
+            for project in self.profiler.report()["projects"].values()
+            for commands in project["collections"].values()
+            for stats in commands.values()
+        )
+
+
+# ========================================
+# 実行
+# ========================================
+def peak_rss_mb() -> float:
+    # Linux の ru_maxrss は KB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_extractor(
+    name: str, backend: str, database: str, n_projects: int, scale: float, seed: int
+) -> dict:
+    # spawn した子プロセスで実行する (ピークメモリをベンチマーク毎に分けるため)
+    # mongomock はプロセス内のみで有効なため, 子プロセスで同じデータセットを生成する
+    counter = (
+        MongomockQueryCounter() if backend == "mongomock" else MongodQueryCounter()
+    )
+    connect_to_benchmark_db(backend, database)
+    if backend == "mongomock":
+        populate(n_projects, scale, seed)
+
+    path, function, kwargs = EXTRACTORS[name]
+    process_project = getattr(load_script(path), function)
+    projects = list(Project.objects.only("id", "name"))
+
+    # データセットの生成に使ったメモリを含めないように, 抽出前のピークメモリとの差を測る
+    # (ru_maxrss は戻らないため, 抽出中に生成時のピークを超えた分のみ数える)
+    rss_start = peak_rss_mb()
+    queries_start = counter.count
+    start = time.perf_counter()
+    pull_requests = None
+    for project in projects:
+        result = process_project(project, **kwargs)
+        # プルリクエスト毎の行を返す抽出 (list) はプルリクエスト数も数える
+        if isinstance(result, list):
+            pull_requests = (pull_requests or 0) + len(result)
+    wall_seconds = time.perf_counter() - start
+
+    return {
+        "projects": len(projects),
+        "pull_requests": pull_requests,
+        "wall_seconds": wall_seconds,
+        "projects_per_second": len(projects) / wall_seconds if wall_seconds else None,
+        "pull_requests_per_second": (
+            pull_requests / wall_seconds
+            if pull_requests is not None and wall_seconds
+            else None
+        ),
+        "queries": counter.count - queries_start,
+        "setup_rss_mb": rss_start,
+        "peak_rss_delta_mb": peak_rss_mb() - rss_start,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+
+        # クエリ数は増えたら回帰とする
+        if result["queries"] > base["queries"]:
+            regressions.append(
+                f"{key}: queries {base['queries']} -> {result['queries']}"
+            )
+
+        # スループット (プロジェクト/秒, 全ての抽出で同じ単位) は
+        # 許容範囲を超えて下がったら回帰とする
+        if (
+            base.get("projects_per_second")
+            and result["projects_per_second"] is not None
+            and result["projects_per_second"]
+            < base["projects_per_second"] * (1 - tolerance)
+        ):
+            regressions.append(
+                f"{key}: projects/s {base['projects_per_second']:.1f}"
+                f" -> {result['projects_per_second']:.1f}"
+            )
+    return regressions
+
+
+@timeit_decorator(logger=logger)
+def main(args):
+    config = {
+        "backend": args.backend,
+        "projects": args.projects,
+        "seed": args.seed,
+        "scales": args.scales,
+    }
+    extractors = args.extractors or [
+        name
+        for name in EXTRACTORS
+        if args.backend == "mongod" or name not in MONGOD_ONLY
+    ]
+    results = {}
+
+    for scale in args.scales:
+        # mongod の場合はベンチマーク用のデータベースを作り直す
+        if args.backend == "mongod":
+            connect_to_benchmark_db(args.backend, args.database)
+            get_db().client.drop_database(args.database)
+            populate(args.projects, scale, args.seed)
+            close_mongodb()
+
+        for name in extractors:
+            # polars のスレッドプールは fork で壊れるため spawn で起動する
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                result = executor.submit(
+                    run_extractor,
+                    name,
+                    args.backend,
+                    args.database,
+                    args.projects,
+                    scale,
+                    args.seed,
+                ).result()
+            key = f"{name}@{scale}"
+            results[key] = result
+            logger.info(
+                f"{key: <48} {result['wall_seconds']:8.2f}s"
+                f" {result['queries']:8d} queries"
+                f" {result['projects_per_second'] or 0:10.1f} projects/s"
+                f" {result['peak_rss_delta_mb']:8.1f} MB"
+            )
+
+    # 結果を出力
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
+
+    # ベースラインの更新
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or ".", exist_ok=True)
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2)
+        logger.info(f"Baseline updated: {args.baseline}")
+        return
+
+    # ベースラインとの比較
+    # ベースラインが無い場合は回帰を検出できないため, 失敗として終了する
+    if not os.path.exists(args.baseline):
+        logger.error(f"No baseline: {args.baseline}. Run with --update-baseline.")
+        sys.exit(1)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if {k: v for k, v in baseline["config"].items() if k != "scales"} != {
+        k: v for k, v in config.items() if k != "scales"
+    }:
+        logger.warning("Baseline was recorded with a different dataset; skipped.")
+        return
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for regression in regressions:
+        logger.error(f"Regression: {regression}")
+    if regressions:
+        sys.exit(1)
+    logger.info("No regressions.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--backend", choices=("mongomock", "mongod"), default="mongomock"
+    )
+    parser.add_argument("--database", type=str, default="smartshark_benchmark")
+    parser.add_argument("-n", "--projects", type=int, default=3)
+    parser.add_argument("--scales", type=float, nargs="+", default=[0.01, 0.05])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--extractors", nargs="*", choices=list(EXTRACTORS))
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument(
+        "-o", "--output", type=str, default="data/benchmark/latest.json"
+    )
+    parser.add_argument("--baseline", type=str, default="data/benchmark/baseline.json")
+    parser.add_argument("--update-baseline", default=False, action="store_true")
+    args = parser.parse_args()
+    # mongod の場合はスケール毎にデータベースを削除するため, 抽出対象のデータベースは使わない
+    if args.backend == "mongod" and is_production_database(args.database):
+        parser.error(
+            f"--database {args.database} is SMARTSHARK_DB_DATABASE; "
+            "use a separate database for benchmarks"
+        )
+
+    main(args)
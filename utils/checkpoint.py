@@ -0,0 +1,109 @@
+import json
+import os
+import traceback
+
+import polars as pl
+
+from utils.part_writer import scan_parts
+
+
+def default_checkpoint_dir(output: str) -> str:
+    # 出力ファイル毎にチェックポイントを分ける (例: data/foo.csv -> data/foo.checkpoints)
+    return os.path.splitext(output)[0] + ".checkpoints"
+
+
+class CheckpointStore:
+    # プロジェクト毎の結果を <directory>/<project>.parquet に保存する
+    # 失敗したプロジェクトは <directory>/<project>.failed にトレースバックを残す
+    # プロジェクト毎の処理時間は <directory>/timings.json に残す (clear でも削除しない)
+    # 出力の列や値を変える実行時の設定は <directory>/config.json に残し,
+    # --resume で異なる設定の結果が混ざらないようにする
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, project_name: str) -> str:
+        return os.path.join(self.directory, f"{project_name}.parquet")
+
+    def failed_path(self, project_name: str) -> str:
+        return os.path.join(self.directory, f"{project_name}.failed")
+
+    def is_done(self, project_name: str) -> bool:
+        return os.path.exists(self.path(project_name))
+
+    def failed_projects(self) -> list[str]:
+        return sorted(
+            os.path.splitext(name)[0]
+            for name in os.listdir(self.directory)
+            if name.endswith(".failed")
+        )
+
+    def save(self, project_name: str, df: pl.DataFrame) -> None:
+        # 書き込み途中で中断しても壊れたチェックポイントが残らないように置き換える
+        tmp_path = self.path(project_name) + ".tmp"
+        df.write_parquet(tmp_path)
+        os.replace(tmp_path, self.path(project_name))
+        if os.path.exists(self.failed_path(project_name)):
+            os.remove(self.failed_path(project_name))
+
+    def mark_failed(self, project_name: str, error: BaseException) -> None:
+        with open(self.failed_path(project_name), "w") as f:
+            f.write("".join(traceback.format_exception(error)))
+
+    def timings_path(self) -> str:
+        return os.path.join(self.directory, "timings.json")
+
+    def load_timings(self) -> dict[str, float]:
+        if not os.path.exists(self.timings_path()):
+            return {}
+        with open(self.timings_path()) as f:
+            return json.load(f)
+
+    def save_timings(self, timings: dict[str, float]) -> None:
+        tmp_path = self.timings_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(timings, f, indent=2)
+        os.replace(tmp_path, self.timings_path())
+
+    def config_path(self) -> str:
+        return os.path.join(self.directory, "config.json")
+
+    def check_config(self, config: dict, resume: bool) -> None:
+        # resume の場合は保存済みのチェックポイントと設定が同じかを確認し, 異なる場合は中断する
+        # (設定を記録していない古いチェックポイントも, 同じ設定か分からないため中断する)
+        # それ以外の場合は config を記録する
+        config = json.loads(json.dumps(config))
+        if resume and any(
+            name.endswith(".parquet") for name in os.listdir(self.directory)
+        ):
+            saved = None
+            if os.path.exists(self.config_path()):
+                with open(self.config_path()) as f:
+                    saved = json.load(f)
+            if saved != config:
+                raise ValueError(
+                    f"Checkpoints in {self.directory} were created with {saved}, "
+                    f"but this run uses {config}. "
+                    "Run without --resume or use another --checkpoint-dir."
+                )
+            return
+        tmp_path = self.config_path() + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(config, f, indent=2)
+        os.replace(tmp_path, self.config_path())
+
+    def clear(self) -> None:
+        for name in os.listdir(self.directory):
+            if name.endswith((".parquet", ".failed", ".tmp")):
+                os.remove(os.path.join(self.directory, name))
+
+    def scan(self, project_names: list[str]) -> pl.LazyFrame:
+        # プロジェクトの順に遅延結合 (全プロジェクトを同時にメモリに載せない)
+        return scan_parts(
+            [
+                self.path(project_name)
+                for project_name in project_names
+                if self.is_done(project_name)
+            ]
+        )
@@ -0,0 +1,40 @@
+from collections import defaultdict
+from typing import Callable, Hashable, Iterable, Iterator
+
+from mongoengine import Document
+from mongoengine.queryset import QuerySet
+
+# $in に渡す値の最大数 (1 クエリあたり)
+CHUNK_SIZE = 1000
+
+
+def iter_chunks(values: Iterable, chunk_size: int = CHUNK_SIZE) -> Iterator[list]:
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def fetch_in_chunks(
+    queryset: QuerySet,
+    field: str,
+    values: Iterable,
+    chunk_size: int = CHUNK_SIZE,
+) -> Iterator[Document]:
+    # 重複を除いた値を chunk_size 毎に $in クエリで取得
+    for chunk in iter_chunks(dict.fromkeys(values), chunk_size):
+        yield from queryset.filter(**{f"{field}__in": chunk})
+
+
+def group_by(
+    documents: Iterable[Document], key: Callable[[Document], Hashable]
+) -> dict[Hashable, list[Document]]:
+    # 取得順を保ったままキー毎にまとめる
+    groups = defaultdict(list)
+    for document in documents:
+        groups[key(document)].append(document)
+    return groups
@@ -0,0 +1,65 @@
+import concurrent.futures
+import contextvars
+from collections import defaultdict
+from typing import Callable
+
+from bson import ObjectId
+from pycoshark.mongomodels import Commit
+
+# 1 シャードあたりの最小コミット数 (小さいプロジェクトは分割しない)
+MIN_SHARD_COMMITS = 1000
+
+
+def shard_ranges(
+    vcs_system_id: ObjectId, shards: int, min_commits: int = MIN_SHARD_COMMITS
+) -> list[tuple[ObjectId | None, ObjectId | None]]:
+    # コミットを _id の範囲 [lower, upper) で件数がほぼ等しくなるように分割する
+    # 境界は _id 順に skip して求める (全コミットの _id は取得しない)
+    if shards <= 1:
+        return [(None, None)]
+    commits = Commit.objects(vcs_system_id=vcs_system_id)
+    count = commits.count()
+    shards = max(1, min(shards, count // min_commits))
+    if shards == 1:
+        return [(None, None)]
+
+    bounds = [
+        commits.order_by("id").skip(count * k // shards).scalar("id").first()
+        for k in range(1, shards)
+    ]
+    return list(zip([None, *bounds], [*bounds, None]))
+
+
+def shard_filter(lower: ObjectId | None, upper: ObjectId | None) -> dict:
+    # Commit.objects(**shard_filter(lower, upper)) で範囲内のコミットに絞り込む
+    filter = {}
+    if lower is not None:
+        filter["id__gte"] = lower
+    if upper is not None:
+        filter["id__lt"] = upper
+    return filter
+
+
+def run_shards(
+    fn: Callable[[ObjectId | None, ObjectId | None], dict],
+    ranges: list[tuple[ObjectId | None, ObjectId | None]],
+) -> list[dict]:
+    # シャード毎に fn(lower, upper) をスレッドで並行実行する
+    # 呼び出し元のコンテキスト (プロファイラのプロジェクト名など) を各スレッドに引き継ぐ
+    if len(ranges) == 1:
+        return [fn(*ranges[0])]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, fn, lower, upper)
+            for lower, upper in ranges
+        ]
+        return [future.result() for future in futures]
+
+
+def merge_counts(rows: list[dict]) -> dict:
+    # シャード毎のカウンタを合計する (キーは最初に出現した順)
+    merged = defaultdict(int)
+    for row in rows:
+        for key, value in row.items():
+            merged[key] += value
+    return merged
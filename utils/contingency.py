@@ -0,0 +1,200 @@
+import warnings
+
+import numpy as np
+import polars as pl
+from scipy.stats import chi2, norm
+
+# 2x2 分割表のセルの列 (行: PR 外 / PR 内, 列: 不具合混入あり / なし)
+# display_chisq の表と同じ向き (a, b, c, d) で, オッズ比は PR 外の PR 内に対する比
+COUNT_COLUMNS = ("#cmt-pr+bi", "#cmt-pr-bi", "#cmt+pr+bi", "#cmt+pr-bi")
+# ブートストラップの反復回数の既定値
+N_BOOTSTRAP = 10000
+
+
+def project_tables(df: pl.DataFrame) -> np.ndarray:
+    # プロジェクト毎の 2x2 分割表 (プロジェクト, 2, 2)
+    return df.select(COUNT_COLUMNS).to_numpy().astype(np.float64).reshape(-1, 2, 2)
+
+
+def buggy_ratios(tables: np.ndarray) -> np.ndarray:
+    # 行 (PR 外, PR 内) 毎の不具合混入の割合 (行が空の場合は NaN)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return tables[..., 0] / tables.sum(axis=-1)
+
+
+def odds_ratios(tables: np.ndarray, confidence: float = 0.95) -> dict[str, np.ndarray]:
+    # 層毎のオッズ比と Woolf の信頼区間
+    # 0 のセルがある層は全てのセルに 0.5 を加える (Haldane-Anscombe の補正)
+    # 行または列の合計が 0 の層 (PR 内のコミットが無いなど) は NaN とする
+    a, b, c, d = (tables[..., i, j] for i in (0, 1) for j in (0, 1))
+    zero = (tables == 0).any(axis=(-2, -1))
+    a, b, c, d = (np.where(zero, x + 0.5, x) for x in (a, b, c, d))
+    empty = (tables.sum(axis=-1) == 0).any(axis=-1) | (tables.sum(axis=-2) == 0).any(
+        axis=-1
+    )
+    log_or = np.where(empty, np.nan, np.log(a * d / (b * c)))
+    se = np.sqrt(1 / a + 1 / b + 1 / c + 1 / d)
+    z = norm.ppf((1 + confidence) / 2)
+    return {
+        "odds_ratio": np.exp(log_or),
+        "ci_low": np.exp(log_or - z * se),
+        "ci_high": np.exp(log_or + z * se),
+    }
+
+
+def mantel_haenszel(tables: np.ndarray, confidence: float = 0.95) -> dict[str, float]:
+    # 層をまとめた Mantel-Haenszel のオッズ比と,
+    # Robins-Breslow-Greenland の分散による信頼区間, 連続修正付きの Mantel-Haenszel 検定
+    a, b, c, d = (tables[:, i, j] for i in (0, 1) for j in (0, 1))
+    n = tables.sum(axis=(1, 2))
+    # 1 件しか無い層は情報を持たないため除く
+    keep = n > 1
+    a, b, c, d, n = a[keep], b[keep], c[keep], d[keep], n[keep]
+
+    r, s = a * d / n, b * c / n
+    odds_ratio = r.sum() / s.sum()
+    p, q = (a + d) / n, (b + c) / n
+    variance = (
+        (p * r).sum() / (2 * r.sum() ** 2)
+        + (p * s + q * r).sum() / (2 * r.sum() * s.sum())
+        + (q * s).sum() / (2 * s.sum() ** 2)
+    )
+    z = norm.ppf((1 + confidence) / 2)
+
+    expected = (a + b) * (a + c) / n
+    var_a = (a + b) * (c + d) * (a + c) * (b + d) / (n**2 * (n - 1))
+    statistic = (max(abs(a.sum() - expected.sum()) - 0.5, 0) ** 2) / var_a.sum()
+    return {
+        "odds_ratio": float(odds_ratio),
+        "ci_low": float(odds_ratio * np.exp(-z * np.sqrt(variance))),
+        "ci_high": float(odds_ratio * np.exp(z * np.sqrt(variance))),
+        "statistic": float(statistic),
+        "p_value": float(chi2.sf(statistic, 1)),
+    }
+
+
+def breslow_day(
+    tables: np.ndarray, odds_ratio: float, tarone: bool = False
+) -> dict[str, float]:
+    # 層毎のオッズ比が等しいかの Breslow-Day 検定 (tarone=True で Tarone の補正)
+    # 行または列の合計が 0 の層は情報を持たないため除く
+    keep = (tables.sum(axis=1) > 0).all(axis=1) & (tables.sum(axis=2) > 0).all(axis=1)
+    tables = tables[keep]
+    a = tables[:, 0, 0]
+    n1, n2 = tables[:, 0].sum(axis=1), tables[:, 1].sum(axis=1)
+    m1 = tables[:, :, 0].sum(axis=1)
+
+    # 共通のオッズ比の下での a の期待値 A は
+    # A (n2 - m1 + A) = OR (n1 - A) (m1 - A) の解のうち, 取り得る範囲にあるもの
+    lower, upper = np.maximum(0, m1 - n2), np.minimum(n1, m1)
+    qa = 1 - odds_ratio
+    qb = n2 - m1 + odds_ratio * (n1 + m1)
+    qc = -odds_ratio * n1 * m1
+    if np.isclose(qa, 0):
+        expected = -qc / qb
+    else:
+        roots = (-qb + np.array([[1], [-1]]) * np.sqrt(qb**2 - 4 * qa * qc)) / (2 * qa)
+        valid = (roots >= lower - 1e-9) & (roots <= upper + 1e-9)
+        expected = np.where(valid[0], roots[0], roots[1])
+    variance = 1 / (
+        1 / expected
+        + 1 / (n1 - expected)
+        + 1 / (m1 - expected)
+        + 1 / (n2 - m1 + expected)
+    )
+    statistic = ((a - expected) ** 2 / variance).sum()
+    if tarone:
+        statistic -= (a - expected).sum() ** 2 / variance.sum()
+    dof = len(tables) - 1
+    return {
+        "statistic": float(statistic),
+        "p_value": float(chi2.sf(statistic, dof)),
+        "dof": dof,
+    }
+
+
+def bootstrap_tables(
+    tables: np.ndarray, n_bootstrap: int = N_BOOTSTRAP, seed: int = 0
+) -> np.ndarray:
+    # 層毎にコミット数を固定し, 4 つのセルを多項分布で復元抽出する
+    # 全ての反復と層を 1 回の多項分布の乱数生成で求める (反復, 層, 2, 2)
+    n = tables.sum(axis=(1, 2))
+    pvals = tables.reshape(-1, 4) / np.maximum(n, 1)[:, None]
+    # 空の層は確率が全て 0 になるため, 件数 0 のまま 1 つ目のセルに割り当てる
+    pvals[n == 0, 0] = 1
+    rng = np.random.default_rng(seed)
+    samples = rng.multinomial(
+        n.astype(np.int64), pvals, size=(n_bootstrap, len(tables))
+    )
+    return samples.reshape(n_bootstrap, len(tables), 2, 2).astype(np.float64)
+
+
+def percentile_interval(
+    samples: np.ndarray, confidence: float = 0.95
+) -> tuple[np.ndarray, np.ndarray]:
+    # 反復 (axis=0) 方向のパーセンタイル区間 (NaN の反復は除く)
+    # 全ての反復が NaN の層 (PR 内のコミットが無いなど) は NaN とする
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        low, high = np.nanquantile(samples, [alpha, 1 - alpha], axis=0)
+    return low, high
+
+
+def analyze_effect(
+    df: pl.DataFrame,
+    n_bootstrap: int = N_BOOTSTRAP,
+    confidence: float = 0.95,
+    seed: int = 0,
+) -> tuple[pl.DataFrame, dict]:
+    # プロジェクト毎の結果と, プロジェクトをまとめた結果を返す
+    # 不具合混入の割合の差は PR 内 - PR 外 (負の場合は PR 内の方が少ない)
+    tables = project_tables(df)
+    ratios = buggy_ratios(tables)
+    per_project_or = odds_ratios(tables, confidence)
+
+    samples = bootstrap_tables(tables, n_bootstrap, seed)
+    sample_ratios = buggy_ratios(samples)
+    diff_low, diff_high = percentile_interval(
+        sample_ratios[..., 1] - sample_ratios[..., 0], confidence
+    )
+    pooled_ratios = buggy_ratios(samples.sum(axis=1))
+    pooled_low, pooled_high = percentile_interval(
+        pooled_ratios[:, 1] - pooled_ratios[:, 0], confidence
+    )
+
+    projects = pl.DataFrame(
+        {
+            "project": df["project"],
+            "#cmt+pr": tables[:, 1].sum(axis=1).astype(np.int64),
+            "#cmt-pr": tables[:, 0].sum(axis=1).astype(np.int64),
+            "buggy_ratio+pr": ratios[:, 1],
+            "buggy_ratio-pr": ratios[:, 0],
+            "diff": ratios[:, 1] - ratios[:, 0],
+            "diff_ci_low": diff_low,
+            "diff_ci_high": diff_high,
+            "odds_ratio": per_project_or["odds_ratio"],
+            "odds_ratio_ci_low": per_project_or["ci_low"],
+            "odds_ratio_ci_high": per_project_or["ci_high"],
+        }
+    )
+
+    pooled = buggy_ratios(tables.sum(axis=0))
+    mh = mantel_haenszel(tables, confidence)
+    bd = breslow_day(tables, mh["odds_ratio"])
+    summary = {
+        "buggy_ratio+pr": float(pooled[1]),
+        "buggy_ratio-pr": float(pooled[0]),
+        "diff": float(pooled[1] - pooled[0]),
+        "diff_ci_low": float(pooled_low),
+        "diff_ci_high": float(pooled_high),
+        "mh_odds_ratio": mh["odds_ratio"],
+        "mh_ci_low": mh["ci_low"],
+        "mh_ci_high": mh["ci_high"],
+        "mh_statistic": mh["statistic"],
+        "mh_p_value": mh["p_value"],
+        "breslow_day_statistic": bd["statistic"],
+        "breslow_day_p_value": bd["p_value"],
+        "breslow_day_dof": bd["dof"],
+    }
+    return projects, summary
@@ -0,0 +1,380 @@
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import warnings
+from logging import getLogger
+
+import joblib
+import numpy as np
+import pandas as pd
+import polars as pl
+import sklearn
+from sklearn.base import BaseEstimator, clone
+from sklearn.inspection import permutation_importance
+from sklearn.metrics import (
+    accuracy_score,
+    auc,
+    f1_score,
+    matthews_corrcoef,
+    precision_recall_curve,
+    precision_score,
+    recall_score,
+    roc_auc_score,
+)
+from sklearn.model_selection import LeaveOneGroupOut, StratifiedKFold
+
+logger = getLogger(__name__)
+
+# stratified: 層化 k 分割, lopo: プロジェクト毎に 1 つをテストにする (leave-one-project-out)
+SPLITS = ("stratified", "lopo")
+# global: 全データの平均と標準偏差で標準化する (既定)
+# fold: 分割毎に学習データの平均と標準偏差で標準化する (テストデータの情報を使わない)
+STANDARDIZATIONS = ("global", "fold")
+METRICS = (
+    "accuracy",
+    "precision",
+    "recall",
+    "f1",
+    "mcc",
+    "roc_auc",
+    "pr_auc",
+    "f1_optimal",
+    "mcc_optimal",
+)
+
+# キャッシュの形式を変えた場合は上げる (古いキャッシュを使わないようにする)
+CACHE_VERSION = 3
+
+
+def default_cache_dir() -> str:
+    return os.path.join("data", "cv_cache")
+
+
+def _hash(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str((part.dtype, part.shape)).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=repr).encode())
+    return h.hexdigest()[:16]
+
+
+def model_config(model: BaseEstimator) -> dict:
+    # キャッシュのキーに使うモデルの設定 (クラスとハイパーパラメータ)
+    return {
+        "class": f"{type(model).__module__}.{type(model).__qualname__}",
+        "params": model.get_params(deep=True),
+        "sklearn": sklearn.__version__,
+    }
+
+
+def make_folds(
+    y: np.ndarray,
+    groups: np.ndarray | None = None,
+    split: str = "stratified",
+    n_splits: int = 5,
+    random_state: int = 0,
+) -> tuple[np.ndarray, list[str]]:
+    # 各行がテストになる分割の番号と, 分割の名前を返す
+    # (どちらの分割でも各行はちょうど 1 つの分割でテストになる)
+    if split not in SPLITS:
+        raise ValueError(f"Unknown split: {split}")
+    if split == "lopo":
+        if groups is None:
+            raise ValueError("groups is required for leave-one-project-out")
+        splitter = LeaveOneGroupOut().split(y, y, groups)
+    else:
+        splitter = StratifiedKFold(
+            n_splits=n_splits, shuffle=True, random_state=random_state
+        ).split(y, y)
+
+    fold_of_row = np.full(len(y), -1, dtype=np.int64)
+    names = []
+    for fold, (_, test_idx) in enumerate(splitter):
+        fold_of_row[test_idx] = fold
+        names.append(str(groups[test_idx[0]]) if split == "lopo" else str(fold + 1))
+    return fold_of_row, names
+
+
+def evaluate(y_true: np.ndarray, y_score: np.ndarray, y_pred: np.ndarray) -> dict:
+    # 予測ラベルと予測確率からモデルの精度を計算する
+    # テストが一方のクラスのみの場合 (lopo の小さいプロジェクトなど) AUC 等は NaN とする
+    row = {
+        "accuracy": accuracy_score(y_true, y_pred),
+        "precision": precision_score(y_true, y_pred, zero_division=0),
+        "recall": recall_score(y_true, y_pred, zero_division=0),
+        "f1": f1_score(y_true, y_pred, zero_division=0),
+        "mcc": matthews_corrcoef(y_true, y_pred),
+    }
+    if len(np.unique(y_true)) < 2:
+        return row | {
+            metric: np.nan
+            for metric in ("roc_auc", "pr_auc", "f1_optimal", "mcc_optimal")
+        }
+
+    precision, recall, thresholds = precision_recall_curve(y_true, y_score)
+    # F1 が最大になる閾値で再評価する
+    # (最後の要素は precision=1, recall=0 で対応する閾値が無いため除く)
+    f1_scores = 2 * recall * precision / (recall + precision + 1e-10)
+    y_pred_optimal = y_score >= thresholds[np.argmax(f1_scores[:-1])]
+    return row | {
+        "roc_auc": roc_auc_score(y_true, y_score),
+        "pr_auc": auc(recall, precision),
+        "f1_optimal": f1_score(y_true, y_pred_optimal),
+        "mcc_optimal": matthews_corrcoef(y_true, y_pred_optimal),
+    }
+
+
+def _dump(value, path: str) -> None:
+    # 書き込み途中で中断しても壊れたキャッシュが残らないように置き換える
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(value, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def importance_path(path: str, scoring: str, n_repeats: int) -> str:
+    # 学習済みモデル (path) に対する並べ替えによる重要度の保存先
+    return f"{os.path.splitext(path)[0]}.importance.{scoring}.{n_repeats}.joblib"
+
+
+def _fit_fold(
+    model: BaseEstimator,
+    data_dir: str,
+    fold: int,
+    scorings: list[str],
+    n_repeats: int,
+    path: str,
+) -> dict:
+    # 1 つの (モデル, 分割) を学習・評価し, 学習済みモデルと結果を path に保存する
+    # 保存済みの場合は学習し直さず, 足りない評価指標の重要度のみを同じモデルで計算する
+    # データは親プロセスが保存したものをメモリマップで読む (プロセス毎に複製しない)
+    X = np.load(os.path.join(data_dir, "X.npy"), mmap_mode="r")
+    y = np.load(os.path.join(data_dir, "y.npy"), mmap_mode="r")
+    fold_of_row = np.load(os.path.join(data_dir, "folds.npy"), mmap_mode="r")
+    mean, std = np.load(os.path.join(data_dir, "scaling.npy"), mmap_mode="r")[fold]
+
+    test = fold_of_row == fold
+    X_test, y_test = (X[test] - mean) / std, y[test]
+
+    if os.path.exists(path):
+        result = joblib.load(path)
+        model = result.pop("model")
+    else:
+        model.fit((X[~test] - mean) / std, y[~test])
+        y_score = model.predict_proba(X_test)[:, 1]
+        y_pred = model.predict(X_test)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            result = {
+                "n_train": int((~test).sum()),
+                "n_test": len(y_test),
+                "metrics": evaluate(y_test, y_score, y_pred),
+            }
+        _dump(result | {"model": model}, path)
+
+    # テストが一方のクラスのみの場合は重要度を計算しない (None)
+    result["importances"] = {}
+    for scoring in scorings:
+        scoring_path = importance_path(path, scoring, n_repeats)
+        if os.path.exists(scoring_path):
+            result["importances"][scoring] = joblib.load(scoring_path)
+            continue
+        importances = None
+        if len(np.unique(y_test)) == 2:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                importances = permutation_importance(
+                    model,
+                    X_test,
+                    y_test,
+                    n_repeats=n_repeats,
+                    random_state=0,
+                    scoring=scoring,
+                ).importances_mean
+        _dump(importances, scoring_path)
+        result["importances"][scoring] = importances
+    return result
+
+
+class CrossValidator:
+    # 複数のモデルの交差検証を (モデル, 分割) 単位でプロセスプールに分散する
+    # 分割と標準化のパラメータはデータ毎に 1 度だけ計算して保存する
+    # 学習済みモデルと結果は <cache_dir>/<データのハッシュ>/<モデルの設定のハッシュ>/<分割>.joblib に
+    # 保存し, データと設定が変わらない組み合わせは学習し直さない
+    # 並べ替えによる重要度は評価指標毎に学習済みモデルの隣に保存する
+    # (評価指標を追加しても学習し直さず, 同じモデルで計算する)
+
+    def __init__(
+        self,
+        X: pd.DataFrame,
+        y: pd.Series,
+        groups: pd.Series | None = None,
+        split: str = "stratified",
+        n_splits: int = 5,
+        random_state: int = 0,
+        standardize: str | None = "global",
+        cache_dir: str | None = None,
+    ):
+        if standardize is not None and standardize not in STANDARDIZATIONS:
+            raise ValueError(f"Unknown standardization: {standardize}")
+        self.columns = list(X.columns)
+        X = X.to_numpy(dtype=np.float64)
+        y = np.asarray(y).astype(bool)
+        groups = None if groups is None else np.asarray(groups).astype(str)
+        fold_of_row, self.fold_names = make_folds(
+            y, groups, split, n_splits, random_state
+        )
+
+        self.data_key = _hash(
+            CACHE_VERSION,
+            self.columns,
+            X,
+            y,
+            fold_of_row,
+            self.fold_names,
+            standardize,
+        )
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.data_dir = os.path.join(self.cache_dir, self.data_key)
+        if not os.path.exists(os.path.join(self.data_dir, "scaling.npy")):
+            # 標準化のパラメータ (分割毎, 平均と標準偏差)
+            # global は X = (X - X.mean()) / X.std() と同じ, None の場合は標準化しない
+            scaling = np.zeros((len(self.fold_names), 2, X.shape[1]))
+            scaling[:, 1] = 1
+            if standardize is not None:
+                for fold in range(len(self.fold_names)):
+                    X_train = X[fold_of_row != fold] if standardize == "fold" else X
+                    std = X_train.std(axis=0, ddof=1)
+                    scaling[fold] = X_train.mean(axis=0), np.where(std > 0, std, 1)
+            os.makedirs(self.data_dir, exist_ok=True)
+            for name, array in (
+                ("X", X),
+                ("y", y),
+                ("folds", fold_of_row),
+                ("scaling", scaling),
+            ):
+                # scaling.npy を最後に保存し, 揃っているかの判定に使う
+                tmp_path = os.path.join(self.data_dir, f"{name}.{os.getpid()}.tmp.npy")
+                np.save(tmp_path, array)
+                os.replace(tmp_path, os.path.join(self.data_dir, f"{name}.npy"))
+
+    def path(self, config_key: str, fold: int) -> str:
+        return os.path.join(self.data_dir, config_key, f"{fold}.joblib")
+
+    @staticmethod
+    def config_key(model: BaseEstimator) -> str:
+        return _hash(model_config(model))
+
+    def pending(self, path: str, scorings: list[str], n_repeats: int) -> bool:
+        # 学習済みモデルか, 指定した評価指標の重要度のいずれかが保存されていない
+        return not os.path.exists(path) or any(
+            not os.path.exists(importance_path(path, scoring, n_repeats))
+            for scoring in scorings
+        )
+
+    def run(
+        self,
+        models: dict[str, BaseEstimator],
+        importance: str | list[str] | tuple[str, ...] | None = None,
+        n_repeats: int = 10,
+        workers: int | None = None,
+    ) -> tuple[pl.DataFrame, dict[str, pl.DataFrame]]:
+        # (モデル, 分割) 毎の精度と, importance を指定した場合は評価指標毎に
+        # 並べ替えによる特徴量の重要度 (平均) を返す
+        # 各 (モデル, 分割) は 1 度だけ学習し, 全ての評価指標の重要度を同じモデルで計算する
+        if importance is None:
+            scorings = []
+        elif isinstance(importance, str):
+            scorings = [importance]
+        else:
+            scorings = list(importance)
+        paths = {
+            (model_name, fold): self.path(self.config_key(model), fold)
+            for model_name, model in models.items()
+            for fold in range(len(self.fold_names))
+        }
+        tasks = list(paths)
+        results = {}
+        pending = []
+        for task, path in paths.items():
+            if self.pending(path, scorings, n_repeats):
+                pending.append(task)
+            else:
+                results[task] = joblib.load(path)
+                del results[task]["model"]
+                results[task]["importances"] = {
+                    scoring: joblib.load(importance_path(path, scoring, n_repeats))
+                    for scoring in scorings
+                }
+        logger.info(f"{len(results)} cached, {len(pending)} to fit or score.")
+
+        workers = min(workers or os.cpu_count(), len(pending))
+        if workers == 1:
+            for model_name, fold in pending:
+                results[model_name, fold] = _fit_fold(
+                    clone(models[model_name]),
+                    self.data_dir,
+                    fold,
+                    scorings,
+                    n_repeats,
+                    paths[model_name, fold],
+                )
+        elif workers > 1:
+            # fork した子に親のスレッドの状態を持ち込まないように spawn で起動する
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            ) as executor:
+                futures = {
+                    executor.submit(
+                        _fit_fold,
+                        clone(models[model_name]),
+                        self.data_dir,
+                        fold,
+                        scorings,
+                        n_repeats,
+                        paths[model_name, fold],
+                    ): (model_name, fold)
+                    for model_name, fold in pending
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    results[futures[future]] = future.result()
+
+        scores = pl.DataFrame(
+            [
+                {
+                    "model": model_name,
+                    "fold": self.fold_names[fold],
+                    "n_train": results[model_name, fold]["n_train"],
+                    "n_test": results[model_name, fold]["n_test"],
+                }
+                | results[model_name, fold]["metrics"]
+                for model_name, fold in tasks
+            ]
+        )
+        importances = {
+            scoring: pl.DataFrame(
+                [
+                    {"model": model_name, "fold": self.fold_names[fold]}
+                    | dict(
+                        zip(
+                            self.columns,
+                            results[model_name, fold]["importances"][scoring],
+                        )
+                    )
+                    for model_name, fold in tasks
+                    if results[model_name, fold]["importances"][scoring] is not None
+                ]
+            )
+            for scoring in scorings
+        }
+        return scores, importances
+
+    def load_model(self, model: BaseEstimator, fold: int) -> BaseEstimator:
+        # run() で学習済みの (モデル, 分割) を読み込む
+        return joblib.load(self.path(self.config_key(model), fold))["model"]
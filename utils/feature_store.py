@@ -0,0 +1,64 @@
+import os
+import threading
+
+import polars as pl
+
+# 文字列として読み込む列 (ObjectId が数字のみの場合に数値と推定されないようにする)
+STRING_COLUMNS = ("project", "id", "url")
+
+_lock = threading.Lock()
+
+
+def default_store_path(csv_path: str) -> str:
+    # CSV と同じ場所に置く (例: data/foo.csv -> data/foo.arrow)
+    return os.path.splitext(csv_path)[0] + ".arrow"
+
+
+def build_feature_store(csv_path: str, store_path: str | None = None) -> str:
+    # CSV を型付きの Arrow IPC に変換する
+    # メモリマップで読めるように圧縮しない
+    store_path = store_path or default_store_path(csv_path)
+    columns = pl.read_csv(csv_path, n_rows=0).columns
+    df = pl.read_csv(
+        csv_path,
+        infer_schema_length=None,
+        schema_overrides={
+            column: pl.String for column in STRING_COLUMNS if column in columns
+        },
+    )
+    # 書き込み途中で中断しても壊れたファイルが残らないように置き換える
+    tmp_path = f"{store_path}.{os.getpid()}.tmp"
+    df.write_ipc(tmp_path, compression="uncompressed")
+    os.replace(tmp_path, store_path)
+    return store_path
+
+
+def feature_store(csv_path: str) -> str:
+    # CSV より古い (または無い) 場合のみ作り直す
+    store_path = default_store_path(csv_path)
+    with _lock:
+        if not os.path.exists(store_path) or os.path.getmtime(
+            store_path
+        ) < os.path.getmtime(csv_path):
+            build_feature_store(csv_path, store_path)
+    return store_path
+
+
+def scan_features(
+    csv_path: str = "data/pull_request_features.csv",
+    columns: list[str] | None = None,
+    exclude_bots: bool = True,
+    code_change_only: bool = True,
+) -> pl.LazyFrame:
+    # 特徴量を遅延評価で読み込む
+    # 非圧縮の Arrow IPC は polars がメモリマップで読むため,
+    # セルやノートブックの間で同じページキャッシュを共有する (パースやコピーをしない)
+    # フィルタと列の選択は読み込み時に適用される (predicate / projection pushdown)
+    lf = pl.scan_ipc(feature_store(csv_path))
+    if exclude_bots:
+        lf = lf.filter(~pl.col("bot"))
+    if code_change_only:
+        lf = lf.filter(pl.col("code_change"))
+    if columns is not None:
+        lf = lf.select(columns)
+    return lf
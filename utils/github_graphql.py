@@ -0,0 +1,288 @@
+import collections
+import concurrent.futures
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from logging import getLogger
+
+from gql import Client, gql
+from gql.client import SyncClientSession
+from gql.transport.exceptions import TransportQueryError, TransportServerError
+from gql.transport.requests import RequestsHTTPTransport
+
+logger = getLogger(__name__)
+
+GITHUB_GRAPHQL_ENDPOINT = "https://api.github.com/graphql"
+
+# 1 回のクエリで取得するリポジトリ数の初期値と上限
+BATCH_SIZE = 25
+MAX_BATCH_SIZE = 100
+# 1 回のクエリのコスト (rateLimit.cost) の目標値
+# GitHub は 1 時間あたり 5000 点で, 100 ノードまでのクエリは 1 点
+TARGET_COST = 1
+# 同時に送信するクエリの数 (GitHub の二次レート制限を避けるため小さくする)
+DEFAULT_CONCURRENCY = 4
+# 一時的なエラーで再送する回数
+MAX_RETRIES = 5
+# リセット時刻 (秒単位) の後に余分に待つ時間 (秒)
+RESET_MARGIN = 1
+# キャッシュの有効期間 (秒)
+CACHE_TTL = 7 * 24 * 60 * 60
+
+# レスポンスに含めるレート制限の情報
+RATE_LIMIT_FIELDS = "rateLimit { cost remaining resetAt }"
+
+Repository = tuple[str, str]
+
+
+def default_cache_dir(output: str) -> str:
+    # 出力ファイルと同じディレクトリに置く (例: data/foo.csv -> data/github_cache)
+    return os.path.join(os.path.dirname(output), "github_cache")
+
+
+class ResponseCache:
+    # リポジトリ毎のレスポンスを <directory>/<owner>/<name>.json に保存する
+    # 取得から ttl 秒を過ぎたものは無効とする (ttl=0 で常に取得し直す)
+
+    def __init__(self, directory: str, ttl: float = CACHE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+
+    def path(self, repository: Repository) -> str:
+        owner, name = repository
+        return os.path.join(self.directory, owner, f"{name}.json")
+
+    def get(self, repository: Repository) -> dict | None:
+        path = self.path(repository)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            entry = json.load(f)
+        if time.time() - entry["fetched_at"] >= self.ttl:
+            return None
+        return entry["data"]
+
+    def put(self, repository: Repository, data: dict) -> None:
+        # 書き込み途中で中断しても壊れたキャッシュが残らないように置き換える
+        path = self.path(repository)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"fetched_at": time.time(), "data": data}, f)
+        os.replace(tmp_path, path)
+
+
+class RateLimiter:
+    # 全スレッドで残りポイントとリセット時刻を共有し, 足りない場合はリセットまで待つ
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset_at = 0.0
+        self.paused_until = 0.0
+
+    def acquire(self, cost: int) -> None:
+        # 送信前に見積もりのコストを予約する
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.paused_until > now:
+                    wait = self.paused_until - now
+                elif self.remaining is not None and self.remaining < cost:
+                    if self.reset_at + RESET_MARGIN <= now:
+                        # リセット後は次のレスポンスで更新されるまで制限しない
+                        self.remaining = None
+                        continue
+                    wait = self.reset_at + RESET_MARGIN - now
+                else:
+                    if self.remaining is not None:
+                        self.remaining -= cost
+                    return
+            logger.info(f"Rate limit reached. Waiting {wait:.0f}s...")
+            time.sleep(wait)
+
+    def update(self, remaining: int, reset_at: float) -> None:
+        with self.lock:
+            # 並行するリクエストのうち, 最も新しい (少ない) 残りポイントを採用する
+            if reset_at > self.reset_at or self.remaining is None:
+                self.remaining = remaining
+            else:
+                self.remaining = min(self.remaining, remaining)
+            self.reset_at = max(self.reset_at, reset_at)
+
+    def pause(self, seconds: float) -> None:
+        # 二次レート制限 (Retry-After) の場合は全スレッドの送信を止める
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+
+class RepositoryFetcher:
+    # リポジトリ情報を GraphQL のエイリアスでまとめて取得する
+    # バッチは複数スレッドで並行に送信し, レスポンスのコストからバッチの大きさを調整する
+
+    def __init__(
+        self,
+        fields: str,
+        endpoint: str = GITHUB_GRAPHQL_ENDPOINT,
+        token: str | None = None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        batch_size: int = BATCH_SIZE,
+        cache: ResponseCache | None = None,
+    ):
+        self.fields = fields
+        self.endpoint = endpoint
+        self.token = token
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.cache = cache
+        self.rate_limiter = RateLimiter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.clients = []
+
+    def session(self) -> tuple[SyncClientSession, RequestsHTTPTransport]:
+        # requests のセッションはスレッド間で共有せず, スレッド内では接続を使い回す
+        # スキーマは取得しない (取得したスキーマでの検証は行わない)
+        if not hasattr(self.local, "session"):
+            headers = {"Authorization": f"Bearer {self.token}"} if self.token else {}
+            transport = RequestsHTTPTransport(url=self.endpoint, headers=headers)
+            client = Client(transport=transport, fetch_schema_from_transport=False)
+            self.local.transport = transport
+            self.local.session = client.connect_sync()
+            with self.lock:
+                self.clients.append(client)
+        return self.local.session, self.local.transport
+
+    def close(self) -> None:
+        for client in self.clients:
+            client.close_sync()
+        self.clients.clear()
+
+    def query(self, repositories: list[Repository]) -> str:
+        aliases = "".join(
+            f"repository_{i}: repository(owner: {json.dumps(owner)}, "
+            f"name: {json.dumps(name)}) {{ {self.fields} }}\n"
+            for i, (owner, name) in enumerate(repositories)
+        )
+        return f"{{\n{aliases}{RATE_LIMIT_FIELDS}\n}}"
+
+    def fetch(self, repositories: list[Repository]) -> dict[Repository, dict | None]:
+        # キャッシュにあるリポジトリは取得しない
+        results = {}
+        pending = collections.deque()
+        for repository in dict.fromkeys(repositories):
+            data = self.cache.get(repository) if self.cache else None
+            if data is not None:
+                results[repository] = data
+            else:
+                pending.append(repository)
+        logger.info(f"{len(results)} cached, {len(pending)} to fetch.")
+
+        # 各スレッドは待ち行列が空になるまでバッチを取り出して送信する
+        def work() -> None:
+            while True:
+                with self.lock:
+                    if not pending:
+                        return
+                    batch = [
+                        pending.popleft()
+                        for _ in range(min(self.batch_size, len(pending)))
+                    ]
+                for repository, data in self.fetch_batch(batch).items():
+                    results[repository] = data
+                    if data is not None and self.cache:
+                        self.cache.put(repository, data)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+                futures = [executor.submit(work) for _ in range(self.concurrency)]
+                for future in futures:
+                    future.result()
+        finally:
+            self.close()
+
+        return {repository: results[repository] for repository in repositories}
+
+    def fetch_batch(self, batch: list[Repository]) -> dict[Repository, dict | None]:
+        session, transport = self.session()
+        for retry in range(MAX_RETRIES + 1):
+            self.rate_limiter.acquire(TARGET_COST)
+            try:
+                result = session.execute(gql(self.query(batch)))
+            except TransportQueryError as error:
+                # レート制限の場合はリセットまで待ってから再送する
+                if self.is_rate_limited(error.errors) and retry < MAX_RETRIES:
+                    self.handle_rate_limit(transport)
+                    continue
+                if error.data is None or self.is_rate_limited(error.errors):
+                    raise
+                # 存在しないリポジトリなどは null とし, 他のリポジトリの結果は使う
+                logger.warning(f"GraphQL errors: {error.errors}")
+                result = error.data
+            except TransportServerError as error:
+                # 二次レート制限 (403, 429) とタイムアウト (502, 504) は待ってから再送する
+                if retry == MAX_RETRIES or error.code not in (403, 429, 502, 504):
+                    raise
+                if error.code in (403, 429):
+                    self.handle_rate_limit(transport)
+                elif len(batch) > 1:
+                    # 重すぎるクエリはバッチを半分に分けて再送する
+                    half = len(batch) // 2
+                    self.resize(half)
+                    return self.fetch_batch(batch[:half]) | self.fetch_batch(
+                        batch[half:]
+                    )
+                else:
+                    time.sleep(2**retry)
+                continue
+            break
+
+        self.update_rate_limit(transport, result.get("rateLimit"))
+        cost = (result.get("rateLimit") or {}).get("cost")
+        if cost and cost > TARGET_COST:
+            # 目標のコストを超えた場合は, 1 リポジトリあたりのコストから件数を減らす
+            self.resize(len(batch) * TARGET_COST // cost)
+        elif cost and len(batch) >= self.batch_size:
+            # 目標のコストに収まった場合は少しずつ件数を増やす
+            self.resize(len(batch) + max(1, len(batch) // 4))
+        return {
+            repository: result.get(f"repository_{i}")
+            for i, repository in enumerate(batch)
+        }
+
+    def resize(self, batch_size: int) -> None:
+        with self.lock:
+            self.batch_size = max(1, min(MAX_BATCH_SIZE, batch_size))
+
+    @staticmethod
+    def is_rate_limited(errors: list | None) -> bool:
+        return any(error.get("type") == "RATE_LIMITED" for error in errors or [])
+
+    def handle_rate_limit(self, transport: RequestsHTTPTransport) -> None:
+        headers = transport.response_headers or {}
+        if "Retry-After" in headers:
+            self.rate_limiter.pause(float(headers["Retry-After"]))
+        elif headers.get("X-RateLimit-Remaining") == "0":
+            reset_at = float(headers["X-RateLimit-Reset"])
+            self.rate_limiter.pause(reset_at + RESET_MARGIN - time.time())
+        else:
+            # ヘッダーが無い場合は 1 分待つ (GitHub の推奨)
+            self.rate_limiter.pause(60)
+
+    def update_rate_limit(
+        self, transport: RequestsHTTPTransport, rate_limit: dict | None
+    ) -> None:
+        # レスポンスヘッダーを優先し, 無い場合はクエリの rateLimit を使用する
+        headers = transport.response_headers or {}
+        if "X-RateLimit-Remaining" in headers and "X-RateLimit-Reset" in headers:
+            self.rate_limiter.update(
+                int(headers["X-RateLimit-Remaining"]),
+                float(headers["X-RateLimit-Reset"]),
+            )
+        elif rate_limit:
+            self.rate_limiter.update(
+                rate_limit["remaining"],
+                datetime.fromisoformat(rate_limit["resetAt"]).timestamp(),
+            )
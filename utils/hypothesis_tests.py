@@ -0,0 +1,173 @@
+import numpy as np
+import polars as pl
+from scipy.stats import chi2, mannwhitneyu
+
+# 層別の既定 (全体に加えて, プロジェクト毎, fix の有無, メンバーかどうか)
+STRATA = ("project", "fix", "is_member")
+
+
+def get_significance(p: float) -> str:
+    if p >= 0.05:
+        return " "
+    elif p >= 0.01:
+        return "*"
+    elif p >= 0.001:
+        return "**"
+    else:
+        return "***"
+
+
+def significance(p: np.ndarray) -> np.ndarray:
+    # get_significance のベクトル版 (p が NaN の場合は有意としない)
+    return np.select(
+        [~(p < 0.05), p >= 0.01, p >= 0.001],
+        [" ", "*", "**"],
+        default="***",
+    )
+
+
+def strata_codes(df: pl.DataFrame, strata: tuple[str, ...]) -> list[tuple]:
+    # (層の種類, 層の値の配列, 行毎の層の番号) のリスト
+    codes = [("overall", np.array(["all"]), np.zeros(df.height, dtype=np.int64))]
+    for stratum in strata:
+        values, inverse = np.unique(
+            df[stratum].cast(pl.String).to_numpy(), return_inverse=True
+        )
+        codes.append((stratum, values, inverse))
+    return codes
+
+
+def mannwhitneyu_tests(
+    x: np.ndarray, y: np.ndarray, groups: np.ndarray, group_count: int
+) -> dict[str, np.ndarray]:
+    # x: (行, 特徴量), y: 不具合混入の有無, groups: 行毎の層の番号
+    # 層毎に全ての特徴量をまとめて検定する (順位は axis 方向に一度に求める)
+    shape = (group_count, x.shape[1])
+    result = {
+        "n_buggy": np.zeros(group_count, dtype=np.int64),
+        "n_clean": np.zeros(group_count, dtype=np.int64),
+        "statistic": np.full(shape, np.nan),
+        "p_value": np.full(shape, np.nan),
+    }
+    order = np.argsort(groups, kind="stable")
+    bounds = np.searchsorted(groups[order], np.arange(group_count + 1))
+    for group in range(group_count):
+        rows = order[bounds[group] : bounds[group + 1]]
+        buggy, clean = x[rows[y[rows]]], x[rows[~y[rows]]]
+        result["n_buggy"][group], result["n_clean"][group] = len(buggy), len(clean)
+        if len(buggy) == 0 or len(clean) == 0:
+            continue
+        # 小さい層では mannwhitneyu (method="auto") が列毎に行う選択と同じく,
+        # 同順位の無い列は正確検定, ある列は漸近検定でまとめて検定する
+        if len(buggy) > 8 and len(clean) > 8:
+            methods = {"asymptotic": np.ones(x.shape[1], dtype=bool)}
+        else:
+            values = np.sort(np.concatenate([buggy, clean]), axis=0)
+            ties = (values[1:] == values[:-1]).any(axis=0)
+            methods = {"exact": ~ties, "asymptotic": ties}
+        for method, columns in methods.items():
+            if not columns.any():
+                continue
+            statistic, p = mannwhitneyu(
+                buggy[:, columns],
+                clean[:, columns],
+                alternative="two-sided",
+                method=method,
+                axis=0,
+            )
+            result["statistic"][group, columns] = statistic
+            result["p_value"][group, columns] = p
+    n = result["n_buggy"][:, None] * result["n_clean"][:, None]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # rank-biserial 相関 (正の場合は不具合混入が無い方が大きい)
+        result["effect_size"] = 1 - 2 * result["statistic"] / n
+    return result
+
+
+def chi2_tests(
+    x: np.ndarray, y: np.ndarray, groups: np.ndarray, group_count: int
+) -> dict[str, np.ndarray]:
+    # x: (行, 特徴量) の真偽値, 層と特徴量の全ての 2x2 分割表をまとめて検定する
+    # chi2_contingency (correction=True) と同じく Yates の補正を行う
+    cells = groups[:, None] * 4 + x.astype(np.int64) * 2 + y[:, None]
+    observed = (
+        np.stack(
+            [
+                np.bincount(cells[:, j], minlength=group_count * 4)
+                for j in range(x.shape[1])
+            ]
+        )
+        .reshape(x.shape[1], group_count, 2, 2)
+        .transpose(1, 0, 2, 3)
+    )
+    total = observed.sum(axis=(2, 3), keepdims=True)
+    rows = observed.sum(axis=3, keepdims=True)
+    columns = observed.sum(axis=2, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        expected = rows * columns / total
+        diff = expected - observed
+        corrected = observed + np.sign(diff) * np.minimum(0.5, np.abs(diff))
+        statistic = ((corrected - expected) ** 2 / expected).sum(axis=(2, 3))
+    # 行または列が 1 つしか無い分割表は自由度 0 (chi2_contingency と同じく統計量 0, p 値 1)
+    degenerate = (rows == 0).any(axis=(2, 3)) | (columns == 0).any(axis=(2, 3))
+    statistic = np.where(degenerate, 0.0, statistic)
+    p = np.where(degenerate, 1.0, chi2.sf(statistic, 1))
+    total = total[:, :, 0, 0]
+    empty = total == 0
+    return {
+        "n_buggy": observed[:, 0, :, 1].sum(axis=1),
+        "n_clean": observed[:, 0, :, 0].sum(axis=1),
+        "statistic": np.where(empty, np.nan, statistic),
+        "p_value": np.where(empty, np.nan, p),
+        # phi 係数の 2 乗 (χ² / n)
+        "effect_size": np.where(empty, np.nan, statistic / np.maximum(total, 1)),
+    }
+
+
+def run_tests(
+    df: pl.DataFrame,
+    numeric_columns: tuple[str, ...],
+    boolean_columns: tuple[str, ...],
+    strata: tuple[str, ...] = STRATA,
+    target: str = "buggy",
+) -> pl.DataFrame:
+    # 数値特徴量は Mann-Whitney U 検定, 真偽値特徴量はカイ二乗検定を
+    # 全体と各層について行い, (層, 特徴量) 毎に 1 行の表を返す
+    y = df[target].to_numpy().astype(bool)
+    x_numeric = df.select(numeric_columns).to_numpy().astype(np.float64)
+    x_boolean = df.select(boolean_columns).to_numpy().astype(bool)
+
+    frames = []
+    for stratum, values, groups in strata_codes(df, strata):
+        for test, columns, x, run in (
+            ("Mann-Whitney U", numeric_columns, x_numeric, mannwhitneyu_tests),
+            ("Chi-squared", boolean_columns, x_boolean, chi2_tests),
+        ):
+            if not columns:
+                continue
+            result = run(x, y, groups, len(values))
+            group_index = np.repeat(np.arange(len(values)), len(columns))
+            frames.append(
+                pl.DataFrame(
+                    {
+                        "stratum": stratum,
+                        "value": values[group_index],
+                        "feature": np.tile(columns, len(values)),
+                        "test": test,
+                        "n_buggy": result["n_buggy"][group_index],
+                        "n_clean": result["n_clean"][group_index],
+                        "statistic": result["statistic"].ravel(),
+                        "p_value": result["p_value"].ravel(),
+                        "effect_size": result["effect_size"].ravel(),
+                    }
+                )
+            )
+
+    results = pl.concat(frames)
+    # 層の変数と同じ特徴量 (例: fix で層別した fix) は除く
+    results = results.filter(pl.col("stratum") != pl.col("feature"))
+    # 不具合混入の有無の一方しか無い層は検定できないため除く
+    results = results.filter((pl.col("n_buggy") > 0) & (pl.col("n_clean") > 0))
+    return results.with_columns(
+        significant=pl.Series(significance(results["p_value"].to_numpy()))
+    )
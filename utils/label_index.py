@@ -0,0 +1,130 @@
+import os
+from typing import Iterable
+
+import numpy as np
+from bson import ObjectId
+from pycoshark.mongomodels import Commit, FileAction, Project, VCSSystem
+
+from utils.chunked_query import fetch_in_chunks
+
+# bug-fixing のラベル (commit.labels のキー)
+# bug-inducing のラベル (FileAction.induces の label) はこの後ろに出現順で追加される
+FIXING_LABELS = ("adjustedszz_bugfix", "issueonly_bugfix", "validated_bugfix")
+
+# マスクのビット数
+MAX_LABELS = 64
+
+
+def index_path(index_dir: str, project_name: str) -> str:
+    return os.path.join(index_dir, f"{project_name}.npz")
+
+
+class LabelIndex:
+    # commit_id (ObjectId の 12 バイト, 昇順) とラベルのビットマスクの対応表
+    # labels[i] が i ビット目に対応する
+
+    def __init__(self, commit_ids: np.ndarray, masks: np.ndarray, labels: list[str]):
+        self.commit_ids = commit_ids
+        self.masks = masks
+        self.labels = list(labels)
+
+    def __len__(self) -> int:
+        return len(self.commit_ids)
+
+    @property
+    def inducing_labels(self) -> list[str]:
+        return self.labels[len(FIXING_LABELS) :]
+
+    def mask(self, *labels: str) -> int:
+        # 索引に存在しないラベルは 0 ビットとして扱う
+        mask = 0
+        for label in labels:
+            if label in self.labels:
+                mask |= 1 << self.labels.index(label)
+        return mask
+
+    def has(self, masks: np.ndarray, *labels: str) -> np.ndarray:
+        # いずれかのラベルを持つかどうか
+        return (masks & np.uint64(self.mask(*labels))) != 0
+
+    def lookup(self, commit_ids: Iterable[ObjectId]) -> np.ndarray:
+        # 索引に存在しない commit は 0 (ラベルなし) を返す
+        keys = np.array([commit_id.binary for commit_id in commit_ids], dtype="S12")
+        if not len(self.commit_ids):
+            return np.zeros(len(keys), dtype=np.uint64)
+        positions = np.searchsorted(self.commit_ids, keys)
+        positions[positions == len(self.commit_ids)] = 0
+        found = self.commit_ids[positions] == keys
+        return np.where(found, self.masks[positions], np.uint64(0))
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # 書き込み途中で中断しても壊れた索引が残らないように置き換える
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                commit_ids=self.commit_ids,
+                masks=self.masks,
+                labels=np.array(self.labels, dtype=str),
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LabelIndex":
+        with np.load(path) as data:
+            return cls(data["commit_ids"], data["masks"], data["labels"].tolist())
+
+    @classmethod
+    def build(cls, project: Project) -> "LabelIndex":
+        labels = list(FIXING_LABELS)
+        masks = {}
+
+        # bug-fixing のラベルを commit から取得
+        vcs_system_ids = VCSSystem.objects(project_id=project.id).scalar("id")
+        commits = (
+            Commit.objects(vcs_system_id__in=list(vcs_system_ids))
+            .only("id", "labels")
+            .as_pymongo()
+        )
+        for commit in commits:
+            mask = 0
+            commit_labels = commit.get("labels") or {}
+            for bit, label in enumerate(FIXING_LABELS):
+                if commit_labels.get(label, False):
+                    mask |= 1 << bit
+            masks[commit["_id"]] = mask
+
+        # bug-inducing のラベルを file_action から取得
+        file_actions = fetch_in_chunks(
+            FileAction.objects.only("commit_id", "induces").as_pymongo(),
+            "commit_id",
+            list(masks),
+        )
+        for file_action in file_actions:
+            for induce in file_action.get("induces") or []:
+                label = induce["label"]
+                if label not in labels:
+                    if len(labels) == MAX_LABELS:
+                        raise ValueError(f"Too many labels in {project.name}")
+                    labels.append(label)
+                masks[file_action["commit_id"]] |= 1 << labels.index(label)
+
+        # commit_id の昇順に並べる (lookup で二分探索するため)
+        commit_ids = np.array([commit_id.binary for commit_id in masks], dtype="S12")
+        order = np.argsort(commit_ids, kind="stable")
+        return cls(
+            commit_ids[order],
+            np.array(list(masks.values()), dtype=np.uint64)[order],
+            labels,
+        )
+
+
+def load_or_build(project: Project, index_dir: str) -> LabelIndex:
+    # 索引が無い場合のみ DB から作成して保存
+    path = index_path(index_dir, project.name)
+    if os.path.exists(path):
+        return LabelIndex.load(path)
+    label_index = LabelIndex.build(project)
+    label_index.save(path)
+    return label_index
@@ -0,0 +1,76 @@
+import os
+import threading
+
+from mongoengine import connect, disconnect
+from pycoshark.utils import create_mongodb_uri_string
+from pymongo import MongoClient
+
+from utils.query_cache import install_from_env
+
+# 接続プールの設定 (プロセス内の全スレッドで 1 つのプールを共有する)
+# maxPoolSize は worker 数 (既定 16) と asyncio の同時実行数を賄える大きさにする
+MAX_POOL_SIZE = 64
+MIN_POOL_SIZE = 4
+# 使われていない接続を閉じるまでの時間 (ミリ秒)
+MAX_IDLE_TIME_MS = 5 * 60 * 1000
+# asyncio で同時に発行するクエリの最大数 (プロセス全体)
+# utils.async_mongo は motor を読み込むため, 引数の既定値に使えるようにここに置く
+DEFAULT_CONCURRENCY = 64
+
+_lock = threading.Lock()
+_client = None
+# 接続しているデータベース名
+_database = None
+
+
+def mongodb_uri() -> str:
+    return create_mongodb_uri_string(
+        db_user=os.getenv("SMARTSHARK_DB_USERNAME"),
+        db_password=os.getenv("SMARTSHARK_DB_PASSWORD"),
+        db_hostname=os.getenv("SMARTSHARK_DB_HOST"),
+        db_port=os.getenv("SMARTSHARK_DB_PORT"),
+        db_authentication_database=os.getenv("SMARTSHARK_DB_AUTHENTICATION_DATABASE"),
+        db_ssl_enabled=False,
+    )
+
+
+def is_production_database(database: str) -> bool:
+    # 抽出スクリプトが読み込むデータベース (SMARTSHARK_DB_DATABASE) かどうか
+    # 合成データの生成やベンチマークなど, データベースを削除・追加するものは使わない
+    return database == os.getenv("SMARTSHARK_DB_DATABASE")
+
+
+def connect_to_mongodb(db: str | None = None) -> MongoClient:
+    # プロセス内で最初の呼び出しのみ接続し, 以降は同じクライアントを返す
+    # (MongoClient はスレッドセーフで, 各操作はプールから接続を借りて返す)
+    # mongoengine はセッションを明示的に渡せないため, 各操作は暗黙のセッションで実行される
+    # 接続済みのデータベースと異なる db を指定した場合は, 別のデータベースを読まないように中断する
+    global _client, _database
+    with _lock:
+        if _client is None:
+            _database = db or os.getenv("SMARTSHARK_DB_DATABASE")
+            _client = connect(
+                db=_database,
+                host=mongodb_uri(),
+                maxPoolSize=MAX_POOL_SIZE,
+                minPoolSize=MIN_POOL_SIZE,
+                maxIdleTimeMS=MAX_IDLE_TIME_MS,
+            )
+            # SMARTSHARK_QUERY_CACHE が設定されている場合はクエリの結果をキャッシュする
+            install_from_env()
+        elif db is not None and db != _database:
+            raise ValueError(
+                f"Already connected to {_database}; "
+                f"call close_mongodb() before connecting to {db}"
+            )
+        return _client
+
+
+def close_mongodb() -> None:
+    # プロセスの終了時に 1 度だけ呼び出す (worker 毎には閉じない)
+    global _client, _database
+    with _lock:
+        if _client is not None:
+            disconnect()
+            _client = None
+            _database = None
@@ -0,0 +1,47 @@
+import os
+import shutil
+
+import polars as pl
+
+
+def default_parts_dir(output: str) -> str:
+    # 出力ファイル毎にパートファイルを分ける (例: data/foo.csv -> data/foo.parts)
+    return os.path.splitext(output)[0] + ".parts"
+
+
+def scan_part(path: str) -> pl.LazyFrame:
+    if path.endswith(".parquet"):
+        return pl.scan_parquet(path)
+    return pl.scan_ipc(path)
+
+
+def scan_parts(paths: list[str]) -> pl.LazyFrame:
+    # スキーマの統一は最後に一度だけ行う (欠けた列は null, 型は上位の型に揃える)
+    frames = [scan_part(path) for path in paths]
+    if not frames:
+        return pl.LazyFrame()
+    return pl.concat(frames, how="diagonal_relaxed")
+
+
+class PartWriter:
+    # 結果を受け取る度に <directory>/part-<n>.arrow (Arrow IPC) として書き出す
+    # 結果をメモリに溜めず, 結合は scan() で一度だけ行う
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.paths = []
+        # 前回の実行で残ったパートファイルは使わない
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+    def write(self, df: pl.DataFrame) -> str:
+        path = os.path.join(self.directory, f"part-{len(self.paths):06d}.arrow")
+        df.write_ipc(path, compression="zstd")
+        self.paths.append(path)
+        return path
+
+    def scan(self) -> pl.LazyFrame:
+        return scan_parts(self.paths)
+
+    def remove(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
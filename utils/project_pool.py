@@ -0,0 +1,67 @@
+import concurrent.futures
+import io
+import multiprocessing
+import time
+from typing import Callable
+
+import polars as pl
+
+EXECUTORS = ("thread", "process")
+
+
+def _run_timed(fn: Callable[..., pl.DataFrame], *args) -> tuple[pl.DataFrame, float]:
+    # 待ち時間を含めない処理時間 (秒) を結果と合わせて返す
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _run_in_process(fn: Callable[..., pl.DataFrame], *args) -> tuple[bytes, float]:
+    # DataFrame を pickle せず Arrow IPC のバイト列として親プロセスに返す
+    result, seconds = _run_timed(fn, *args)
+    buffer = io.BytesIO()
+    result.write_ipc(buffer)
+    return buffer.getvalue(), seconds
+
+
+class ProjectPool:
+    # プロジェクト毎の worker をスレッドまたはプロセスで並行実行する
+    # process の場合は spawn で起動するため, 親の MongoClient を子に複製しない
+    # (worker は各プロセス内で connect_to_mongodb() により接続し直す)
+
+    def __init__(self, executor: str = "thread", workers: int = 16):
+        if executor not in EXECUTORS:
+            raise ValueError(f"Unknown executor: {executor}")
+        self.executor = executor
+        # future -> 処理時間 (秒)
+        self.seconds = {}
+        if executor == "process":
+            self.pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.pool.shutdown(wait=True)
+
+    def submit(
+        self, fn: Callable[..., pl.DataFrame], *args
+    ) -> concurrent.futures.Future:
+        if self.executor == "process":
+            return self.pool.submit(_run_in_process, fn, *args)
+        return self.pool.submit(_run_timed, fn, *args)
+
+    def result(self, future: concurrent.futures.Future) -> pl.DataFrame:
+        result, self.seconds[future] = future.result()
+        if self.executor == "process":
+            return pl.read_ipc(io.BytesIO(result))
+        return result
+
+    def elapsed(self, future: concurrent.futures.Future) -> float:
+        # result() の後に呼び出す
+        return self.seconds.pop(future)
@@ -0,0 +1,497 @@
+import argparse
+import hashlib
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from logging import basicConfig, getLogger
+
+import bson
+from mongoengine import Document
+from mongoengine.queryset import QuerySet
+from pycoshark import mongomodels
+from pymongo.collection import Collection
+
+logger = getLogger(__name__)
+
+# キャッシュの場所と容量 (バイト) は環境変数で指定する
+# SMARTSHARK_QUERY_CACHE が設定されている場合のみ connect_to_mongodb() で有効になる
+QUERY_CACHE_ENV = "SMARTSHARK_QUERY_CACHE"
+QUERY_CACHE_BYTES_ENV = "SMARTSHARK_QUERY_CACHE_BYTES"
+DEFAULT_MAX_BYTES = 4 * 1024**3
+# find の結果がこの件数を超える場合はキャッシュせず, 通常の Cursor と同様に順に読み出す
+# (全件を 1 つのリストと圧縮した BSON にするとメモリの使用量が大きくなるため)
+QUERY_CACHE_DOCUMENTS_ENV = "SMARTSHARK_QUERY_CACHE_DOCUMENTS"
+DEFAULT_MAX_DOCUMENTS = 50000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    collection TEXT NOT NULL,
+    value BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE INDEX IF NOT EXISTS entries_collection ON entries (collection);
+CREATE TABLE IF NOT EXISTS fingerprints (
+    collection TEXT PRIMARY KEY,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta VALUES ('bytes', 0);
+"""
+
+# install_query_cache() で設定される (プロセス毎)
+_query_cache = None
+
+
+def encode(value) -> bytes:
+    # 結果は BSON にして圧縮する (ObjectId や datetime をそのまま保存できる)
+    return zlib.compress(bson.encode({"value": value}), 1)
+
+
+def decode(blob: bytes):
+    return bson.decode(zlib.decompress(blob))["value"]
+
+
+class QueryCache:
+    # クエリの結果を <directory>/query_cache.sqlite3 に保存する
+    # 合計が max_bytes を超えた場合は最後に使われた時刻が古いものから削除する (LRU)
+    # コレクションの件数と最大の _id が変わった場合はそのコレクションのエントリを破棄する
+    # (件数と最大の _id は変わらないため, ラベルの付け直しなど既存のドキュメントの更新は
+    #  検出できない. データベースを更新した場合は --clear で破棄する)
+
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        max_documents: int = DEFAULT_MAX_DOCUMENTS,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_documents = max_documents
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        # 検証済みのコレクション (プロセス内で 1 度だけ検証する)
+        self.validated = set()
+        os.makedirs(directory, exist_ok=True)
+        self.connection().executescript(SCHEMA)
+
+    def path(self) -> str:
+        return os.path.join(self.directory, "query_cache.sqlite3")
+
+    def connection(self) -> sqlite3.Connection:
+        # sqlite3 の接続はスレッド間で共有しない
+        if not hasattr(self.local, "connection"):
+            connection = sqlite3.connect(self.path(), timeout=60, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return self.local.connection
+
+    @staticmethod
+    def key(kind: str, collection: Collection, **query) -> str:
+        # コレクション名とクエリ (filter, projection, sort など) から求める
+        son = {"kind": kind, "collection": collection.name, **query}
+        return hashlib.sha256(bson.encode(son)).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        connection = self.connection()
+        row = connection.execute(
+            "SELECT value FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        connection.execute(
+            "UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return row[0]
+
+    def put(self, key: str, collection: Collection, value: bytes) -> None:
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT size FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (key, collection.name, value, len(value), time.time()),
+            )
+            connection.execute(
+                "UPDATE meta SET value = value + ? WHERE name = 'bytes'",
+                (len(value) - (row[0] if row else 0),),
+            )
+            self.evict(connection)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def evict(self, connection: sqlite3.Connection) -> None:
+        # 容量を超えた分だけ古いものから削除する (put のトランザクション内で呼び出す)
+        (total,) = connection.execute(
+            "SELECT value FROM meta WHERE name = 'bytes'"
+        ).fetchone()
+        excess = total - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in connection.execute(
+            "SELECT key, size FROM entries ORDER BY last_used"
+        ):
+            keys.append(key)
+            excess -= size
+            if excess <= 0:
+                break
+        connection.executemany(
+            "DELETE FROM entries WHERE key = ?", [(key,) for key in keys]
+        )
+        connection.execute(
+            "UPDATE meta SET value = (SELECT COALESCE(SUM(size), 0) FROM entries) "
+            "WHERE name = 'bytes'"
+        )
+
+    def load(self, key: str, collection: Collection, fetch):
+        # キャッシュに無い場合は fetch() の結果を保存して返す
+        self.validate(collection)
+        blob = self.get(key)
+        if blob is not None:
+            return decode(blob)
+        value = fetch()
+        self.put(key, collection, encode(value))
+        return value
+
+    def validate(self, collection: Collection) -> None:
+        # データベースが変わった (スナップショットを入れ替えた) 場合は古いエントリを破棄する
+        with self.lock:
+            if collection.name in self.validated:
+                return
+            last = next(collection.find({}, {"_id": 1}).sort("_id", -1).limit(1), None)
+            fingerprint = (
+                f"{collection.estimated_document_count()}:{last and last['_id']}"
+            )
+            connection = self.connection()
+            row = connection.execute(
+                "SELECT fingerprint FROM fingerprints WHERE collection = ?",
+                (collection.name,),
+            ).fetchone()
+            if row is None or row[0] != fingerprint:
+                if row is not None:
+                    logger.info(f"{collection.name} changed. Invalidating the cache.")
+                self.invalidate(collection.name)
+                connection.execute(
+                    "INSERT OR REPLACE INTO fingerprints VALUES (?, ?)",
+                    (collection.name, fingerprint),
+                )
+            self.validated.add(collection.name)
+
+    def invalidate(self, collection_name: str | None = None) -> None:
+        # collection_name を省略した場合は全て破棄する
+        connection = self.connection()
+        if collection_name is None:
+            connection.execute("DELETE FROM entries")
+            connection.execute("DELETE FROM fingerprints")
+            self.validated.clear()
+        else:
+            connection.execute(
+                "DELETE FROM entries WHERE collection = ?", (collection_name,)
+            )
+        connection.execute(
+            "UPDATE meta SET value = (SELECT COALESCE(SUM(size), 0) FROM entries) "
+            "WHERE name = 'bytes'"
+        )
+        if collection_name is not None:
+            self.validated.discard(collection_name)
+
+    def stats(self) -> list[tuple[str, int, int]]:
+        # コレクション毎の (エントリ数, バイト数)
+        return (
+            self.connection()
+            .execute(
+                "SELECT collection, COUNT(*), SUM(size) FROM entries "
+                "GROUP BY collection ORDER BY collection"
+            )
+            .fetchall()
+        )
+
+
+class CachedCursor:
+    # QuerySet から pymongo の Cursor の代わりに使われる
+    # sort, skip, limit などはクエリの条件として記録し, 最初に読み出す時に全件をキャッシュから取得する
+    # キャッシュに無い場合は max_documents 件まで読み込み, それを超える結果はキャッシュせずに
+    # 残りを Cursor から順に読み出す
+
+    def __init__(
+        self,
+        cache: QueryCache,
+        collection: Collection,
+        filter: dict,
+        projection: dict | None = None,
+    ):
+        self.cache = cache
+        self.collection = collection
+        self.filter = filter
+        self.projection = projection
+        self.sort_keys = None
+        self.skip_count = 0
+        self.limit_count = 0
+        self.hint_index = None
+        self.documents = None
+        self.index = 0
+        # キャッシュしない (件数が多い) 結果の残りを読み出す Cursor
+        self.stream = None
+
+    def clone(self) -> "CachedCursor":
+        cursor = CachedCursor(self.cache, self.collection, self.filter, self.projection)
+        cursor.sort_keys = self.sort_keys
+        cursor.skip_count = self.skip_count
+        cursor.limit_count = self.limit_count
+        cursor.hint_index = self.hint_index
+        return cursor
+
+    def sort(self, key_or_list, direction=None) -> "CachedCursor":
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, direction or 1)]
+        self.sort_keys = list(key_or_list)
+        return self.rewind(reset=True)
+
+    def skip(self, skip: int) -> "CachedCursor":
+        self.skip_count = skip
+        return self.rewind(reset=True)
+
+    def limit(self, limit: int) -> "CachedCursor":
+        self.limit_count = limit
+        return self.rewind(reset=True)
+
+    def hint(self, index) -> "CachedCursor":
+        self.hint_index = index
+        return self.rewind(reset=True)
+
+    def batch_size(self, batch_size: int) -> "CachedCursor":
+        # 結果には影響しない
+        return self
+
+    def comment(self, comment) -> "CachedCursor":
+        return self
+
+    def rewind(self, reset: bool = False) -> "CachedCursor":
+        self.index = 0
+        # 順に読み出した結果は保持していないため, クエリからやり直す
+        if reset or self.stream is not None:
+            self.close()
+            self.documents = None
+        return self
+
+    def close(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def query(self) -> dict:
+        return {
+            "filter": self.filter,
+            "projection": self.projection,
+            "sort": self.sort_keys,
+            "skip": self.skip_count,
+            "limit": self.limit_count,
+            "hint": self.hint_index,
+        }
+
+    def find(self):
+        cursor = self.collection.find(self.filter, self.projection)
+        if self.sort_keys:
+            cursor = cursor.sort(self.sort_keys)
+        if self.skip_count:
+            cursor = cursor.skip(self.skip_count)
+        if self.limit_count:
+            cursor = cursor.limit(self.limit_count)
+        if self.hint_index is not None:
+            cursor = cursor.hint(self.hint_index)
+        return cursor
+
+    def load(self) -> list[dict]:
+        key = self.cache.key("find", self.collection, **self.query())
+        self.cache.validate(self.collection)
+        blob = self.cache.get(key)
+        if blob is not None:
+            return decode(blob)
+        cursor = self.find()
+        documents = list(itertools.islice(cursor, self.cache.max_documents + 1))
+        if len(documents) > self.cache.max_documents:
+            self.stream = cursor
+            return documents
+        self.cache.put(key, self.collection, encode(documents))
+        return documents
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> dict:
+        if self.documents is None:
+            self.documents = self.load()
+        if self.index < len(self.documents):
+            self.index += 1
+            return self.documents[self.index - 1]
+        if self.stream is None:
+            raise StopIteration
+        # 読み込み済みの分は不要になるため解放する
+        self.documents = []
+        self.index = 0
+        return next(self.stream)
+
+    def __getitem__(self, index):
+        # pymongo と同様に, 整数の場合は skip からの位置, スライスの場合は skip と limit を置き換える
+        cursor = self.clone()
+        if isinstance(index, slice):
+            cursor.skip_count = index.start or 0
+            cursor.limit_count = (
+                index.stop - cursor.skip_count if index.stop is not None else 0
+            )
+            return cursor
+        cursor.skip_count = self.skip_count + index
+        cursor.limit_count = 1
+        for document in cursor:
+            return document
+        raise IndexError("no such item for Cursor instance")
+
+    def distinct(self, key: str) -> list:
+        query = {"filter": self.filter, "distinct": key}
+        return self.cache.load(
+            self.cache.key("distinct", self.collection, **query),
+            self.collection,
+            lambda: self.collection.distinct(key, self.filter),
+        )
+
+    def explain(self) -> dict:
+        return self.collection.find(self.filter, self.projection).explain()
+
+
+class CachedQuerySet(QuerySet):
+    # find と count の結果をキャッシュする QuerySet
+    # キャッシュの条件に含められない指定 (where, collation など) がある場合は通常通り実行する
+
+    def _cacheable(self) -> bool:
+        return (
+            _query_cache is not None
+            and not self._where_clause
+            and self._collation is None
+            and self._read_preference is None
+            and self._read_concern is None
+            and not self._search_text
+        )
+
+    @property
+    def _cursor(self):
+        if self._cursor_obj is not None or not self._cacheable():
+            return super()._cursor
+
+        cursor = CachedCursor(
+            _query_cache,
+            self._collection,
+            self._query,
+            self._cursor_args.get("projection"),
+        )
+        if self._ordering:
+            cursor.sort(self._ordering)
+        elif self._ordering is None and self._document._meta["ordering"]:
+            cursor.sort(self._get_order_by(self._document._meta["ordering"]))
+        if self._limit is not None:
+            cursor.limit(self._limit)
+        if self._skip is not None:
+            cursor.skip(self._skip)
+        if self._hint != -1:
+            cursor.hint(self._hint)
+        self._cursor_obj = cursor
+        return self._cursor_obj
+
+    def count(self, with_limit_and_skip=False):
+        if not self._cacheable():
+            return super().count(with_limit_and_skip)
+        query = {"filter": self._query, "hint": self._hint}
+        if with_limit_and_skip:
+            query.update(skip=self._skip, limit=self._limit)
+        return _query_cache.load(
+            _query_cache.key("count", self._collection, **query),
+            self._collection,
+            lambda: QuerySet.count(self, with_limit_and_skip),
+        )
+
+
+def documents() -> list[type[Document]]:
+    return [
+        document
+        for document in vars(mongomodels).values()
+        if isinstance(document, type)
+        and issubclass(document, Document)
+        and not document._meta.get("abstract")
+    ]
+
+
+def install_query_cache(
+    directory: str,
+    max_bytes: int = DEFAULT_MAX_BYTES,
+    max_documents: int = DEFAULT_MAX_DOCUMENTS,
+) -> QueryCache:
+    # pycoshark の全ての Document の objects を CachedQuerySet にする
+    global _query_cache
+    _query_cache = QueryCache(directory, max_bytes, max_documents)
+    for document in documents():
+        document._meta["queryset_class"] = CachedQuerySet
+    return _query_cache
+
+
+def uninstall_query_cache() -> None:
+    global _query_cache
+    _query_cache = None
+    for document in documents():
+        document._meta.pop("queryset_class", None)
+
+
+def install_from_env() -> QueryCache | None:
+    directory = os.getenv(QUERY_CACHE_ENV)
+    if not directory:
+        return None
+    max_bytes = int(os.getenv(QUERY_CACHE_BYTES_ENV, DEFAULT_MAX_BYTES))
+    max_documents = int(os.getenv(QUERY_CACHE_DOCUMENTS_ENV, DEFAULT_MAX_DOCUMENTS))
+    logger.info(f"Query cache: {directory} ({max_bytes / 1024**3:.1f} GiB)")
+    return install_query_cache(directory, max_bytes, max_documents)
+
+
+def main(args):
+    cache = QueryCache(args.directory, args.max_bytes)
+    if args.clear is not None:
+        # コレクション名を省略した場合は全て破棄する
+        for collection_name in args.clear or [None]:
+            cache.invalidate(collection_name)
+    for collection_name, count, size in cache.stats():
+        logger.info(f"{collection_name}: {count} entries, {size / 1024**2:.1f} MiB")
+
+
+if __name__ == "__main__":
+    basicConfig(
+        level="INFO",
+        format="[%(asctime)s] [%(levelname)s] %(message)s",
+    )
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d", "--directory", type=str, default=os.getenv(QUERY_CACHE_ENV)
+    )
+    parser.add_argument(
+        "--max-bytes",
+        type=int,
+        default=int(os.getenv(QUERY_CACHE_BYTES_ENV, DEFAULT_MAX_BYTES)),
+    )
+    parser.add_argument("--clear", nargs="*", default=None)
+    args = parser.parse_args()
+    if not args.directory:
+        parser.error(f"--directory or {QUERY_CACHE_ENV} is required")
+
+    main(args)
@@ -0,0 +1,190 @@
+import contextlib
+import contextvars
+import json
+import threading
+import time
+from collections import defaultdict
+
+import bson
+from pymongo import monitoring
+
+# レイテンシのヒストグラムの境界 (ミリ秒)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# プロジェクト外 (main でのプロジェクト一覧の取得など) のクエリの集計先
+MAIN_SCOPE = "(main)"
+
+# 実行中のスレッドが処理しているプロジェクト
+_current_project = contextvars.ContextVar("current_project", default=MAIN_SCOPE)
+
+# install_profiler() で登録したプロファイラ
+_profiler = None
+
+
+def _latency_bucket(duration_ms: float) -> str:
+    for bound in LATENCY_BUCKETS_MS:
+        if duration_ms <= bound:
+            return f"<={bound}ms"
+    return f">{LATENCY_BUCKETS_MS[-1]}ms"
+
+
+def _new_stats() -> dict:
+    return {
+        "commands": 0,
+        "failures": 0,
+        "documents": 0,
+        "bytes": 0,
+        "mongo_seconds": 0.0,
+        "latency_histogram": defaultdict(int),
+    }
+
+
+class QueryProfiler(monitoring.CommandListener):
+    # pymongo のコマンド監視でプロジェクト毎, コレクション毎, コマンド毎に集計する
+    # 応答のバイト数は応答を BSON にし直して数えるため, 計測時間への影響が大きい.
+    # count_bytes=True の場合のみ数える
+
+    def __init__(self, count_bytes: bool = False):
+        self.count_bytes = count_bytes
+        self.lock = threading.Lock()
+        self.pending = {}
+        # project -> collection -> command -> stats
+        self.stats = defaultdict(lambda: defaultdict(lambda: defaultdict(_new_stats)))
+        # project -> 処理時間 (秒)
+        self.wall_seconds = defaultdict(float)
+
+    # ========================================
+    # コマンド監視
+    # ========================================
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = event.command.get("collection")
+        if not isinstance(collection, str):
+            collection = "(none)"
+        with self.lock:
+            self.pending[(event.connection_id, event.request_id)] = (
+                _current_project.get(),
+                collection,
+                event.command_name,
+            )
+
+    def succeeded(self, event):
+        # 返却されたドキュメント数 (find, aggregate, getMore のカーソル)
+        cursor = event.reply.get("cursor") or {}
+        documents = len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        size = len(bson.encode(event.reply)) if self.count_bytes else 0
+        self._record(event, documents=documents, size=size, failed=False)
+
+    def failed(self, event):
+        self._record(event, documents=0, size=0, failed=True)
+
+    def _record(self, event, documents: int, size: int, failed: bool):
+        with self.lock:
+            key = self.pending.pop((event.connection_id, event.request_id), None)
+            if key is None:
+                return
+            project, collection, command = key
+            stats = self.stats[project][collection][command]
+            stats["commands"] += 1
+            stats["failures"] += failed
+            stats["documents"] += documents
+            stats["bytes"] += size
+            stats["mongo_seconds"] += event.duration_micros / 1_000_000
+            stats["latency_histogram"][
+                _latency_bucket(event.duration_micros / 1000)
+            ] += 1
+
+    # ========================================
+    # プロジェクト単位の計測
+    # ========================================
+    @contextlib.contextmanager
+    def project(self, project_name: str):
+        token = _current_project.set(project_name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            _current_project.reset(token)
+            with self.lock:
+                self.wall_seconds[project_name] += elapsed
+
+    # ========================================
+    # レポート
+    # ========================================
+    def report(self) -> dict:
+        with self.lock:
+            projects = {}
+            for project in self.stats.keys() | self.wall_seconds.keys():
+                collections = {
+                    collection: {
+                        command: self._format(stats)
+                        for command, stats in commands.items()
+                    }
+                    for collection, commands in self.stats[project].items()
+                }
+                mongo_seconds = sum(
+                    stats["mongo_seconds"]
+                    for commands in collections.values()
+                    for stats in commands.values()
+                )
+                wall_seconds = self.wall_seconds.get(project)
+                projects[project] = {
+                    "wall_seconds": wall_seconds,
+                    "mongo_seconds": mongo_seconds,
+                    # Python 側の処理時間 (プロジェクト単位で計測した場合のみ)
+                    "python_seconds": (
+                        max(wall_seconds - mongo_seconds, 0.0)
+                        if wall_seconds is not None
+                        else None
+                    ),
+                    "collections": collections,
+                }
+
+        # クエリの種類 (collection.command) 毎の合計
+        shapes = defaultdict(_new_stats)
+        for project in projects.values():
+            for collection, commands in project["collections"].items():
+                for command, stats in commands.items():
+                    total = shapes[f"{collection}.{command}"]
+                    for field in ("commands", "failures", "documents", "bytes"):
+                        total[field] += stats.get(field, 0)
+                    total["mongo_seconds"] += stats["mongo_seconds"]
+                    for bucket, count in stats["latency_histogram"].items():
+                        total["latency_histogram"][bucket] += count
+        shapes = {
+            shape: self._format(stats)
+            for shape, stats in sorted(
+                shapes.items(), key=lambda item: -item[1]["mongo_seconds"]
+            )
+        }
+
+        return {"projects": projects, "shapes": shapes}
+
+    def _format(self, stats: dict) -> dict:
+        # 数えていないバイト数は出力しない
+        stats = {**stats, "latency_histogram": dict(stats["latency_histogram"])}
+        if not self.count_bytes:
+            stats.pop("bytes")
+        return stats
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, ensure_ascii=False)
+
+
+def install_profiler(count_bytes: bool = False) -> QueryProfiler:
+    # MongoClient を作成する前に呼び出す (登録後に作成したクライアントのみ監視される)
+    global _profiler
+    if _profiler is None:
+        _profiler = QueryProfiler(count_bytes)
+        monitoring.register(_profiler)
+    return _profiler
+
+
+def profile_project(project_name: str):
+    # プロファイラを登録していない場合は何もしない
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.project(project_name)
@@ -0,0 +1,78 @@
+import statistics
+
+import polars as pl
+from pycoshark.mongomodels import (
+    Commit,
+    Project,
+    PullRequest,
+    PullRequestSystem,
+    VCSSystem,
+)
+
+from utils.snapshot import scan
+
+
+def count_costs(
+    projects: list[Project], snapshot_dir: str | None = None
+) -> dict[str, int]:
+    # コミット数とマージされたプルリクエスト数の和を処理量の目安とする
+    # (DB の場合は索引のみで数えられる count を使用する)
+    costs = {}
+    for project in projects:
+        if snapshot_dir:
+            commit_count = scan(snapshot_dir, Commit, project.name).select(pl.len())
+            merged_count = (
+                scan(snapshot_dir, PullRequest, project.name)
+                .filter(pl.col("merged_at").is_not_null())
+                .select(pl.len())
+            )
+            costs[project.name] = (
+                commit_count.collect().item() + merged_count.collect().item()
+            )
+            continue
+
+        vcs_system_ids = list(VCSSystem.objects(project_id=project.id).scalar("id"))
+        pull_request_system_ids = list(
+            PullRequestSystem.objects(project_id=project.id).scalar("id")
+        )
+        costs[project.name] = (
+            Commit.objects(vcs_system_id__in=vcs_system_ids).count()
+            + PullRequest.objects(
+                pull_request_system_id__in=pull_request_system_ids,
+                merged_at__exists=True,
+            ).count()
+        )
+    return costs
+
+
+def estimate_costs(
+    projects: list[Project],
+    timings: dict[str, float],
+    snapshot_dir: str | None = None,
+) -> dict[str, float]:
+    # 前回の処理時間 (秒) が全プロジェクトにある場合はそのまま使用する
+    if all(project.name in timings for project in projects):
+        return {project.name: timings[project.name] for project in projects}
+
+    # 無いプロジェクトがある場合は件数から見積もる
+    # 処理時間があるプロジェクトから 1 件あたりの秒数を求めて単位を揃える
+    counts = count_costs(projects, snapshot_dir)
+    rates = [
+        timings[name] / count
+        for name, count in counts.items()
+        if name in timings and count
+    ]
+    if not rates:
+        return {name: float(count) for name, count in counts.items()}
+    rate = statistics.median(rates)
+    return {name: timings.get(name, count * rate) for name, count in counts.items()}
+
+
+def largest_first(
+    projects: list[Project],
+    timings: dict[str, float] | None = None,
+    snapshot_dir: str | None = None,
+) -> list[Project]:
+    # 見積もりの大きい順に並べる (同じ見積もりの場合は元の順序を保つ)
+    costs = estimate_costs(projects, timings or {}, snapshot_dir)
+    return sorted(projects, key=lambda project: -costs[project.name])
@@ -0,0 +1,207 @@
+import concurrent.futures
+import json
+import multiprocessing
+import os
+from logging import getLogger
+
+import joblib
+import numpy as np
+import pandas as pd
+import shap
+from sklearn.base import BaseEstimator, clone
+
+logger = getLogger(__name__)
+
+# 1 回の shap_values で計算する行数 (メモリに載せるのは各プロセスでこの行数分のみ)
+BATCH_SIZE = 1000
+# キャッシュの形式を変えた場合は上げる (古いキャッシュを使わないようにする)
+CACHE_VERSION = 1
+
+# ワーカープロセス毎の TreeExplainer (_init_worker で作成する)
+_explainer = None
+
+
+def default_cache_dir() -> str:
+    return os.path.join("data", "shap_cache")
+
+
+# 学習済みモデルのハッシュに使う TreeExplainer 内部の木の配列
+TREE_ATTRIBUTES = (
+    "children_left",
+    "children_right",
+    "children_default",
+    "features",
+    "thresholds",
+    "values",
+    "node_sample_weight",
+    "base_offset",
+    "model_output",
+    "tree_output",
+)
+
+
+def fingerprint(*objects) -> str:
+    # モデルの設定やデータの内容から求めるハッシュ
+    return joblib.hash((CACHE_VERSION, shap.__version__, *objects))[:16]
+
+
+def model_fingerprint(model: BaseEstimator) -> str:
+    # 学習済みモデルは pickle すると読み込む度にハッシュが変わる場合があるため,
+    # TreeExplainer が取り出した木の配列 (分岐, 閾値, 葉の値) から求める
+    trees = shap.TreeExplainer(model).model
+    return fingerprint([getattr(trees, name, None) for name in TREE_ATTRIBUTES])
+
+
+def fit_model(
+    model: BaseEstimator,
+    X: pd.DataFrame,
+    y: pd.Series,
+    cache_dir: str | None = None,
+) -> BaseEstimator:
+    # 学習済みモデルを <cache_dir>/models/<モデルの設定とデータのハッシュ>.joblib に保存し,
+    # 同じ設定とデータの場合は学習し直さない
+    cache_dir = cache_dir or default_cache_dir()
+    path = os.path.join(cache_dir, "models", f"{fingerprint(model, X, y)}.joblib")
+    if os.path.exists(path):
+        return joblib.load(path)
+    model = clone(model).fit(X, y)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+    return model
+
+
+def sample_background(
+    X: pd.DataFrame, size: int | None, random_state: int = 0
+) -> pd.DataFrame | None:
+    # None の場合は背景データを使わず, 木の分岐の件数から期待値を求める
+    # (tree_path_dependent, TreeExplainer で最も速い)
+    # 指定した場合は size 行を無作為に選び, 背景データに対する期待値を求める (interventional)
+    # (真偽値の列を含むと shap が object 型として扱うため浮動小数点数にする)
+    if size is None:
+        return None
+    if len(X) > size:
+        X = X.sample(n=size, random_state=random_state)
+    return X.astype(np.float64)
+
+
+def _positive_class(values: np.ndarray | list[np.ndarray]) -> np.ndarray:
+    # 二値分類でクラス毎の値を返すモデル (RandomForest など) は陽性クラスの値を使う
+    # shap < 0.45 はクラス毎の配列のリスト, それ以降は (行, 特徴量, クラス) の配列を返す
+    if isinstance(values, list):
+        return np.asarray(values[1])
+    values = np.asarray(values)
+    return values[..., 1] if values.ndim == 3 else values
+
+
+def _init_worker(model: BaseEstimator, background: pd.DataFrame | None) -> None:
+    global _explainer
+    _explainer = shap.TreeExplainer(model, data=background)
+
+
+def _explain_batch(input_path: str, output_path: str, start: int, stop: int) -> None:
+    # 入力と出力はメモリマップで開き, 担当する行の範囲だけを読み書きする
+    X = np.load(input_path, mmap_mode="r")[start:stop]
+    output = np.load(output_path, mmap_mode="r+")
+    output[start:stop] = _positive_class(_explainer.shap_values(X))
+    output.flush()
+
+
+class ShapExplanation:
+    # SHAP 値 (行, 特徴量) はメモリマップで開くため, 全行をメモリに載せずにプロットできる
+
+    def __init__(self, path: str, X: pd.DataFrame):
+        self.path = path
+        self.values = np.load(path, mmap_mode="r")
+        with open(f"{os.path.splitext(path)[0]}.json") as f:
+            self.expected_value = json.load(f)["expected_value"]
+        self.X = X
+
+    def sample(self, n: int, random_state: int = 0) -> tuple[np.ndarray, pd.DataFrame]:
+        # プロット用に n 行を無作為に選ぶ (読み込むのは選んだ行のみ)
+        if len(self.X) <= n:
+            return np.asarray(self.values), self.X
+        rng = np.random.default_rng(random_state)
+        rows = np.sort(rng.choice(len(self.X), size=n, replace=False))
+        return self.values[rows], self.X.iloc[rows]
+
+    def summary_plot(self, max_rows: int | None = None, **kwargs) -> None:
+        values, X = self.sample(max_rows) if max_rows else (self.values, self.X)
+        shap.summary_plot(np.asarray(values), X, **kwargs)
+
+    def dependence_plot(
+        self, feature: str, max_rows: int | None = None, **kwargs
+    ) -> None:
+        values, X = self.sample(max_rows) if max_rows else (self.values, self.X)
+        shap.dependence_plot(feature, np.asarray(values), X, **kwargs)
+
+
+def explain(
+    model: BaseEstimator,
+    X: pd.DataFrame,
+    background: pd.DataFrame | None = None,
+    batch_size: int = BATCH_SIZE,
+    workers: int | None = None,
+    cache_dir: str | None = None,
+) -> ShapExplanation:
+    # X の SHAP 値を TreeExplainer で計算し,
+    # <cache_dir>/<木, 背景データ, X のハッシュ>.npy に保存する
+    # 保存済みの場合は計算せずに読み込む
+    # 行を batch_size 毎に分け, ワーカープロセスで並行に計算する
+    cache_dir = cache_dir or default_cache_dir()
+    key = fingerprint(model_fingerprint(model), background, X)
+    path = os.path.join(cache_dir, f"{key}.npy")
+    if os.path.exists(path):
+        logger.info(f"Loaded SHAP values from {path}")
+        return ShapExplanation(path, X)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # ワーカーと共有するため入力もファイルに書き出し, 出力はファイル上に直接書き込む
+    input_path = os.path.join(cache_dir, f"{key}.{os.getpid()}.input.npy")
+    output_path = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp.npy")
+    np.save(input_path, X.to_numpy(dtype=np.float64))
+    output = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=np.float64, shape=X.shape
+    )
+    del output
+
+    ranges = [
+        (start, min(start + batch_size, len(X)))
+        for start in range(0, len(X), batch_size)
+    ]
+    workers = min(workers or os.cpu_count(), len(ranges))
+    try:
+        if workers <= 1:
+            _init_worker(model, background)
+            for start, stop in ranges:
+                _explain_batch(input_path, output_path, start, stop)
+        else:
+            # fork した子に親のスレッドの状態を持ち込まないように spawn で起動する
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(model, background),
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _explain_batch, input_path, output_path, start, stop
+                    )
+                    for start, stop in ranges
+                ]
+                for future in futures:
+                    future.result()
+    except BaseException:
+        os.remove(output_path)
+        raise
+    finally:
+        os.remove(input_path)
+
+    # 期待値 (SHAP 値の基準) はモデルと背景データのみで決まる
+    expected_value = np.ravel(shap.TreeExplainer(model, data=background).expected_value)
+    with open(f"{os.path.splitext(path)[0]}.json", "w") as f:
+        json.dump({"expected_value": float(expected_value[-1])}, f)
+    # SHAP 値を最後に置き換え, 揃っているかの判定に使う
+    os.replace(output_path, path)
+    return ShapExplanation(path, X)
@@ -0,0 +1,290 @@
+import argparse
+import os
+import sys
+from logging import basicConfig, getLogger
+
+import polars as pl
+from bson import ObjectId
+from mongoengine import Document
+from pycoshark.mongomodels import (
+    Commit,
+    File,
+    FileAction,
+    People,
+    Project,
+    PullRequest,
+    PullRequestComment,
+    PullRequestCommit,
+    PullRequestFile,
+    PullRequestReview,
+    PullRequestReviewComment,
+    PullRequestSystem,
+    VCSSystem,
+)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.chunked_query import iter_chunks
+from utils.mongo_client import close_mongodb, connect_to_mongodb
+from utils.timeit_decorator import timeit_decorator
+
+# ========================================
+# 定数
+# ========================================
+# コレクション毎に書き出す列 (列名: (射影式, 型))
+# ObjectId は文字列に変換し, スクリプトで使用するフィールドのみを残す
+SNAPSHOT_COLUMNS = {
+    Project: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "name": ("$name", pl.String),
+    },
+    VCSSystem: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "project_id": ({"$toString": "$project_id"}, pl.String),
+        "url": ("$url", pl.String),
+    },
+    Commit: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "vcs_system_id": ({"$toString": "$vcs_system_id"}, pl.String),
+        "committer_date": ("$committer_date", pl.Datetime("ms")),
+        "adjustedszz_bugfix": ("$labels.adjustedszz_bugfix", pl.Boolean),
+        "issueonly_bugfix": ("$labels.issueonly_bugfix", pl.Boolean),
+        "validated_bugfix": ("$labels.validated_bugfix", pl.Boolean),
+    },
+    FileAction: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "commit_id": ({"$toString": "$commit_id"}, pl.String),
+        "file_id": ({"$toString": "$file_id"}, pl.String),
+        "induces": ("$induces.label", pl.List(pl.String)),
+    },
+    File: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "vcs_system_id": ({"$toString": "$vcs_system_id"}, pl.String),
+        "path": ("$path", pl.String),
+    },
+    PullRequestSystem: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "project_id": ({"$toString": "$project_id"}, pl.String),
+        "url": ("$url", pl.String),
+    },
+    PullRequest: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "pull_request_system_id": (
+            {"$toString": "$pull_request_system_id"},
+            pl.String,
+        ),
+        "external_id": ("$external_id", pl.String),
+        "title": ("$title", pl.String),
+        "description": ("$description", pl.String),
+        "created_at": ("$created_at", pl.Datetime("ms")),
+        "merged_at": ("$merged_at", pl.Datetime("ms")),
+        "state": ("$state", pl.String),
+        "source_repo_url": ("$source_repo_url", pl.String),
+        "target_repo_url": ("$target_repo_url", pl.String),
+        "creator_id": ({"$toString": "$creator_id"}, pl.String),
+        "author_association": ("$author_association", pl.String),
+    },
+    PullRequestCommit: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "pull_request_id": ({"$toString": "$pull_request_id"}, pl.String),
+        "commit_id": ({"$toString": "$commit_id"}, pl.String),
+        "author_id": ({"$toString": "$author_id"}, pl.String),
+    },
+    PullRequestFile: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "pull_request_id": ({"$toString": "$pull_request_id"}, pl.String),
+        "path": ("$path", pl.String),
+        "additions": ("$additions", pl.Int64),
+        "deletions": ("$deletions", pl.Int64),
+    },
+    PullRequestComment: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "pull_request_id": ({"$toString": "$pull_request_id"}, pl.String),
+        "created_at": ("$created_at", pl.Datetime("ms")),
+    },
+    PullRequestReview: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "pull_request_id": ({"$toString": "$pull_request_id"}, pl.String),
+        "submitted_at": ("$submitted_at", pl.Datetime("ms")),
+        "state": ("$state", pl.String),
+    },
+    PullRequestReviewComment: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "pull_request_review_id": (
+            {"$toString": "$pull_request_review_id"},
+            pl.String,
+        ),
+        "created_at": ("$created_at", pl.Datetime("ms")),
+        # comment__exists=True の判定に使用
+        "has_comment": (
+            {"$ne": [{"$type": "$comment"}, "missing"]},
+            pl.Boolean,
+        ),
+    },
+    People: {
+        "id": ({"$toString": "$_id"}, pl.String),
+        "name": ("$name", pl.String),
+        "email": ("$email", pl.String),
+        "username": ("$username", pl.String),
+    },
+}
+
+# ロギングの設定
+basicConfig(
+    level="INFO",
+    format="[%(asctime)s] [%(levelname)s] %(message)s",
+)
+logger = getLogger(__name__)
+
+
+# ========================================
+# 読み込み
+# ========================================
+def snapshot_path(snapshot_dir: str, document: type[Document], project: str) -> str:
+    return os.path.join(
+        snapshot_dir,
+        document._get_collection_name(),
+        f"project={project}",
+        "part-0.parquet",
+    )
+
+
+def scan(
+    snapshot_dir: str, document: type[Document], project: str | None = None
+) -> pl.LazyFrame:
+    # project を指定した場合はそのパーティションのみを読み込む
+    if project is not None:
+        return pl.scan_parquet(snapshot_path(snapshot_dir, document, project))
+    return pl.scan_parquet(
+        os.path.join(snapshot_dir, document._get_collection_name(), "**", "*.parquet"),
+        hive_partitioning=True,
+    )
+
+
+def load_projects(snapshot_dir: str) -> list[Project]:
+    # スナップショット上のプロジェクトを Project として返す (DB 接続は不要)
+    projects = scan(snapshot_dir, Project).select("id", "name").collect()
+    return [
+        Project(id=ObjectId(project["id"]), name=project["name"])
+        for project in projects.iter_rows(named=True)
+    ]
+
+
+# ========================================
+# 書き出し
+# ========================================
+def schema(document: type[Document]) -> dict:
+    return {column: dtype for column, (_, dtype) in SNAPSHOT_COLUMNS[document].items()}
+
+
+def fetch(document: type[Document], match: dict) -> pl.DataFrame:
+    columns = SNAPSHOT_COLUMNS[document]
+    pipeline = [
+        {"$match": match},
+        {
+            "$project": {
+                "_id": 0,
+                **{column: expression for column, (expression, _) in columns.items()},
+            }
+        },
+    ]
+    return pl.DataFrame(
+        list(document._get_collection().aggregate(pipeline, allowDiskUse=True)),
+        schema=schema(document),
+    )
+
+
+def fetch_in(document: type[Document], field: str, ids: list[str]) -> pl.DataFrame:
+    # $in を分割して取得
+    frames = [
+        fetch(document, {field: {"$in": [ObjectId(id_) for id_ in chunk]}})
+        for chunk in iter_chunks(dict.fromkeys(ids))
+    ]
+    if not frames:
+        return pl.DataFrame(schema=schema(document))
+    return pl.concat(frames)
+
+
+def write(
+    df: pl.DataFrame, snapshot_dir: str, document: type[Document], project: str
+) -> None:
+    path = snapshot_path(snapshot_dir, document, project)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.write_parquet(path, compression="zstd")
+
+
+def export_project(project: Project, snapshot_dir: str) -> None:
+    frames = {}
+
+    # プロジェクトとシステム
+    frames[Project] = fetch(Project, {"_id": project.id})
+    frames[VCSSystem] = fetch(VCSSystem, {"project_id": project.id})
+    frames[PullRequestSystem] = fetch(PullRequestSystem, {"project_id": project.id})
+
+    # VCS に関するコレクション
+    vcs_system_ids = frames[VCSSystem]["id"].to_list()
+    frames[Commit] = fetch_in(Commit, "vcs_system_id", vcs_system_ids)
+    frames[File] = fetch_in(File, "vcs_system_id", vcs_system_ids)
+    frames[FileAction] = fetch_in(FileAction, "commit_id", frames[Commit]["id"])
+
+    # プルリクエストに関するコレクション
+    frames[PullRequest] = fetch_in(
+        PullRequest, "pull_request_system_id", frames[PullRequestSystem]["id"]
+    )
+    pull_request_ids = frames[PullRequest]["id"].to_list()
+    for document in (
+        PullRequestCommit,
+        PullRequestFile,
+        PullRequestComment,
+        PullRequestReview,
+    ):
+        frames[document] = fetch_in(document, "pull_request_id", pull_request_ids)
+    frames[PullRequestReviewComment] = fetch_in(
+        PullRequestReviewComment,
+        "pull_request_review_id",
+        frames[PullRequestReview]["id"],
+    )
+
+    # プルリクエストの作成者とコミットの作成者
+    people_ids = (
+        pl.concat(
+            [
+                frames[PullRequest]["creator_id"],
+                frames[PullRequestCommit]["author_id"],
+            ]
+        )
+        .drop_nulls()
+        .unique()
+    )
+    frames[People] = fetch_in(People, "_id", people_ids)
+
+    for document, df in frames.items():
+        write(df, snapshot_dir, document, project.name)
+
+
+@timeit_decorator(logger=logger)
+def main(args):
+    # データベースに接続
+    connect_to_mongodb()
+
+    # プロジェクトの取得
+    projects: list[Project] = Project.objects.only("id", "name")
+    if args.projects:
+        projects = projects.filter(name__in=args.projects)
+    project_count = len(projects)
+
+    # プロジェクト毎に書き出し
+    for i, project in enumerate(projects):
+        logger.info(f"{project.name} Start ({i + 1}/{project_count})")
+        export_project(project, args.output)
+
+    # データベースをクローズ
+    close_mongodb()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", type=str, default="data/snapshot")
+    parser.add_argument("--projects", nargs="*", default=None)
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,143 @@
+import os
+import re
+from typing import Iterable
+
+import numpy as np
+import polars as pl
+from bson import ObjectId
+from pycoshark.mongomodels import File, VCSSystem
+
+# ========================================
+# 定数
+# ========================================
+# ソースファイルの拡張子と言語
+SOURCE_FILE_LANGUAGES = {
+    # Java
+    ".java": "Java",
+    # Scala
+    ".scala": "Scala",
+    # Python
+    ".py": "Python",
+    # C
+    ".c": "C",
+    ".h": "C",
+    # C++
+    ".cpp": "C++",
+    ".hpp": "C++",
+    ".cc": "C++",
+    ".hh": "C++",
+    ".cxx": "C++",
+    ".hxx": "C++",
+    # C#
+    ".cs": "C#",
+    # JavaScript
+    ".js": "JavaScript",
+    # TypeScript
+    ".ts": "TypeScript",
+}
+SOURCE_FILE_EXTENSIONS = tuple(SOURCE_FILE_LANGUAGES)
+SOURCE_FILE_PATTERN = (
+    "(" + "|".join(re.escape(extension) for extension in SOURCE_FILE_EXTENSIONS) + ")$"
+)
+
+
+def classify_paths(paths: pl.Series) -> pl.DataFrame:
+    # パスの末尾の拡張子から is_source と language をまとめて判定
+    # (str.endswith(SOURCE_FILE_EXTENSIONS) と同じ判定)
+    language = (
+        paths.str.extract(r"(\.[^./]+)$")
+        .replace_strict(SOURCE_FILE_LANGUAGES, default=None, return_dtype=pl.String)
+        .alias("language")
+    )
+    return pl.DataFrame([language.is_not_null().alias("is_source"), language])
+
+
+def table_path(table_dir: str, vcs_system_id: ObjectId) -> str:
+    return os.path.join(table_dir, f"{vcs_system_id}.npz")
+
+
+class SourceFileTable:
+    # file_id (ObjectId の 12 バイト, 昇順) と is_source, language の対応表
+
+    def __init__(
+        self, file_ids: np.ndarray, is_source: np.ndarray, language: np.ndarray
+    ):
+        self.file_ids = file_ids
+        self.is_source = is_source
+        self.language = language
+
+    def __len__(self) -> int:
+        return len(self.file_ids)
+
+    def positions(self, file_ids: Iterable[ObjectId]) -> tuple[np.ndarray, np.ndarray]:
+        # 二分探索で位置を求め, 表に存在するかどうかと合わせて返す
+        keys = np.array(
+            [file_id.binary for file_id in file_ids if file_id], dtype="S12"
+        )
+        if not len(self.file_ids):
+            return np.zeros(len(keys), dtype=np.intp), np.zeros(len(keys), dtype=bool)
+        positions = np.searchsorted(self.file_ids, keys)
+        positions[positions == len(self.file_ids)] = 0
+        return positions, self.file_ids[positions] == keys
+
+    def lookup(self, file_ids: Iterable[ObjectId]) -> np.ndarray:
+        # 表に存在しない file は False (ソースファイルではない) を返す
+        positions, found = self.positions(file_ids)
+        return found & self.is_source[positions]
+
+    def languages(self, file_ids: Iterable[ObjectId]) -> list[str | None]:
+        positions, found = self.positions(file_ids)
+        return [
+            (self.language[position] or None) if is_found else None
+            for position, is_found in zip(positions, found)
+        ]
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(
+                f,
+                file_ids=self.file_ids,
+                is_source=self.is_source,
+                language=self.language,
+            )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "SourceFileTable":
+        with np.load(path) as data:
+            return cls(data["file_ids"], data["is_source"], data["language"])
+
+    @classmethod
+    def build(cls, vcs_system: VCSSystem) -> "SourceFileTable":
+        # vcs_system の全ファイルのパスを一度だけ取得して判定
+        files = list(
+            File.objects(vcs_system_id=vcs_system.id).only("id", "path").as_pymongo()
+        )
+        file_ids = np.array([file["_id"].binary for file in files], dtype="S12")
+        classes = classify_paths(
+            pl.Series([file.get("path") for file in files], dtype=pl.String)
+        )
+
+        # file_id の昇順に並べる (lookup で二分探索するため)
+        order = np.argsort(file_ids, kind="stable")
+        return cls(
+            file_ids[order],
+            classes["is_source"].to_numpy()[order],
+            classes["language"].fill_null("").to_numpy().astype(str)[order],
+        )
+
+
+def load_or_build_table(
+    vcs_system: VCSSystem, table_dir: str | None = None
+) -> SourceFileTable:
+    # table_dir を指定しない場合は保存せずに作成のみ行う
+    if table_dir is None:
+        return SourceFileTable.build(vcs_system)
+    path = table_path(table_dir, vcs_system.id)
+    if os.path.exists(path):
+        return SourceFileTable.load(path)
+    source_file_table = SourceFileTable.build(vcs_system)
+    source_file_table.save(path)
+    return source_file_table
@@ -0,0 +1,473 @@
+import argparse
+import os
+import sys
+from datetime import datetime, timedelta
+from logging import basicConfig, getLogger
+
+import numpy as np
+import polars as pl
+from bson import ObjectId
+from mongoengine import Document, connect
+from pycoshark.mongomodels import (
+    Commit,
+    File,
+    FileAction,
+    People,
+    Project,
+    PullRequest,
+    PullRequestComment,
+    PullRequestCommit,
+    PullRequestFile,
+    PullRequestReview,
+    PullRequestReviewComment,
+    PullRequestSystem,
+    VCSSystem,
+)
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+from utils.chunked_query import iter_chunks
+from utils.mongo_client import (
+    close_mongodb,
+    connect_to_mongodb,
+    is_production_database,
+)
+from utils.timeit_decorator import timeit_decorator
+
+# ========================================
+# 定数
+# ========================================
+# 分布の元になる統計 (800 の出力)
+DATA_DIR = os.path.join(os.path.dirname(__file__), "..", "800", "data")
+
+# 一度に挿入するドキュメント数
+INSERT_BATCH_SIZE = 10000
+
+# 統計に含まれないものの分布 (1 件あたりの平均)
+FILES_PER_COMMIT = 0.5
+FILE_ACTIONS_PER_COMMIT = 3.0
+PEOPLE_PER_PROJECT = 50
+PULL_REQUEST_FILES_PER_PULL_REQUEST = 4.0
+COMMENTS_PER_PULL_REQUEST = 2.0
+REVIEWS_PER_PULL_REQUEST = 1.0
+REVIEW_COMMENTS_PER_REVIEW = 1.0
+REVIEW_COMMENT_WITH_BODY_RATE = 0.8
+DEPENDABOT_RATE = 0.02
+MERGE_HOURS_LOG_MEAN = 3.0
+MERGE_HOURS_LOG_SIGMA = 1.5
+
+# ファイルの拡張子 (ソースファイル以外も含む) と出現率
+FILE_EXTENSIONS = {
+    ".java": 0.55,
+    "Test.java": 0.15,
+    ".xml": 0.08,
+    ".md": 0.05,
+    ".properties": 0.04,
+    ".py": 0.03,
+    ".js": 0.03,
+    ".scala": 0.02,
+    ".txt": 0.02,
+    ".cpp": 0.01,
+    ".h": 0.01,
+    ".ts": 0.01,
+}
+REVIEW_STATES = {"COMMENTED": 0.6, "APPROVED": 0.3, "CHANGES_REQUESTED": 0.1}
+AUTHOR_ASSOCIATIONS = {"CONTRIBUTOR": 0.5, "MEMBER": 0.3, "NONE": 0.2}
+
+# マージされたプルリクエストのコミット数の階級 (列名: (最小, 最大))
+COMMIT_COUNT_BUCKETS = {
+    "nmpr_nc==0": (0, 0),
+    "nmpr_nc==1": (1, 1),
+    "nmpr_1<nc<=5": (2, 5),
+    "nmpr_5<nc<=10": (6, 10),
+    "nmpr_10<nc<=20": (11, 20),
+    "nmpr_20<nc<=30": (21, 30),
+    "nmpr_30<nc": (31, 60),
+}
+
+# dependabot (analyze_author と同じ判定になるように作成する)
+DEPENDABOT_ID = ObjectId("5ff191c8c26a57681e7b99d0")
+DEPENDABOT_TITLE = "Bump {} from 1.0 to 1.1"
+DEPENDABOT_DESCRIPTION = (
+    "Dependabot will resolve any conflicts with this PR as long as you don't alter"
+    " it yourself. You can trigger Dependabot actions by commenting on this PR:"
+)
+
+# ロギングの設定
+basicConfig(
+    level="INFO",
+    format="[%(asctime)s] [%(levelname)s] %(message)s",
+)
+logger = getLogger(__name__)
+
+
+def connect_to_mongomock():
+    # mongomock はプロセス内のみで有効 (ベンチマークなどから import して使用する)
+    return connect(db="smartshark", host="mongomock://localhost")
+
+
+# ========================================
+# 統計の読み込み
+# ========================================
+def load_profiles(data_dir: str = DATA_DIR) -> pl.DataFrame:
+    # プロジェクト毎のコミットとプルリクエストの統計
+    commit_info = pl.read_csv(
+        os.path.join(data_dir, "commit_info.csv"), try_parse_dates=True
+    )
+    pull_request_info = pl.read_csv(
+        os.path.join(data_dir, "pull_request_info.csv"), try_parse_dates=True
+    )
+
+    profiles = commit_info.join(pull_request_info, on="project")
+
+    # 1<nc<=5 の列は nc==1 を含むため差し引く
+    return profiles.with_columns(
+        (pl.col("nmpr_1<nc<=5") - pl.col("nmpr_nc==1")).clip(lower_bound=0)
+    )
+
+
+def _choice(rng: np.random.Generator, weights: dict, size: int) -> np.ndarray:
+    probabilities = np.array(list(weights.values()), dtype=float)
+    return rng.choice(list(weights), size=size, p=probabilities / probabilities.sum())
+
+
+def _rate(count, total) -> float:
+    return min(count / total, 1.0) if total else 0.0
+
+
+def _dates(rng: np.random.Generator, start, end, size: int) -> list[datetime]:
+    # start から end の間で一様に (ミリ秒単位で) 生成
+    span_ms = max(int((end - start).total_seconds() * 1000), 1)
+    offsets = np.sort(rng.integers(0, span_ms, size=size))
+    return [start + timedelta(milliseconds=int(offset)) for offset in offsets]
+
+
+def _insert(document: type[Document], documents: list[dict]) -> None:
+    collection = document._get_collection()
+    for chunk in iter_chunks(documents, INSERT_BATCH_SIZE):
+        collection.insert_many(chunk, ordered=False)
+
+
+# ========================================
+# 生成
+# ========================================
+def generate_project(
+    name: str, profile: dict, scale: float, rng: np.random.Generator
+) -> dict:
+    documents = {document: [] for document in (Project, VCSSystem, PullRequestSystem)}
+    project_id = ObjectId()
+    vcs_system_id = ObjectId()
+    pull_request_system_id = ObjectId()
+    documents[Project].append({"_id": project_id, "name": name})
+    documents[VCSSystem].append(
+        {
+            "_id": vcs_system_id,
+            "project_id": project_id,
+            "url": f"https://github.com/apache/{name}.git",
+            "repository_type": "git",
+        }
+    )
+    documents[PullRequestSystem].append(
+        {
+            "_id": pull_request_system_id,
+            "project_id": project_id,
+            "url": f"https://api.github.com/repos/apache/{name}/pulls",
+        }
+    )
+
+    # 人
+    people_ids = [ObjectId() for _ in range(PEOPLE_PER_PROJECT)]
+    documents[People] = [
+        {
+            "_id": people_id,
+            "name": f"{name}-user{i}",
+            "email": f"{name}-user{i}@example.com",
+            "username": f"{name}-user{i}",
+        }
+        for i, people_id in enumerate(people_ids)
+    ]
+
+    # ファイル
+    nc = max(int(profile["nc"] * scale), 1)
+    nf = max(int(nc * FILES_PER_COMMIT), 1)
+    file_ids = [ObjectId() for _ in range(nf)]
+    extensions = _choice(rng, FILE_EXTENSIONS, nf)
+    documents[File] = [
+        {
+            "_id": file_id,
+            "vcs_system_id": vcs_system_id,
+            "path": f"src/main/{name}/module{i % 97}/File{i}{extension}",
+        }
+        for i, (file_id, extension) in enumerate(zip(file_ids, extensions))
+    ]
+
+    # コミット (bug-fixing のラベルは統計の割合で付与)
+    commit_ids = [ObjectId() for _ in range(nc)]
+    committer_dates = _dates(rng, profile["fcd"], profile["lcd"], nc)
+    fixing = {
+        label: rng.random(nc) < _rate(profile[column], profile["nc"])
+        for label, column in (
+            ("adjustedszz_bugfix", "nbfc_a"),
+            ("issueonly_bugfix", "nbfc_io"),
+            ("validated_bugfix", "nbfc_v"),
+        )
+    }
+    documents[Commit] = [
+        {
+            "_id": commit_id,
+            "vcs_system_id": vcs_system_id,
+            "revision_hash": f"{commit_id}{i:016x}",
+            "committer_date": committer_date,
+            "author_id": people_ids[rng.integers(len(people_ids))],
+            "labels": {label: bool(flags[i]) for label, flags in fixing.items()},
+        }
+        for i, (commit_id, committer_date) in enumerate(
+            zip(commit_ids, committer_dates)
+        )
+    ]
+
+    # ファイルアクション (bug-inducing のラベルはコミット単位の割合で付与)
+    inducing = {
+        column.removeprefix("nbic_").upper(): rng.random(nc)
+        < _rate(profile[column], profile["nc"])
+        for column in profile
+        if column.startswith("nbic_")
+    }
+    file_action_counts = rng.poisson(FILE_ACTIONS_PER_COMMIT, nc) + 1
+    documents[FileAction] = []
+    for i, commit_id in enumerate(commit_ids):
+        induces = [
+            {"label": label, "change_file_action_id": ObjectId()}
+            for label, flags in inducing.items()
+            if flags[i]
+        ]
+        targets = rng.choice(nf, size=min(file_action_counts[i], nf), replace=False)
+        for j, target in enumerate(targets):
+            documents[FileAction].append(
+                {
+                    "_id": ObjectId(),
+                    "commit_id": commit_id,
+                    "file_id": file_ids[target],
+                    "mode": "M",
+                    # 不具合混入のラベルは先頭のファイルアクションに付与
+                    "induces": induces if j == 0 else [],
+                }
+            )
+
+    # プルリクエスト (マージ済み, リジェクト, オープン)
+    npr = max(int(profile["npr"] * scale), 1)
+    merged_rate = _rate(profile["nmpr"], profile["npr"])
+    rejected_rate = _rate(profile["nrpr"], profile["npr"])
+    states = _choice(
+        rng,
+        {
+            "merged": merged_rate,
+            "rejected": rejected_rate,
+            "open": max(1.0 - merged_rate - rejected_rate, 0.0),
+        },
+        npr,
+    )
+    created_dates = _dates(rng, profile["fprd"], profile["lprd"], npr)
+
+    # コミット数の階級と commit_id の欠損の度合い (all, partial, none)
+    bucket_weights = {
+        bucket: profile[bucket] for bucket in COMMIT_COUNT_BUCKETS if profile[bucket]
+    } or {"nmpr_nc==1": 1}
+    missing_weights = {
+        "all": profile["nmpr_all"],
+        "partial": profile["nmpr_partial"],
+        "none": profile["nmpr_none"],
+    }
+    if not sum(missing_weights.values()):
+        missing_weights = {"all": 1}
+    buckets = _choice(rng, bucket_weights, npr)
+    missings = _choice(rng, missing_weights, npr)
+    is_dependabot = rng.random(npr) < DEPENDABOT_RATE
+    associations = _choice(rng, AUTHOR_ASSOCIATIONS, npr)
+
+    for document in (
+        PullRequest,
+        PullRequestCommit,
+        PullRequestFile,
+        PullRequestComment,
+        PullRequestReview,
+        PullRequestReviewComment,
+    ):
+        documents[document] = []
+    for i in range(npr):
+        pull_request_id = ObjectId()
+        created_at = created_dates[i]
+        creator_id = (
+            DEPENDABOT_ID
+            if is_dependabot[i]
+            else people_ids[rng.integers(len(people_ids))]
+        )
+        pull_request = {
+            "_id": pull_request_id,
+            "pull_request_system_id": pull_request_system_id,
+            "external_id": str(i + 1),
+            "title": (
+                DEPENDABOT_TITLE.format(f"dependency{i}")
+                if is_dependabot[i]
+                else f"{name} change {i + 1}"
+            ),
+            "description": (
+                DEPENDABOT_DESCRIPTION if is_dependabot[i] else "Synthetic change."
+            ),
+            "created_at": created_at,
+            "updated_at": created_at,
+            "state": "open" if states[i] == "open" else "closed",
+            "creator_id": creator_id,
+            "author_association": associations[i],
+            "target_repo_url": f"https://api.github.com/repos/apache/{name}",
+            "source_repo_url": (
+                f"https://api.github.com/repos/apache/{name}"
+                if rng.random() < 0.3
+                else f"https://api.github.com/repos/fork{i % 13}/{name}"
+            ),
+        }
+        if states[i] == "merged":
+            pull_request["merged_at"] = created_at + timedelta(
+                hours=float(rng.lognormal(MERGE_HOURS_LOG_MEAN, MERGE_HOURS_LOG_SIGMA))
+            )
+        documents[PullRequest].append(pull_request)
+
+        # プルリクエストコミット (commit_id を欠損させるものも含む)
+        low, high = COMMIT_COUNT_BUCKETS[buckets[i]]
+        n_commits = int(rng.integers(low, high + 1))
+        start = int(rng.integers(0, max(nc - n_commits, 0) + 1))
+        for k in range(n_commits):
+            pull_request_commit = {
+                "_id": ObjectId(),
+                "pull_request_id": pull_request_id,
+                "author_id": creator_id,
+                "commit_sha": f"{pull_request_id}{k:08x}",
+            }
+            has_commit_id = missings[i] == "all" or (
+                missings[i] == "partial" and (k == 0 or rng.random() < 0.5)
+            )
+            if has_commit_id and start + k < nc:
+                pull_request_commit["commit_id"] = commit_ids[start + k]
+            documents[PullRequestCommit].append(pull_request_commit)
+
+        # プルリクエストファイル
+        for k in range(rng.poisson(PULL_REQUEST_FILES_PER_PULL_REQUEST)):
+            documents[PullRequestFile].append(
+                {
+                    "_id": ObjectId(),
+                    "pull_request_id": pull_request_id,
+                    "path": documents[File][int(rng.integers(nf))]["path"],
+                    "status": "modified",
+                    "additions": int(rng.geometric(0.05)),
+                    "deletions": int(rng.geometric(0.1)) - 1,
+                    "changes": 0,
+                }
+            )
+
+        # コメントとレビュー
+        for k in range(rng.poisson(COMMENTS_PER_PULL_REQUEST)):
+            documents[PullRequestComment].append(
+                {
+                    "_id": ObjectId(),
+                    "pull_request_id": pull_request_id,
+                    "external_id": f"{pull_request_id}-c{k}",
+                    "created_at": created_at + timedelta(hours=k + 1),
+                    "author_id": people_ids[rng.integers(len(people_ids))],
+                    "comment": "Synthetic comment.",
+                }
+            )
+        for k in range(rng.poisson(REVIEWS_PER_PULL_REQUEST)):
+            review_id = ObjectId()
+            documents[PullRequestReview].append(
+                {
+                    "_id": review_id,
+                    "pull_request_id": pull_request_id,
+                    "external_id": f"{pull_request_id}-r{k}",
+                    "submitted_at": created_at + timedelta(hours=k + 1),
+                    "state": _choice(rng, REVIEW_STATES, 1)[0],
+                    "creator_id": people_ids[rng.integers(len(people_ids))],
+                }
+            )
+            for m in range(rng.poisson(REVIEW_COMMENTS_PER_REVIEW)):
+                review_comment = {
+                    "_id": ObjectId(),
+                    "pull_request_review_id": review_id,
+                    "external_id": f"{review_id}-rc{m}",
+                    "created_at": created_at + timedelta(hours=k + 1, minutes=m),
+                }
+                if rng.random() < REVIEW_COMMENT_WITH_BODY_RATE:
+                    review_comment["comment"] = "Synthetic review comment."
+                documents[PullRequestReviewComment].append(review_comment)
+
+    return documents
+
+
+def populate(
+    n_projects: int,
+    scale: float = 1.0,
+    seed: int = 0,
+    data_dir: str = DATA_DIR,
+    prefix: str = "synthetic",
+) -> list[str]:
+    # 統計から復元抽出したプロジェクトを n_projects 個生成して挿入
+    rng = np.random.default_rng(seed)
+    profiles = load_profiles(data_dir)
+    names = []
+
+    # dependabot はプロジェクトを跨いで 1 人
+    if not People.objects(id=DEPENDABOT_ID).count():
+        _insert(
+            People,
+            [
+                {
+                    "_id": DEPENDABOT_ID,
+                    "name": "dependabot[bot]",
+                    "email": "dependabot[bot]@users.noreply.github.com",
+                    "username": "dependabot[bot]",
+                }
+            ],
+        )
+
+    for i in range(n_projects):
+        profile = profiles.row(int(rng.integers(profiles.height)), named=True)
+        name = f"{prefix}-{i:04d}"
+        logger.info(f"{name} Start ({i + 1}/{n_projects}) from {profile['project']}")
+        for document, documents in generate_project(name, profile, scale, rng).items():
+            _insert(document, documents)
+        names.append(name)
+
+    return names
+
+
+@timeit_decorator(logger=logger)
+def main(args):
+    # 合成データ用のデータベースに接続
+    client = connect_to_mongodb(args.database)
+
+    # 既存のデータを削除 (合成データ用のデータベースのみ)
+    if args.drop:
+        client.drop_database(args.database)
+
+    populate(args.projects, args.scale, args.seed, args.data_dir, args.prefix)
+
+    # データベースをクローズ
+    close_mongodb()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--projects", type=int, default=10)
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--data-dir", type=str, default=DATA_DIR)
+    parser.add_argument("--prefix", type=str, default="synthetic")
+    parser.add_argument("--database", type=str, default="smartshark_synthetic")
+    parser.add_argument("--drop", default=False, action="store_true")
+    args = parser.parse_args()
+    # 抽出スクリプトが読み込むデータベースには合成データを混ぜない
+    if is_production_database(args.database):
+        parser.error(
+            f"--database {args.database} is SMARTSHARK_DB_DATABASE; "
+            "use a separate database for synthetic data"
+        )
+
+    main(args)